@@ -0,0 +1,127 @@
+#!/usr/bin/env python2.7
+
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+Micro-benchmarks for the hot paths of the verification. Each benchmark is
+run on the same set of generated receipts and the time per receipt is
+printed.
+"""
+
+from __future__ import print_function
+from builtins import int
+from builtins import range
+
+import gettext
+gettext.install('rktool', './lang', True)
+
+import datetime
+import os
+import random
+import sys
+import timeit
+
+from librksv import algorithms
+from librksv import cashreg
+from librksv import receipt
+from librksv import sigsys
+from librksv import utils
+
+def usage():
+    print("Usage: ./benchmark.py <private key file> <number of receipts> [<benchmark>]...")
+    print("Benchmarks: {}".format(' '.join(sorted(BENCHMARKS.keys()))))
+    sys.exit(0)
+
+def generateReceipts(priv, num):
+    sigsystem = sigsys.SignatureSystemWorking("AT0", "U:ATU12345678-K1",
+            priv)
+    register = cashreg.CashRegister("BENCHMARK-1", None, 0, os.urandom(32))
+
+    dateTime = datetime.datetime(2017, 1, 1)
+    recs = [ register.receipt('R1', "0", dateTime, 0.0, 0.0, 0.0, 0.0, 0.0,
+        sigsystem) ]
+    for i in range(1, num):
+        dateTime += datetime.timedelta(seconds=1)
+        sums = [ round(random.uniform(-1000, 1000), 2) for j in range(5) ]
+        recs.append(register.receipt('R1', "%d" % i, dateTime, sums[0],
+            sums[1], sums[2], sums[3], sums[4], sigsystem))
+
+    return [ r.toJWSString('R1') for r in recs ]
+
+def benchConstruct(jwss):
+    recs = [ receipt.Receipt.fromJWSString(j)[0] for j in jwss ]
+    args = [ (r.zda, r.registerId, r.receiptId, r.dateTimeStr, r.sumAStr,
+        r.sumBStr, r.sumCStr, r.sumDStr, r.sumEStr, r.encTurnoverCounter,
+        r.certSerial, r.previousChain) for r in recs ]
+    return lambda: [ receipt.Receipt(*a) for a in args ]
+
+def benchSums(jwss):
+    recs = [ receipt.Receipt.fromJWSString(j)[0] for j in jwss ]
+    sums = [ s for r in recs for s in (r.sumAStr, r.sumBStr, r.sumCStr,
+        r.sumDStr, r.sumEStr) ]
+    return lambda: [ utils.getReceiptCents(s) for s in sums ]
+
+def benchTimestamps(jwss):
+    recs = [ receipt.Receipt.fromJWSString(j)[0] for j in jwss ]
+    timestamps = [ r.dateTimeStr for r in recs ]
+    return lambda: [ utils.getReceiptTimestamp(t) for t in timestamps ]
+
+def benchChain(jwss):
+    recs = [ receipt.CompactReceipt.fromJWSString(j)[0] for j in jwss ]
+    alg = algorithms.ALGORITHMS['R1']
+    pairs = list(zip(recs[1:], jwss[:-1]))
+    return lambda: [ alg.chain(r, p) for r, p in pairs ]
+
+def benchParse(jwss):
+    return lambda: [ receipt.Receipt.fromJWSString(j) for j in jwss ]
+
+def benchParseCompact(jwss):
+    return lambda: [ receipt.CompactReceipt.fromJWSString(j) for j in jwss ]
+
+BENCHMARKS = {
+        'chain': benchChain,
+        'construct': benchConstruct,
+        'parse': benchParse,
+        'parse-compact': benchParseCompact,
+        'sums': benchSums,
+        'timestamps': benchTimestamps,
+        }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        usage()
+
+    priv = None
+    with open(sys.argv[1]) as f:
+        priv = f.read()
+    num = int(sys.argv[2])
+    if num < 1:
+        print(_("The number of receipts must be at least 1."))
+        sys.exit(0)
+
+    names = sys.argv[3:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            usage()
+
+    jwss = generateReceipts(priv, num)
+
+    for name in names:
+        func = BENCHMARKS[name](jwss)
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print("{:<20} {:10.2f} us/receipt".format(name, best / num * 1e6))
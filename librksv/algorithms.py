@@ -108,6 +108,18 @@ class AlgorithmI(object):
         """
         raise NotImplementedError("Please implement this yourself.")
 
+    def verifyRaw(self, signingInput, signature, pubKey):
+        """
+        Verifies a JWS signature that has already been decoded. This avoids
+        having to serialize and parse the JWS again.
+        :param signingInput: The JWS signing input (i.e. the encoded header
+        and payload separated by a dot) as a byte list.
+        :param signature: The decoded signature as a byte list.
+        :param pubKey: The public key to use in cryptography's own format.
+        :return: True if the signature is valid, False otherwise.
+        """
+        raise NotImplementedError("Please implement this yourself.")
+
     def verifyKey(self, key):
         """
         Checks if the given key is valid for encrypting/decrypting the
@@ -142,6 +154,23 @@ class AlgorithmI(object):
         """
         raise NotImplementedError("Please implement this yourself.")
 
+    def decryptTurnoverCounters(self, receipts, key,
+            encTurnoverCounters = None):
+        """
+        Decrypts the turnover counters of several receipts with the key.
+        :param receipts: The receipt objects as a list. They must not be
+        dummy receipts or reversals.
+        :param key: The key as a byte list.
+        :param encTurnoverCounters: The encrypted turnover counters as a list
+        of byte lists or None to decode them from the receipts.
+        :return: The turnover counters as a list of ints.
+        """
+        if encTurnoverCounters is None:
+            encTurnoverCounters = [ utils.b64decode(
+                r.encTurnoverCounter.encode('utf-8')) for r in receipts ]
+        return [ self.decryptTurnoverCounter(r, ct, key)
+                for r, ct in zip(receipts, encTurnoverCounters) ]
+
 class R1(AlgorithmI):
     """
     This is the implementation of the \"R1\" algorithm.
@@ -196,6 +225,9 @@ class R1(AlgorithmI):
             return True
         return False
 
+    def verifyRaw(self, signingInput, signature, pubKey):
+        return utils.verifyES256(pubKey, signature, signingInput)
+
     def verifyKey(self, key):
         if not isinstance(key, bytes):
             return False
@@ -218,4 +250,36 @@ class R1(AlgorithmI):
 
         return int.from_bytes(decCtr, byteorder='big', signed=True)
 
+    def decryptTurnoverCounters(self, receipts, key,
+            encTurnoverCounters = None):
+        if encTurnoverCounters is None:
+            encTurnoverCounters = [ utils.b64decode(
+                r.encTurnoverCounter.encode('utf-8')) for r in receipts ]
+
+        # A turnover counter fits into a single AES block, so the CTR key
+        # stream for each receipt is just its encrypted IV. This lets us
+        # encrypt all IVs with one cipher context.
+        ivs = b''.join(utils.sha256(r.registerId.encode("utf-8")
+            + r.receiptId.encode("utf-8"))[0:16] for r in receipts)
+        keyStream = utils.aes256ecb(key, ivs)
+
+        counters = list()
+        for i, ct in enumerate(encTurnoverCounters):
+            size = len(ct)
+            if size > 16:
+                counters.append(self.decryptTurnoverCounter(receipts[i], ct,
+                    key))
+                continue
+            if size == 0:
+                counters.append(0)
+                continue
+            ks = keyStream[16 * i:16 * i + size]
+            counter = int.from_bytes(ct, byteorder='big') ^ int.from_bytes(
+                    ks, byteorder='big')
+            if counter >> (8 * size - 1):
+                counter -= 1 << (8 * size)
+            counters.append(counter)
+
+        return counters
+
 ALGORITHMS = { 'R1': R1() }
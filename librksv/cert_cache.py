@@ -0,0 +1,133 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module contains a cache for certificate chains that have already been
+verified against a key store, so that the same chain in multiple chunks or
+groups of a DEP is only verified once. The cache can be written to and read
+from JSON to reuse it across multiple verifications.
+"""
+from builtins import int
+from builtins import range
+
+from .gettext_helper import _
+
+from six import string_types
+
+import hashlib
+
+from . import utils
+
+class CertificateChainCacheException(utils.RKSVException):
+    def __init__(self, message):
+        super(CertificateChainCacheException, self).__init__(message)
+        self._initargs = (message,)
+
+class MalformedCertificateChainCacheException(CertificateChainCacheException):
+    """
+    Indicates that a certificate chain cache read from JSON is malformed.
+    """
+
+    def __init__(self, msg):
+        super(MalformedCertificateChainCacheException, self).__init__(
+                _("Malformed certificate chain cache: {}").format(msg))
+        self._initargs = (msg,)
+
+def keyStoreFingerprint(keyStore):
+    """
+    Gets a fingerprint of the contents of a key store. It changes whenever a
+    key or certificate is added to or removed from the key store.
+    :param keyStore: The key store.
+    :return: The fingerprint as a string.
+    """
+    entries = list()
+    for keyId in sorted(keyStore.getKeyIds()):
+        cert = keyStore.getCert(keyId)
+        if cert:
+            entries.append(u'{} cert {}'.format(keyId,
+                utils.certFingerprint(cert)))
+        else:
+            entries.append(u'{} key {}'.format(keyId,
+                utils.exportKeyToPEM(keyStore.getKey(keyId))))
+    return hashlib.sha256(u'\n'.join(entries).encode('utf-8')).hexdigest()
+
+class CertificateChainCache(object):
+    """
+    Remembers the certificate chains that verify.verifyCert() successfully
+    verified against a key store. Chains are identified by the fingerprints
+    of their certificates. The cache is bound to the contents of one key
+    store and forgets all chains if it is used with a different one. Note
+    that a cache read from disk is trusted like the key store itself.
+    """
+
+    def __init__(self):
+        self.keyStoreFingerprint = None
+        self.chains = set()
+
+    def useKeyStore(self, keyStore):
+        """
+        Binds the cache to the given key store. If the cache contains chains
+        verified against a different key store, they are discarded.
+        :param keyStore: The key store.
+        """
+        fp = keyStoreFingerprint(keyStore)
+        if fp != self.keyStoreFingerprint:
+            self.keyStoreFingerprint = fp
+            self.chains = set()
+
+    @staticmethod
+    def chainKey(cert, chain):
+        """
+        Gets the key identifying a certificate and its signing chain.
+        :param cert: The certificate as an object.
+        :param chain: A list of certificates as objects.
+        :return: The key as a string.
+        """
+        return u' '.join(utils.certFingerprint(c) for c in [cert] + list(chain))
+
+    def isVerified(self, chainKey):
+        return chainKey in self.chains
+
+    def addVerified(self, chainKey):
+        self.chains.add(chainKey)
+
+    def writeCacheToJson(self):
+        return {
+                'keyStore': self.keyStoreFingerprint,
+                'chains': sorted(self.chains)
+        }
+
+    @staticmethod
+    def readCacheFromJson(json):
+        if not isinstance(json, dict):
+            raise MalformedCertificateChainCacheException(_('not an object'))
+
+        fp = json.get('keyStore')
+        if fp is not None and not isinstance(fp, string_types):
+            raise MalformedCertificateChainCacheException(
+                    _('keyStore is not a string'))
+
+        chains = json.get('chains', list())
+        if not isinstance(chains, list) or not all(isinstance(c,
+            string_types) for c in chains):
+            raise MalformedCertificateChainCacheException(
+                    _('chains is not a list of strings'))
+
+        ret = CertificateChainCache()
+        ret.keyStoreFingerprint = fp
+        ret.chains = set(chains)
+        return ret
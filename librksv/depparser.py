@@ -350,12 +350,15 @@ def shrinkDEPReceipt(rec, idx = None):
 def expandDEPReceipt(rec, idx = None):
     """
     Decodes a receipt JWS byte array to a regular string.
-    :param rec: The receipt JWS as a byte array.
+    :param rec: The receipt JWS as a byte array or a memoryview of one.
     :param idx: The index of the group in the DEP to which the receipt belongs
     or None if it is unknown. This is only used to generate error messages.
     :return: The receipt JWS as a string.
     """
     try:
+        if isinstance(rec, memoryview):
+            # A receipt in shared memory, see shared_chunks.
+            return str(rec, 'utf-8')
         return rec.decode('utf-8')
     except UnicodeDecodeError:
         if idx is None:
@@ -704,7 +707,7 @@ class FullFileDEPParser(DEPParserI):
 def receiptGroupAdapter(depgen):
     for chunk in depgen:
         for recs, cert, cert_list in chunk:
-            rec_tuples = [ receipt.Receipt.fromJWSString(expandDEPReceipt(r))
+            rec_tuples = [ receipt.CompactReceipt.fromJWSString(expandDEPReceipt(r))
                     for r in recs ]
             recs = None
             yield (rec_tuples, cert, cert_list)
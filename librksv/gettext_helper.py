@@ -22,3 +22,12 @@ import six
 # We always want text to be unicode encoded.
 _gt = gettext.translation('rktool', './lang', fallback=True)
 _ = _gt.ugettext if six.PY2 else _gt.gettext
+
+def N_(message):
+    """
+    Marks a message for translation without translating it. Use this for
+    messages that are only translated with _() once they are actually needed.
+    :param message: The untranslated message.
+    :return: The message as is.
+    """
+    return message
@@ -22,11 +22,10 @@ functions.
 from builtins import int
 from builtins import range
 
-from .gettext_helper import _
+from .gettext_helper import _, N_
 
 import base64
 import binascii
-import datetime
 import enum
 import re
 
@@ -162,238 +161,282 @@ class CertSerialType(enum.Enum):
 algRegex = re.compile(r'^R[1-9]\d*$')
 zdaRegex = re.compile(r'^([A-Z][A-Z][1-9]\d*|AT0)$')
 
+# The reason passed to the following functions is the untranslated message
+# with a placeholder for the offending value. It is only translated and
+# formatted if the value is actually invalid.
+
 def _getSum(s, receiptId, reason):
     if not isinstance(s, string_types) or not s:
-        raise MalformedReceiptException(receiptId, reason)
-    sF = utils.getReceiptFloat(s)
-    if sF is None:
-        raise MalformedReceiptException(receiptId, reason)
-    return sF
+        raise MalformedReceiptException(receiptId, _(reason).format(s))
+    sC = utils.getReceiptCents(s)
+    if sC is None:
+        raise MalformedReceiptException(receiptId, _(reason).format(s))
+    return sC
 
 def _getTimestamp(dateTime, receiptId, reason):
     if not isinstance(dateTime, string_types) or not dateTime:
-        raise MalformedReceiptException(receiptId, reason)
+        raise MalformedReceiptException(receiptId, _(reason).format(dateTime))
     try:
-        dateTimeDT = datetime.datetime.strptime(dateTime, "%Y-%m-%dT%H:%M:%S")
+        return utils.getReceiptTimestamp(dateTime)
     except ValueError:
-        raise MalformedReceiptException(receiptId, reason)
-    if not dateTimeDT:
-        raise MalformedReceiptException(receiptId, reason)
-    return dateTimeDT
+        raise MalformedReceiptException(receiptId, _(reason).format(dateTime))
 
 def _getEmptyOrB64(b, receiptId, reason):
     if not isinstance(b, string_types):
-        raise MalformedReceiptException(receiptId, reason)
+        raise MalformedReceiptException(receiptId, _(reason).format(b))
     try:
         return utils.b64decode(b.encode('utf-8'))
     except (TypeError, binascii.Error):
-        raise MalformedReceiptException(receiptId, reason)
+        raise MalformedReceiptException(receiptId, _(reason).format(b))
 
-class Receipt(object):
+def _checkReceipt(zda, registerId, receiptId, dateTime,
+        sumA, sumB, sumC, sumD, sumE, encTurnoverCounter,
+        certSerial, previousChain):
     """
-    The basic receipt class. Contains methods to convert a receipt to and from
-    various string formats.
+    Performs all checks on the elements of a receipt that are done when a
+    receipt object is created. The parameters are the same as for
+    Receipt.__init__().
+    :return: The timestamp as int (see utils.getReceiptTimestamp()), the sums as a tuple of
+    ints (in cents) and the decoded encrypted turnover counter as a byte list.
+    :throws: MalformedReceiptException
+    :throws: CertSerialInvalidException
+    :throws: InvalidCertificateProviderException
     """
-
-    def __init__(self, zda, registerId, receiptId, dateTime,
-            sumA, sumB, sumC, sumD, sumE, encTurnoverCounter,
-            certSerial, previousChain):
-        """
-        Creates a new receipt object. The dateTime and sum[A-E] attributes
-        are stored as datetime and float objects respectively but their
-        string representations are retained for the various to*() methods
-        to ensure signatures remain valid after conversion.
-        :param zda: The ZDA ID as a string.
-        :param registerId: The ID of the register as a string.
-        :param receiptId: The ID of the receipt as a string.
-        :param dateTime: The receipt's timestamp as a string.
-        :param sumA: The first sum as a string.
-        :param sumB: The second sum as a string.
-        :param sumC: The third sum as a string.
-        :param sumD: The fourth sum as a string.
-        :param sumE: The fifth sum as a string.
-        :param encTurnoverCounter: The encrypted turnover counter as a base64
-        encoded string.
-        :param certSerial: The certificate's serial or a key ID as a string.
-        :param previousChain: The chaining value for the previous receipt as a
-        base64 encoded string.
-        """
-        if not isinstance(receiptId, string_types) or not receiptId:
-            raise MalformedReceiptException(_("Unknown Receipt"),
-                    _("Receipt ID \"{}\" invalid.").format(receiptId))
-        if '_' in receiptId:
+    if not isinstance(receiptId, string_types) or not receiptId:
+        raise MalformedReceiptException(_("Unknown Receipt"),
+                _("Receipt ID \"{}\" invalid.").format(receiptId))
+    if '_' in receiptId:
+        raise MalformedReceiptException(receiptId,
+                _("Receipt ID \"{}\" invalid.").format(receiptId))
+
+    if not isinstance(zda, string_types) or not zda \
+            or zdaRegex.match(zda) is None:
+        raise MalformedReceiptException(receiptId,
+                _("ZDA \"{}\" invalid.").format(zda))
+
+    if not isinstance(registerId, string_types) or not registerId \
+            or '_' in registerId:
+        raise MalformedReceiptException(receiptId,
+                _("Register ID \"{}\" invalid.").format(registerId))
+
+    timestamp = _getTimestamp(dateTime, receiptId,
+                N_("Timestamp \"{}\" invalid."))
+
+    sumAC = _getSum(sumA, receiptId, N_('Sum tax normal \"{}\" invalid.'))
+    sumBC = _getSum(sumB, receiptId, N_('Sum tax reduced 1 \"{}\" invalid.'))
+    sumCC = _getSum(sumC, receiptId, N_('Sum tax reduced 2 \"{}\" invalid.'))
+    sumDC = _getSum(sumD, receiptId, N_('Sum tax zero \"{}\" invalid.'))
+    sumEC = _getSum(sumE, receiptId, N_('Sum tax special \"{}\" invalid.'))
+
+    # Due to how algorithm works encTurnoverCounter and previousChain
+    # can both be the empty string when the receipt is created and not
+    # parsed from a string.
+    encTC = _getEmptyOrB64(encTurnoverCounter, receiptId,
+            N_('Encrypted turnover counter \"{}\" invalid.'))
+    _getEmptyOrB64(previousChain, receiptId,
+            N_('Chaining value \"{}\" invalid.'))
+
+    if not isinstance(certSerial, string_types) \
+            or not certSerial:
+        raise MalformedReceiptException(receiptId,
+                _('Certificate serial/Key ID \"{}\" invalid.').format(
+                    certSerial))
+    certSerialType = CertSerialType.getCertSerialType(certSerial)
+    if certSerialType == CertSerialType.INVALID:
+        raise CertSerialInvalidException(receiptId)
+    if certSerialType == CertSerialType.SERIAL:
+        if zda == 'AT0':
+            raise InvalidCertificateProviderException(receiptId)
+    else:
+        if zda != 'AT0':
+            raise InvalidCertificateProviderException(receiptId)
+
+    # perform post check of turnover counter
+    if len(encTC) != 0 and (len(encTC) < 5 or len(encTC) > 16):
+        if not (encTC == b'TRA' or encTC == b'STO'):
             raise MalformedReceiptException(receiptId,
-                    _("Receipt ID \"{}\" invalid.").format(receiptId))
+                    _('Encrypted turnover counter \"{}\" invalid.').format(
+                        encTurnoverCounter))
 
-        if not isinstance(zda, string_types) or not zda \
-                or zdaRegex.match(zda) is None:
-            raise MalformedReceiptException(receiptId,
-                    _("ZDA \"{}\" invalid.").format(zda))
+    return timestamp, (sumAC, sumBC, sumCC, sumDC, sumEC), encTC
 
-        if not isinstance(registerId, string_types) or not registerId \
-                or '_' in registerId:
-            raise MalformedReceiptException(receiptId,
-                    _("Register ID \"{}\" invalid.").format(registerId))
-
-        dateTimeDT = _getTimestamp(dateTime, receiptId,
-                    _("Timestamp \"{}\" invalid.").format(dateTime))
-
-        sumAF = _getSum(sumA, receiptId,
-                _('Sum tax normal \"{}\" invalid.').format(sumA))
-        sumBF = _getSum(sumB, receiptId,
-                _('Sum tax reduced 1 \"{}\" invalid.').format(sumB))
-        sumCF = _getSum(sumC, receiptId,
-                _('Sum tax reduced 2 \"{}\" invalid.').format(sumC))
-        sumDF = _getSum(sumD, receiptId,
-                _('Sum tax zero \"{}\" invalid.').format(sumD))
-        sumEF = _getSum(sumE, receiptId,
-                _('Sum tax special \"{}\" invalid.').format(sumE))
-
-        # Due to how algorithm works encTurnoverCounter and previousChain
-        # can both be the empty string when the receipt is created and not
-        # parsed from a string.
-        encTC = _getEmptyOrB64(encTurnoverCounter, receiptId,
-                _('Encrypted turnover counter \"{}\" invalid.').format(
-                    encTurnoverCounter))
-        _getEmptyOrB64(previousChain, receiptId,
+def _checkSignature(receiptId, header, signature):
+    """
+    Performs the checks done when a receipt is signed.
+    :param receiptId: The ID of the receipt as a string.
+    :param header: The JWS header as a string.
+    :param signature: The signature as an urlsafe base64 encoded string
+    without padding.
+    :return: The decoded signature as a byte list.
+    :throws: MalformedReceiptException
+    """
+    if not isinstance(header, string_types):
+        raise MalformedReceiptException(receiptId,
+                _('JWS header \"{}\" invalid.').format(header))
+
+    if not isinstance(signature, string_types):
+        raise MalformedReceiptException(receiptId,
+                _('Signature \"{}\" invalid.').format(signature))
+    if signature.endswith('='):
+        raise MalformedReceiptException(receiptId,
+                _('Signature \"{}\" uses padding.').format(signature))
+    try:
+        return utils.urlsafe_b64decode(utils.restoreb64padding(
+            signature).encode("utf-8"))
+    except (TypeError, binascii.Error):
+        raise MalformedReceiptException(receiptId,
+                _('Signature \"{}\" not Base 64 URL encoded.').format(signature))
+
+def _checkChainingValue(receiptId, previousChain, alg):
+    # We assume this to work, because the receipt has already been checked.
+    cv = utils.b64decode(previousChain.encode('utf-8'))
+    if len(cv) != alg.chainBytes():
+        raise MalformedReceiptException(receiptId,
                 _('Chaining value \"{}\" invalid.').format(previousChain))
 
-        if not isinstance(certSerial, string_types) \
-                or not certSerial:
-            raise MalformedReceiptException(receiptId,
-                    _('Certificate serial/Key ID \"{}\" invalid.').format(
-                        certSerial))
-        certSerialType = CertSerialType.getCertSerialType(certSerial)
-        if certSerialType == CertSerialType.INVALID:
-            raise CertSerialInvalidException(receiptId)
-        if certSerialType == CertSerialType.SERIAL:
-            if zda == 'AT0':
-                raise InvalidCertificateProviderException(receiptId)
-        else:
-            if zda != 'AT0':
-                raise InvalidCertificateProviderException(receiptId)
-
-        self.zda = zda
-        self.header = None
-        self.registerId = registerId
-        self.receiptId = receiptId
-        self.dateTime = dateTimeDT
-        self.dateTimeStr = dateTime
-        self.sumA = sumAF
-        self.sumAStr = sumA
-        self.sumB = sumBF
-        self.sumBStr = sumB
-        self.sumC = sumCF
-        self.sumCStr = sumC
-        self.sumD = sumDF
-        self.sumDStr = sumD
-        self.sumE = sumEF
-        self.sumEStr = sumE
-        self.encTurnoverCounter = encTurnoverCounter
-        self.certSerial = certSerial
-        self.previousChain = previousChain
-        self.signature = None
-        self.signed = False
-
-        # perform post check of turnover counter
-        if len(encTC) != 0 and (len(encTC) < 5 or len(encTC) > 16):
-            if not (self.isDummy() or self.isReversal()):
-                raise MalformedReceiptException(receiptId,
-                        _('Encrypted turnover counter \"{}\" invalid.').format(
-                            encTurnoverCounter))
-
-    @staticmethod
-    def fromJWSString(jwsString):
-        """
-        Creates a receipt object from a JWS string.
-        :param jwsString: The JWS string to parse.
-        :return: The new, signed receipt object.
-        :throws: MalformedReceiptException
-        :throws: UnknownAlgorithmException
-        :throws: AlgorithmMismatchException
-        """
-        if not isinstance(jwsString, string_types):
-            raise MalformedReceiptException(jwsString, _('Invalid JWS.'))
-
-        jwsSegs = jwsString.split('.')
-        if len(jwsSegs) != 3:
-            raise MalformedReceiptException(jwsString,
-                    _('JWS does not contain exactly three segments.'))
-        if jwsSegs[0].endswith('=') or jwsSegs[1].endswith('=') \
-                or jwsSegs[2].endswith('='):
-            raise MalformedReceiptException(jwsString,
-                    _('Base 64 padding was used in JWS.'))
-
-        header = None
-        try:
-            header = utils.urlsafe_b64decode(utils.restoreb64padding(
-                jwsSegs[0]).encode("utf-8")).decode("utf-8")
-        except (TypeError, binascii.Error, UnicodeDecodeError):
-            raise MalformedReceiptException(jwsString,
-                    _('Invalid JWS header.'))
+def _splitBasicCode(basicCode):
+    """
+    Splits a QR code string into its parts and checks the parts that are
+    not covered by _checkReceipt().
+    :param basicCode: The QR code string to parse.
+    :return: The JWS header, the elements of the receipt as passed to
+    _checkReceipt(), the signature as an urlsafe base64 encoded string
+    without padding, the ID of the algorithm class and the algorithm object.
+    :throws: MalformedReceiptException
+    :throws: UnknownAlgorithmException
+    """
+    if not isinstance(basicCode, string_types):
+        raise MalformedReceiptException(basicCode,
+                _('Invalid machine-readable code.'))
+
+    segments = basicCode.split('_')
+    if len(segments) != 14 or len(segments[0]) != 0:
+        raise MalformedReceiptException(basicCode,
+                _('Machine-readable code does not contain 13 elements.'))
+
+    algorithmPrefixAndZda = segments[1].split('-')
+    if len(algorithmPrefixAndZda) != 2:
+        raise MalformedReceiptException(basicCode,
+                _('Machine-readable code does not contain algorithm and ZDA IDs.'))
+    algorithmPrefix = algorithmPrefixAndZda[0]
+    zda = algorithmPrefixAndZda[1]
+
+    if algRegex.match(algorithmPrefix) is None:
+        raise MalformedReceiptException(basicCode,
+                _('Algorithm ID \"{}\" invalid.').format(algorithmPrefix))
+    if algorithmPrefix not in algorithms.ALGORITHMS:
+        raise UnknownAlgorithmException(basicCode)
+    alg = algorithms.ALGORITHMS[algorithmPrefix]
+    header = alg.jwsHeader()
+
+    registerId = segments[2]
+    receiptId = segments[3]
+    dateTime = segments[4]
+    sumA = segments[5]
+    sumB = segments[6]
+    sumC = segments[7]
+    sumD = segments[8]
+    sumE = segments[9]
+    turnoverCounter = segments[10]
+    certSerial = segments[11]
+    previousChain = segments[12]
+
+    signature = None
+    try:
+        signature = utils.b64decode(segments[13].encode("utf-8"))
+    except (TypeError, binascii.Error):
+        raise MalformedReceiptException(basicCode,
+                _('Signature \"{}\" not Base 64 encoded.').format(segments[13]))
+    signature = base64.urlsafe_b64encode(signature).replace(b'=', b'')
+    signature = signature.decode("utf-8")
+
+    # __init__ does not perform the latter check
+    if not isinstance(turnoverCounter, string_types) \
+            or not turnoverCounter.replace('=', ''):
+        raise MalformedReceiptException(basicCode,
+                _('Encrypted turnover counter \"{}\" invalid.').format(
+                    turnoverCounter))
 
-        payload = None
-        try:
-            payload = utils.urlsafe_b64decode(utils.restoreb64padding(
-                jwsSegs[1]).encode("utf-8")).decode("utf-8")
-        except (TypeError, binascii.Error, UnicodeDecodeError):
-            raise MalformedReceiptException(jwsString,
-                    _('Invalid JWS payload.'))
-
-        signature = jwsSegs[2]
-
-        segments = payload.split('_')
-        if len(segments) != 13 or len(segments[0]) != 0:
-            raise MalformedReceiptException(jwsString,
-                    _('JWS payload does not contain 12 elements.'))
-
-        algorithmPrefixAndZda = segments[1].split('-')
-        if len(algorithmPrefixAndZda) != 2:
-            raise MalformedReceiptException(jwsString,
-                    _('Payload does not contain algorithm and ZDA IDs.'))
-        algorithmPrefix = algorithmPrefixAndZda[0]
-        zda = algorithmPrefixAndZda[1]
-
-        if algRegex.match(algorithmPrefix) is None:
-            raise MalformedReceiptException(jwsString,
-                    _('Algorithm ID \"{}\" invalid.').format(algorithmPrefix))
-        if algorithmPrefix not in algorithms.ALGORITHMS:
-            raise UnknownAlgorithmException(jwsString)
-        alg = algorithms.ALGORITHMS[algorithmPrefix]
-        if alg.jwsHeader() != header:
-            raise AlgorithmMismatchException(jwsString)
+    return header, [ zda, registerId, receiptId, dateTime, sumA, sumB, sumC,
+            sumD, sumE, turnoverCounter, certSerial, previousChain ], \
+                    signature, algorithmPrefix, alg
 
-        registerId = segments[2]
-        receiptId = segments[3]
-        dateTime = segments[4]
-        sumA = segments[5]
-        sumB = segments[6]
-        sumC = segments[7]
-        sumD = segments[8]
-        sumE = segments[9]
-        turnoverCounter = segments[10]
-        certSerial = segments[11]
-        previousChain = segments[12]
-
-        # __init__ does not perform the latter check
-        if not isinstance(turnoverCounter, string_types) \
-                or not turnoverCounter.replace('=', ''):
-            raise MalformedReceiptException(jwsString,
-                    _('Encrypted turnover counter \"{}\" invalid.').format(
-                        turnoverCounter))
+def _splitJWSString(jwsString):
+    """
+    Splits a JWS string into its parts and checks the parts that are not
+    covered by _checkReceipt().
+    :param jwsString: The JWS string to parse.
+    :return: The JWS header, the encoded JWS segments, the elements of the
+    payload, the ID of the algorithm class and the algorithm object.
+    :throws: MalformedReceiptException
+    :throws: UnknownAlgorithmException
+    :throws: AlgorithmMismatchException
+    """
+    if not isinstance(jwsString, string_types):
+        raise MalformedReceiptException(jwsString, _('Invalid JWS.'))
+
+    jwsSegs = jwsString.split('.')
+    if len(jwsSegs) != 3:
+        raise MalformedReceiptException(jwsString,
+                _('JWS does not contain exactly three segments.'))
+    if jwsSegs[0].endswith('=') or jwsSegs[1].endswith('=') \
+            or jwsSegs[2].endswith('='):
+        raise MalformedReceiptException(jwsString,
+                _('Base 64 padding was used in JWS.'))
+
+    header = None
+    try:
+        header = utils.urlsafe_b64decode(utils.restoreb64padding(
+            jwsSegs[0]).encode("utf-8")).decode("utf-8")
+    except (TypeError, binascii.Error, UnicodeDecodeError):
+        raise MalformedReceiptException(jwsString,
+                _('Invalid JWS header.'))
 
-        receipt = Receipt(zda, registerId, receiptId, dateTime,
-                sumA, sumB, sumC, sumD, sumE, turnoverCounter,
-                certSerial, previousChain)
-        receipt.sign(header, signature)
+    payload = None
+    try:
+        payload = utils.urlsafe_b64decode(utils.restoreb64padding(
+            jwsSegs[1]).encode("utf-8")).decode("utf-8")
+    except (TypeError, binascii.Error, UnicodeDecodeError):
+        raise MalformedReceiptException(jwsString,
+                _('Invalid JWS payload.'))
+
+    segments = payload.split('_')
+    if len(segments) != 13 or len(segments[0]) != 0:
+        raise MalformedReceiptException(jwsString,
+                _('JWS payload does not contain 12 elements.'))
+
+    algorithmPrefixAndZda = segments[1].split('-')
+    if len(algorithmPrefixAndZda) != 2:
+        raise MalformedReceiptException(jwsString,
+                _('Payload does not contain algorithm and ZDA IDs.'))
+    algorithmPrefix = algorithmPrefixAndZda[0]
+
+    if algRegex.match(algorithmPrefix) is None:
+        raise MalformedReceiptException(jwsString,
+                _('Algorithm ID \"{}\" invalid.').format(algorithmPrefix))
+    if algorithmPrefix not in algorithms.ALGORITHMS:
+        raise UnknownAlgorithmException(jwsString)
+    alg = algorithms.ALGORITHMS[algorithmPrefix]
+    if alg.jwsHeader() != header:
+        raise AlgorithmMismatchException(jwsString)
+
+    # __init__ does not perform the latter check
+    turnoverCounter = segments[10]
+    if not isinstance(turnoverCounter, string_types) \
+            or not turnoverCounter.replace('=', ''):
+        raise MalformedReceiptException(jwsString,
+                _('Encrypted turnover counter \"{}\" invalid.').format(
+                    turnoverCounter))
 
-        # We assume this to work, because we got through __init__
-        cv = utils.b64decode(previousChain.encode('utf-8'))
-        if len(cv) != alg.chainBytes():
-            raise MalformedReceiptException(receipt.receiptId,
-                    _('Chaining value \"{}\" invalid.').format(previousChain))
+    return header, jwsSegs, segments, algorithmPrefix, alg
 
-        return receipt, algorithmPrefix
+class ReceiptBase(object):
+    """
+    The base class for receipts. It contains the methods that only depend
+    on the receipt's attributes. Do not use this directly, use Receipt or
+    CompactReceipt.
+    """
+    __slots__ = ()
 
     def toJWSString(self, algorithmPrefix):
         """
@@ -440,80 +483,6 @@ class Receipt(object):
 
         return b'_'.join(segments).decode("utf-8")
 
-    @staticmethod
-    def fromBasicCode(basicCode):
-        """
-        Creates a receipt object from a QR code string.
-        :param basicCode: The QR code string to parse.
-        :return: The new, signed receipt object.
-        :throws: MalformedReceiptException
-        :throws: UnknownAlgorithmException
-        """
-        if not isinstance(basicCode, string_types):
-            raise MalformedReceiptException(basicCode,
-                    _('Invalid machine-readable code.'))
-
-        segments = basicCode.split('_')
-        if len(segments) != 14 or len(segments[0]) != 0:
-            raise MalformedReceiptException(basicCode,
-                    _('Machine-readable code does not contain 13 elements.'))
-
-        algorithmPrefixAndZda = segments[1].split('-')
-        if len(algorithmPrefixAndZda) != 2:
-            raise MalformedReceiptException(basicCode,
-                    _('Machine-readable code does not contain algorithm and ZDA IDs.'))
-        algorithmPrefix = algorithmPrefixAndZda[0]
-        zda = algorithmPrefixAndZda[1]
-
-        if algRegex.match(algorithmPrefix) is None:
-            raise MalformedReceiptException(basicCode,
-                    _('Algorithm ID \"{}\" invalid.').format(algorithmPrefix))
-        if algorithmPrefix not in algorithms.ALGORITHMS:
-            raise UnknownAlgorithmException(basicCode)
-        alg = algorithms.ALGORITHMS[algorithmPrefix]
-        header = alg.jwsHeader()
-
-        registerId = segments[2]
-        receiptId = segments[3]
-        dateTime = segments[4]
-        sumA = segments[5]
-        sumB = segments[6]
-        sumC = segments[7]
-        sumD = segments[8]
-        sumE = segments[9]
-        turnoverCounter = segments[10]
-        certSerial = segments[11]
-        previousChain = segments[12]
-
-        signature = None
-        try:
-            signature = utils.b64decode(segments[13].encode("utf-8"))
-        except (TypeError, binascii.Error):
-            raise MalformedReceiptException(basicCode,
-                    _('Signature \"{}\" not Base 64 encoded.').format(segments[13]))
-        signature = base64.urlsafe_b64encode(signature).replace(b'=', b'')
-        signature = signature.decode("utf-8")
-
-        # __init__ does not perform the latter check
-        if not isinstance(turnoverCounter, string_types) \
-                or not turnoverCounter.replace('=', ''):
-            raise MalformedReceiptException(basicCode,
-                    _('Encrypted turnover counter \"{}\" invalid.').format(
-                        turnoverCounter))
-
-        receipt = Receipt(zda, registerId, receiptId, dateTime,
-                sumA, sumB, sumC, sumD, sumE, turnoverCounter,
-                certSerial, previousChain)
-        receipt.sign(header, signature)
-
-        # We assume this to work, because we got through __init__
-        cv = utils.b64decode(previousChain.encode('utf-8'))
-        if len(cv) != alg.chainBytes():
-            raise MalformedReceiptException(receipt.receiptId,
-                    _('Chaining value \"{}\" invalid.').format(previousChain))
-
-        return receipt, algorithmPrefix
-
     def toBasicCode(self, algorithmPrefix):
         """
         Converts the receipt to a QR code string.
@@ -532,59 +501,6 @@ class Receipt(object):
 
         return payload + '_' + signature
 
-    @staticmethod
-    def fromOCRCode(ocrCode):
-        """
-        Creates a receipt object from a OCR code string.
-        :param ocrCode: The OCR code string to parse.
-        :return: The new, signed receipt object.
-        :throws: MalformedReceiptException
-        :throws: UnknownAlgorithmException
-        """
-        if not isinstance(ocrCode, string_types):
-            raise MalformedReceiptException(ocrCode,
-                    _('Invalid OCR code.'))
-
-        segments = ocrCode.split('_')
-        if len(segments) != 14 or len(segments[0]) != 0:
-            raise MalformedReceiptException(ocrCode,
-                    _('OCR code does not contain 13 elements.'))
-
-        encTurnoverCounter = None
-        try:
-            encTurnoverCounter = utils.b32decode(segments[10])
-        except (TypeError, binascii.Error):
-            raise MalformedReceiptException(ocrCode,
-                    _('Encrypted turnover counter \"{}\" not Base 32 encoded.'
-                        ).format(segments[10]))
-
-        previousChain = None
-        try:
-            previousChain = utils.b32decode(segments[12])
-        except (TypeError, binascii.Error):
-            raise MalformedReceiptException(ocrCode,
-                    _('Chaining value \"{}\" not Base 32 encoded.'
-                        ).format(segments[12]))
-
-        signature = None
-        try:
-            signature = utils.b32decode(segments[13])
-        except (TypeError, binascii.Error):
-            raise MalformedReceiptException(ocrCode,
-                    _('Signature \"{}\" not Base 32 encoded.'
-                        ).format(segments[13]))
-
-        encTurnoverCounter = base64.b64encode(encTurnoverCounter)
-        segments[10] = encTurnoverCounter.decode('utf-8')
-
-        previousChain = base64.b64encode(previousChain)
-        segments[12] = previousChain.decode('utf-8')
-
-        signature = base64.b64encode(signature)
-        segments[13] = signature.decode('utf-8')
-
-        return Receipt.fromBasicCode('_'.join(segments))
-
     def toOCRCode(self, algorithmPrefix):
         """
         Converts the receipt to an OCR code string.
@@ -637,22 +553,6 @@ class Receipt(object):
         return base64.urlsafe_b64encode((algorithm.hash(payload)[0:8]
             )).decode("utf-8").replace('=', '')
 
-    @staticmethod
-    def fromCSV(csv):
-        """
-        Creates a receipt object from a CSV string.
-        :param csv: The CSV string to parse.
-        :return: The new, signed receipt object.
-        :throws: MalformedReceiptException
-        :throws: UnknownAlgorithmException
-        """
-        if not isinstance(csv, string_types):
-            raise MalformedReceiptException(csv,
-                    _('Invalid CSV.'))
-
-        segs = [ s.strip() for s in csv.split(';') ]
-        return Receipt.fromBasicCode('_' + ('_'.join(segs)))
-
     def toCSV(self, algorithmPrefix):
         """
         Converts the receipt to a CSV string.
@@ -661,34 +561,6 @@ class Receipt(object):
         """
         return self.toBasicCode(algorithmPrefix)[1:].replace('_', ';')
 
-    def sign(self, header, signature):
-        """
-        Signs the receipt with the given signature and JWS header.
-        :param header: The JWS header as a string.
-        :param signature: The signature as an urlsafe base64 encoded string
-        without padding.
-        """
-        if not isinstance(header, string_types):
-            raise MalformedReceiptException(self.receiptId,
-                    _('JWS header \"{}\" invalid.').format(header))
-
-        if not isinstance(signature, string_types):
-            raise MalformedReceiptException(self.receiptId,
-                    _('Signature \"{}\" invalid.').format(signature))
-        if signature.endswith('='):
-            raise MalformedReceiptException(self.receiptId,
-                    _('Signature \"{}\" uses padding.').format(signature))
-        try:
-            utils.urlsafe_b64decode(utils.restoreb64padding(
-                signature).encode("utf-8"))
-        except (TypeError, binascii.Error):
-            raise MalformedReceiptException(self.receiptId,
-                    _('Signature \"{}\" not Base 64 URL encoded.').format(signature))
-
-        self.header = header
-        self.signature = signature
-        self.signed = True
-
     def isSignedBroken(self):
         """
         Determines if the signature system was inoperative when the receipt was
@@ -718,12 +590,36 @@ class Receipt(object):
         decCtr = utils.b64decode(self.encTurnoverCounter.encode("utf-8"))
         return decCtr == b'STO'
 
+    @property
+    def dateTime(self):
+        """
+        The timestamp of the receipt as a datetime object. Use the timestamp
+        attribute to compare receipts.
+        """
+        return utils.timestampToDateTime(self.timestamp)
+
+    # The sums as floats, for display purposes only. Use the sum[A-E]Cents
+    # attributes for calculations.
+    sumA = property(lambda self: self.sumACents / 100.0)
+    sumB = property(lambda self: self.sumBCents / 100.0)
+    sumC = property(lambda self: self.sumCCents / 100.0)
+    sumD = property(lambda self: self.sumDCents / 100.0)
+    sumE = property(lambda self: self.sumECents / 100.0)
+
+    def sumCents(self):
+        """
+        Adds up the five sums of the receipt.
+        :return: The turnover of the receipt in cents as int.
+        """
+        return self.sumACents + self.sumBCents + self.sumCCents \
+                + self.sumDCents + self.sumECents
+
     def isNull(self):
         """
         Determines if this receipt has zero turnover.
         :return: True if the receipt has zero turnover, False otherwise.
         """
-        return self.sumA == 0.0 and self.sumB == 0.0 and self.sumC == 0.0 and self.sumD == 0.0 and self.sumE == 0.0
+        return self.sumACents == 0 and self.sumBCents == 0 and self.sumCCents == 0 and self.sumDCents == 0 and self.sumECents == 0
 
     def decryptTurnoverCounter(self, key, algorithm):
         """
@@ -744,3 +640,377 @@ class Receipt(object):
 
         ct = utils.b64decode(self.encTurnoverCounter.encode("utf-8"))
         return algorithm.decryptTurnoverCounter(self, ct, key)
+
+class Receipt(ReceiptBase):
+    """
+    The basic receipt class. Contains methods to convert a receipt to and from
+    various string formats.
+    """
+
+    def __init__(self, zda, registerId, receiptId, dateTime,
+            sumA, sumB, sumC, sumD, sumE, encTurnoverCounter,
+            certSerial, previousChain):
+        """
+        Creates a new receipt object. The timestamp and sum[A-E]Cents
+        attributes are stored as ints (in seconds and cents respectively)
+        but their
+        string representations are retained for the various to*() methods
+        to ensure signatures remain valid after conversion.
+        :param zda: The ZDA ID as a string.
+        :param registerId: The ID of the register as a string.
+        :param receiptId: The ID of the receipt as a string.
+        :param dateTime: The receipt's timestamp as a string.
+        :param sumA: The first sum as a string.
+        :param sumB: The second sum as a string.
+        :param sumC: The third sum as a string.
+        :param sumD: The fourth sum as a string.
+        :param sumE: The fifth sum as a string.
+        :param encTurnoverCounter: The encrypted turnover counter as a base64
+        encoded string.
+        :param certSerial: The certificate's serial or a key ID as a string.
+        :param previousChain: The chaining value for the previous receipt as a
+        base64 encoded string.
+        """
+        timestamp, sums, encTC = _checkReceipt(zda, registerId, receiptId,
+                dateTime, sumA, sumB, sumC, sumD, sumE, encTurnoverCounter,
+                certSerial, previousChain)
+
+        self.zda = zda
+        self.header = None
+        self.registerId = registerId
+        self.receiptId = receiptId
+        self.timestamp = timestamp
+        self.dateTimeStr = dateTime
+        (self.sumACents, self.sumBCents, self.sumCCents, self.sumDCents,
+                self.sumECents) = sums
+        self.sumAStr = sumA
+        self.sumBStr = sumB
+        self.sumCStr = sumC
+        self.sumDStr = sumD
+        self.sumEStr = sumE
+        self.encTurnoverCounter = encTurnoverCounter
+        self.certSerial = certSerial
+        self.previousChain = previousChain
+        self.signature = None
+        self.signed = False
+        self.rawSignature = None
+        self.jwsSigningInput = None
+
+    @staticmethod
+    def fromJWSString(jwsString):
+        """
+        Creates a receipt object from a JWS string.
+        :param jwsString: The JWS string to parse.
+        :return: The new, signed receipt object.
+        :throws: MalformedReceiptException
+        :throws: UnknownAlgorithmException
+        :throws: AlgorithmMismatchException
+        """
+        header, jwsSegs, segments, algorithmPrefix, alg = _splitJWSString(
+                jwsString)
+
+        zda = segments[1].split('-')[1]
+        registerId = segments[2]
+        receiptId = segments[3]
+        dateTime = segments[4]
+        sumA = segments[5]
+        sumB = segments[6]
+        sumC = segments[7]
+        sumD = segments[8]
+        sumE = segments[9]
+        turnoverCounter = segments[10]
+        certSerial = segments[11]
+        previousChain = segments[12]
+
+        receipt = Receipt(zda, registerId, receiptId, dateTime,
+                sumA, sumB, sumC, sumD, sumE, turnoverCounter,
+                certSerial, previousChain)
+        receipt.sign(header, jwsSegs[2])
+        # Keep the signed data as is, so verifying the signature does not
+        # need to serialize the receipt again.
+        receipt.jwsSigningInput = (jwsSegs[0] + '.' + jwsSegs[1]).encode(
+                'utf-8')
+
+        _checkChainingValue(receipt.receiptId, previousChain, alg)
+
+        return receipt, algorithmPrefix
+
+    @staticmethod
+    def fromBasicCode(basicCode):
+        """
+        Creates a receipt object from a QR code string.
+        :param basicCode: The QR code string to parse.
+        :return: The new, signed receipt object.
+        :throws: MalformedReceiptException
+        :throws: UnknownAlgorithmException
+        """
+        header, segments, signature, algorithmPrefix, alg = _splitBasicCode(
+                basicCode)
+
+        receipt = Receipt(*segments)
+        receipt.sign(header, signature)
+
+        _checkChainingValue(receipt.receiptId, receipt.previousChain, alg)
+
+        return receipt, algorithmPrefix
+
+    @staticmethod
+    def fromOCRCode(ocrCode):
+        """
+        Creates a receipt object from a OCR code string.
+        :param ocrCode: The OCR code string to parse.
+        :return: The new, signed receipt object.
+        :throws: MalformedReceiptException
+        :throws: UnknownAlgorithmException
+        """
+        if not isinstance(ocrCode, string_types):
+            raise MalformedReceiptException(ocrCode,
+                    _('Invalid OCR code.'))
+
+        segments = ocrCode.split('_')
+        if len(segments) != 14 or len(segments[0]) != 0:
+            raise MalformedReceiptException(ocrCode,
+                    _('OCR code does not contain 13 elements.'))
+
+        encTurnoverCounter = None
+        try:
+            encTurnoverCounter = utils.b32decode(segments[10])
+        except (TypeError, binascii.Error):
+            raise MalformedReceiptException(ocrCode,
+                    _('Encrypted turnover counter \"{}\" not Base 32 encoded.'
+                        ).format(segments[10]))
+
+        previousChain = None
+        try:
+            previousChain = utils.b32decode(segments[12])
+        except (TypeError, binascii.Error):
+            raise MalformedReceiptException(ocrCode,
+                    _('Chaining value \"{}\" not Base 32 encoded.'
+                        ).format(segments[12]))
+
+        signature = None
+        try:
+            signature = utils.b32decode(segments[13])
+        except (TypeError, binascii.Error):
+            raise MalformedReceiptException(ocrCode,
+                    _('Signature \"{}\" not Base 32 encoded.'
+                        ).format(segments[13]))
+
+        encTurnoverCounter = base64.b64encode(encTurnoverCounter)
+        segments[10] = encTurnoverCounter.decode('utf-8')
+
+        previousChain = base64.b64encode(previousChain)
+        segments[12] = previousChain.decode('utf-8')
+
+        signature = base64.b64encode(signature)
+        segments[13] = signature.decode('utf-8')
+
+        return Receipt.fromBasicCode('_'.join(segments))
+
+    @staticmethod
+    def fromCSV(csv):
+        """
+        Creates a receipt object from a CSV string.
+        :param csv: The CSV string to parse.
+        :return: The new, signed receipt object.
+        :throws: MalformedReceiptException
+        :throws: UnknownAlgorithmException
+        """
+        if not isinstance(csv, string_types):
+            raise MalformedReceiptException(csv,
+                    _('Invalid CSV.'))
+
+        segs = [ s.strip() for s in csv.split(';') ]
+        return Receipt.fromBasicCode('_' + ('_'.join(segs)))
+
+    def sign(self, header, signature):
+        """
+        Signs the receipt with the given signature and JWS header.
+        :param header: The JWS header as a string.
+        :param signature: The signature as an urlsafe base64 encoded string
+        without padding.
+        """
+        rawSignature = _checkSignature(self.receiptId, header, signature)
+
+        self.header = header
+        self.signature = signature
+        self.signed = True
+        self.rawSignature = rawSignature
+        # Only set by fromJWSString(), where the original JWS is known.
+        self.jwsSigningInput = None
+
+def _segmentProperty(idx):
+    return property(lambda self: self._segments[idx])
+
+class CompactReceipt(ReceiptBase):
+    """
+    A memory efficient, read-only variant of Receipt that can be used in
+    place of the objects returned by Receipt.fromJWSString() and
+    Receipt.fromBasicCode(). It only keeps the elements of the receipt as
+    strings and converts the timestamp, the sums and the encrypted turnover
+    counter on first access.
+    """
+    __slots__ = ('_segments', '_algorithmPrefix', 'header', 'signature',
+            'jwsSigningInput', '_rawSignature', '_encTC', '_timestamp',
+            '_sums', '_validated')
+
+    signed = True
+
+    zda = _segmentProperty(0)
+    registerId = _segmentProperty(1)
+    receiptId = _segmentProperty(2)
+    dateTimeStr = _segmentProperty(3)
+    sumAStr = _segmentProperty(4)
+    sumBStr = _segmentProperty(5)
+    sumCStr = _segmentProperty(6)
+    sumDStr = _segmentProperty(7)
+    sumEStr = _segmentProperty(8)
+    encTurnoverCounter = _segmentProperty(9)
+    certSerial = _segmentProperty(10)
+    previousChain = _segmentProperty(11)
+
+    def __init__(self, segments, algorithmPrefix, header, signature,
+            jwsSigningInput = None):
+        """
+        Creates a new compact receipt. Use fromJWSString() or
+        fromBasicCode() instead.
+        :param segments: A tuple with the ZDA ID, the register ID, the
+        receipt ID, the timestamp, the five sums, the encrypted turnover
+        counter, the certificate serial and the chaining value as strings
+        (in that order).
+        :param algorithmPrefix: The ID of the algorithm class used as a string.
+        :param header: The JWS header as a string.
+        :param signature: The signature as an urlsafe base64 encoded string
+        without padding.
+        :param jwsSigningInput: The JWS signing input as a byte list or None.
+        """
+        self._segments = segments
+        self._algorithmPrefix = algorithmPrefix
+        self.header = header
+        self.signature = signature
+        self.jwsSigningInput = jwsSigningInput
+        self._rawSignature = None
+        self._encTC = None
+        self._timestamp = None
+        self._sums = None
+        self._validated = False
+
+    @staticmethod
+    def fromJWSString(jwsString, validate = True):
+        """
+        Creates a compact receipt object from a JWS string.
+        :param jwsString: The JWS string to parse.
+        :param validate: If True, the receipt is checked just like
+        Receipt.fromJWSString() would. If False, only the structure of the
+        JWS is checked now and the elements are checked when they are
+        needed.
+        :return: The new, signed receipt object.
+        :throws: MalformedReceiptException
+        :throws: UnknownAlgorithmException
+        :throws: AlgorithmMismatchException
+        """
+        header, jwsSegs, segments, algorithmPrefix, alg = _splitJWSString(
+                jwsString)
+        segments[1] = segments[1].split('-')[1]
+
+        rec = CompactReceipt(tuple(segments[1:]), algorithmPrefix, header,
+                jwsSegs[2], (jwsSegs[0] + '.' + jwsSegs[1]).encode('utf-8'))
+        if validate:
+            rec.validate()
+        return rec, algorithmPrefix
+
+    @staticmethod
+    def fromBasicCode(basicCode, validate = True):
+        """
+        Creates a compact receipt object from a QR code string.
+        :param basicCode: The QR code string to parse.
+        :param validate: If True, the receipt is checked just like
+        Receipt.fromBasicCode() would. If False, only the structure of the
+        code is checked now and the elements are checked when they are
+        needed.
+        :return: The new, signed receipt object.
+        :throws: MalformedReceiptException
+        :throws: UnknownAlgorithmException
+        """
+        header, segments, signature, algorithmPrefix, alg = _splitBasicCode(
+                basicCode)
+
+        rec = CompactReceipt(tuple(segments), algorithmPrefix, header,
+                signature)
+        if validate:
+            rec.validate()
+        return rec, algorithmPrefix
+
+    def validate(self):
+        """
+        Performs all the checks Receipt.fromJWSString() performs on the
+        receipt. This is only done once per receipt.
+        :throws: MalformedReceiptException
+        :throws: CertSerialInvalidException
+        :throws: InvalidCertificateProviderException
+        """
+        if self._validated:
+            return
+
+        timestamp, sums, encTC = _checkReceipt(*self._segments)
+        rawSignature = _checkSignature(self.receiptId, self.header,
+                self.signature)
+        _checkChainingValue(self.receiptId, self.previousChain,
+                algorithms.ALGORITHMS[self._algorithmPrefix])
+
+        self._timestamp = timestamp
+        self._sums = sums
+        self._encTC = encTC
+        self._rawSignature = rawSignature
+        self._validated = True
+
+    def _lazy(self, slot):
+        # If an element has not been converted yet, we check the entire
+        # receipt. This way we raise the same exception as Receipt would.
+        self.validate()
+        return getattr(self, slot)
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None:
+            return self._lazy('_timestamp')
+        return self._timestamp
+
+    @property
+    def sums(self):
+        if self._sums is None:
+            return self._lazy('_sums')
+        return self._sums
+
+    sumACents = property(lambda self: self.sums[0])
+    sumBCents = property(lambda self: self.sums[1])
+    sumCCents = property(lambda self: self.sums[2])
+    sumDCents = property(lambda self: self.sums[3])
+    sumECents = property(lambda self: self.sums[4])
+
+    @property
+    def rawSignature(self):
+        if self._rawSignature is None:
+            return self._lazy('_rawSignature')
+        return self._rawSignature
+
+    def _encTurnoverCounterBytes(self):
+        if self._encTC is None:
+            try:
+                self._encTC = utils.b64decode(
+                        self.encTurnoverCounter.encode('utf-8'))
+            except (TypeError, binascii.Error):
+                return self._lazy('_encTC')
+        return self._encTC
+
+    def toJWSString(self, algorithmPrefix):
+        if self.jwsSigningInput is not None \
+                and algorithmPrefix == self._algorithmPrefix:
+            return self.jwsSigningInput.decode('utf-8') + '.' + self.signature
+        return super(CompactReceipt, self).toJWSString(algorithmPrefix)
+
+    def isDummy(self):
+        return self._encTurnoverCounterBytes() == b'TRA'
+
+    def isReversal(self):
+        return self._encTurnoverCounterBytes() == b'STO'
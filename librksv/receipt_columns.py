@@ -0,0 +1,373 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module decodes groups of receipts into a columnar representation so
+that checks can be performed on entire groups at once. NumPy is used for
+the columns if it is installed, otherwise they are plain lists.
+"""
+from builtins import int
+from builtins import range
+
+import base64
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import algorithms
+from . import depparser
+from . import receipt
+from . import utils
+
+INT64_MAX = 2 ** 63 - 1
+
+def _intColumn(values):
+    """
+    Turns a list of ints into a column. If the values do not fit into 64 bit
+    the column holds Python ints.
+    """
+    if numpy is None:
+        return values
+    if values and (max(values) > INT64_MAX or min(values) < -INT64_MAX):
+        return numpy.array(values, dtype=object)
+    return numpy.array(values, dtype=numpy.int64)
+
+def _boolColumn(values):
+    if numpy is None:
+        return values
+    return numpy.array(values, dtype=bool)
+
+def _objColumn(values):
+    if numpy is None:
+        return values
+    col = numpy.empty(len(values), dtype=object)
+    col[:] = values
+    return col
+
+def _internColumn(values):
+    """
+    Replaces the given strings by indices into a list of distinct strings.
+    :return: The list of distinct strings and the column of indices.
+    """
+    interned = dict()
+    indices = [ interned.setdefault(v, len(interned)) for v in values ]
+    strings = [ None ] * len(interned)
+    for v, i in interned.items():
+        strings[i] = v
+
+    if numpy is None:
+        return strings, indices
+    return strings, numpy.array(indices, dtype=numpy.int32)
+
+def _decodeChainingValue(previousChain):
+    """
+    Decodes a chaining value so that it can be compared as bytes. Values
+    that are not encoded like verify.verifyChain() would encode them are
+    replaced by None so that they do not match any chaining value.
+    """
+    encoded = previousChain.encode('utf-8')
+    value = utils.b64decode(encoded)
+    if base64.b64encode(value) != encoded:
+        return None
+    return value
+
+class ReceiptColumns(object):
+    """
+    A group of receipts in columnar form. The receipts are decoded up to the
+    first one that can not be parsed. The exception for this receipt is kept
+    in the error attribute so that it can be raised once the preceding
+    receipts have been verified.
+    """
+
+    def __init__(self, jwss, receipts, prefixes, error):
+        """
+        Creates the columns for the given receipts. Use fromDEPGroup()
+        instead.
+        :param jwss: The receipts as a list of JWS strings.
+        :param receipts: The receipts as a list of CompactReceipt objects.
+        :param prefixes: The IDs of the algorithm classes of the receipts
+        as a list of strings.
+        :param error: The exception raised while decoding the receipt
+        following the given receipts or None.
+        """
+        self.jwss = jwss
+        self.receipts = receipts
+        self.prefixes = prefixes
+        self.error = error
+        self.size = len(receipts)
+
+        self.registerIds, self.registerIdIdx = _internColumn(
+                [ r.registerId for r in receipts ])
+        self.zdas, self.zdaIdx = _internColumn([ r.zda for r in receipts ])
+        self.receiptIds = _objColumn([ r.receiptId for r in receipts ])
+        self.timestamps = _intColumn([ r.timestamp for r in receipts ])
+        self.sums = [ _intColumn([ r.sums[i] for r in receipts ])
+                for i in range(5) ]
+        encTCs = [ utils.b64decode(r.encTurnoverCounter.encode('utf-8'))
+                for r in receipts ]
+        self.encTurnoverCounters = _objColumn(encTCs)
+        self.chainingValues = _objColumn([ _decodeChainingValue(
+            r.previousChain) for r in receipts ])
+        # The signature follows the signing input and the separating dot.
+        self.signatureOffsets = _intColumn([ len(r.jwsSigningInput) + 1
+            for r in receipts ])
+
+        self.dummy = _boolColumn([ c == b'TRA' for c in encTCs ])
+        self.reversal = _boolColumn([ c == b'STO' for c in encTCs ])
+        self.null = _boolColumn([ r.isNull() for r in receipts ])
+        self.signedBroken = _boolColumn([ r.isSignedBroken()
+            for r in receipts ])
+
+    @staticmethod
+    def fromDEPGroup(group):
+        """
+        Decodes a group of receipts.
+        :param group: The receipts in the group as a list of compressed JWS
+        strings as returned by a parser conforming to depparser.DEPParserI.
+        :return: The new ReceiptColumns object.
+        """
+        jwss = list()
+        receipts = list()
+        prefixes = list()
+        error = None
+        for cr in group:
+            try:
+                r = depparser.expandDEPReceipt(cr)
+                ro, prefix = receipt.CompactReceipt.fromJWSString(r)
+            except Exception as e:
+                # Whatever happened here would also have happened when the
+                # receipt is verified on its own, so we just keep the
+                # exception for later.
+                error = e
+                break
+            jwss.append(r)
+            receipts.append(ro)
+            prefixes.append(prefix)
+
+        return ReceiptColumns(jwss, receipts, prefixes, error)
+
+    def firstRestoreReceiptViolation(self, prevRec, needRestoreReceipt):
+        """
+        Determines the first receipt that would require a preceding restore
+        receipt (a signed receipt with zero turnover) after the signature
+        system failed but is not preceded by one. This mirrors the checks
+        done by verify.verifyGroup() for each receipt.
+        :param prevRec: The receipt preceding the group as a receipt object
+        or None if there is none.
+        :param needRestoreReceipt: Whether a restore receipt is required
+        before the first receipt in the group.
+        :return: The index of the first offending receipt or None and
+        whether a restore receipt is required after the last receipt in the
+        group. The latter is only meaningful if no receipt is offending.
+        """
+        n = self.size
+        if n == 0:
+            return None, needRestoreReceipt
+        prevSignedBroken = prevRec is not None and prevRec.isSignedBroken()
+
+        if numpy is None:
+            need = needRestoreReceipt
+            for i in range(n):
+                hasPrev = i > 0 or prevRec is not None
+                nonNull = not self.null[i] or self.dummy[i] \
+                        or self.reversal[i]
+                if hasPrev and need and (self.signedBroken[i] or nonNull):
+                    return i, need
+                if not self.signedBroken[i]:
+                    if hasPrev and nonNull:
+                        if prevSignedBroken:
+                            need = True
+                    else:
+                        need = False
+                prevSignedBroken = self.signedBroken[i]
+            return None, need
+
+        sb = self.signedBroken
+        nonNull = ~self.null | self.dummy | self.reversal
+        hasPrev = numpy.ones(n, dtype=bool)
+        hasPrev[0] = prevRec is not None
+        prevSB = numpy.empty(n, dtype=bool)
+        prevSB[0] = prevSignedBroken
+        prevSB[1:] = sb[:-1]
+
+        setNeed = ~sb & hasPrev & nonNull & prevSB
+        resetNeed = ~sb & ~(hasPrev & nonNull)
+        # Carry the last state change forward to each receipt.
+        lastChange = numpy.where(setNeed | resetNeed, numpy.arange(n), -1)
+        numpy.maximum.accumulate(lastChange, out=lastChange)
+        needAfter = numpy.where(lastChange >= 0,
+                setNeed[numpy.maximum(lastChange, 0)], needRestoreReceipt)
+        needBefore = numpy.empty(n, dtype=bool)
+        needBefore[0] = needRestoreReceipt
+        needBefore[1:] = needAfter[:-1]
+
+        bad = needBefore & hasPrev & (sb | nonNull)
+        return _firstIndex(bad), bool(needAfter[-1])
+
+    def firstStructureViolations(self, prevRec):
+        """
+        Compares each receipt to its predecessor and determines the first
+        receipt where the register ID changes, where the system type (open
+        or closed) changes and where the date decreases.
+        :param prevRec: The receipt preceding the group as a receipt object
+        or None if there is none. The first receipt is not checked if this is
+        None.
+        :return: The indices of the first offending receipt for each of the
+        three checks (in that order). An index is None if no receipt fails
+        the check.
+        """
+        n = self.size
+        if n == 0:
+            return None, None, None
+
+        closed = [ z == 'AT0' for z in self.zdas ]
+        if numpy is None:
+            regIds = [ self.registerIds[i] for i in self.registerIdIdx ]
+            types = [ closed[i] for i in self.zdaIdx ]
+            timestamps = self.timestamps
+            if prevRec is not None:
+                regIds = [ prevRec.registerId ] + regIds
+                types = [ prevRec.zda == 'AT0' ] + types
+                timestamps = [ prevRec.timestamp ] + timestamps
+            offset = 0 if prevRec is not None else 1
+            regBad = [ regIds[i] != regIds[i + 1]
+                    for i in range(len(regIds) - 1) ]
+            typeBad = [ types[i] != types[i + 1]
+                    for i in range(len(types) - 1) ]
+            dateBad = [ timestamps[i] > timestamps[i + 1]
+                    for i in range(len(timestamps) - 1) ]
+            return tuple(_firstIndexInList(bad, offset)
+                    for bad in (regBad, typeBad, dateBad))
+
+        regIds = self.registerIdIdx
+        types = numpy.array(closed, dtype=bool)[self.zdaIdx]
+        timestamps = self.timestamps
+        if prevRec is not None:
+            prevRegId = -1
+            if prevRec.registerId in self.registerIds:
+                prevRegId = self.registerIds.index(prevRec.registerId)
+            regIds = numpy.concatenate(([prevRegId], regIds))
+            types = numpy.concatenate(([prevRec.zda == 'AT0'], types))
+            timestamps = numpy.concatenate(([prevRec.timestamp], timestamps))
+
+        offset = 0 if prevRec is not None else 1
+        return tuple(_firstIndex(bad, offset) for bad in (
+            regIds[:-1] != regIds[1:],
+            types[:-1] != types[1:],
+            timestamps[:-1] > timestamps[1:]))
+
+    def turnover(self):
+        """
+        Adds up the five sums of each receipt.
+        :return: The turnover of each receipt in cents as a column.
+        """
+        if numpy is None:
+            return [ sum(s) for s in zip(*self.sums) ]
+
+        if any(s.dtype == object for s in self.sums) or sum(
+                _maxAbs(s) for s in self.sums) > INT64_MAX:
+            return sum(s.astype(object) for s in self.sums)
+        return sum(self.sums)
+
+    def decryptTurnoverCounters(self, key):
+        """
+        Decrypts the turnover counters of all receipts that are neither dummy
+        receipts nor reversals.
+        :param key: The key to decrypt the counters as a byte list. It must
+        be valid for the algorithms used by the receipts.
+        :return: The turnover counters as a column. The entries for dummy
+        receipts and reversals are zero.
+        """
+        byPrefix = dict()
+        for i in range(self.size):
+            if not self.dummy[i] and not self.reversal[i]:
+                byPrefix.setdefault(self.prefixes[i], list()).append(i)
+
+        counters = [ 0 ] * self.size
+        for prefix, indices in byPrefix.items():
+            algorithm = algorithms.ALGORITHMS[prefix]
+            decrypted = algorithm.decryptTurnoverCounters(
+                    [ self.receipts[i] for i in indices ], key,
+                    [ self.encTurnoverCounters[i] for i in indices ])
+            for i, counter in zip(indices, decrypted):
+                counters[i] = counter
+        return _intColumn(counters)
+
+    def firstTurnoverCounterViolation(self, lastTurnoverCounter,
+            turnoverCounters):
+        """
+        Calculates the expected turnover counter for each receipt and
+        compares it to the actual one. Dummy receipts do not change the
+        turnover counter and the counter of reversals is not checked.
+        :param lastTurnoverCounter: The turnover counter before the first
+        receipt in the group as int.
+        :param turnoverCounters: The decrypted turnover counters as returned
+        by decryptTurnoverCounters().
+        :return: The index of the first receipt with an unexpected turnover
+        counter or None and the turnover counter after the last receipt in
+        the group. The latter is only meaningful if no receipt is offending.
+        """
+        n = self.size
+        if n == 0:
+            return None, lastTurnoverCounter
+
+        turnover = self.turnover()
+        if numpy is None:
+            counter = lastTurnoverCounter
+            for i in range(n):
+                if self.dummy[i]:
+                    continue
+                counter += turnover[i]
+                if not self.reversal[i] and turnoverCounters[i] != counter:
+                    return i, counter
+            return None, counter
+
+        if turnover.dtype != object and abs(lastTurnoverCounter) \
+                + _maxAbs(turnover) * n > INT64_MAX:
+            turnover = turnover.astype(object)
+        if turnover.dtype == object:
+            lastTurnoverCounter = int(lastTurnoverCounter)
+
+        expected = numpy.cumsum(numpy.where(self.dummy, 0, turnover)
+                ) + lastTurnoverCounter
+        checked = ~self.dummy & ~self.reversal
+        bad = checked & numpy.asarray(expected != turnoverCounters,
+                dtype=bool)
+        return _firstIndex(bad), int(expected[-1])
+
+def _maxAbs(column):
+    if len(column) == 0:
+        return 0
+    return max(abs(int(column.max())), abs(int(column.min())))
+
+def _firstIndex(mask, offset = 0):
+    """
+    Returns the index of the first True value in a boolean NumPy array plus
+    offset or None if there is none.
+    """
+    idx = numpy.flatnonzero(mask)
+    if len(idx) == 0:
+        return None
+    return int(idx[0]) + offset
+
+def _firstIndexInList(mask, offset = 0):
+    for i, bad in enumerate(mask):
+        if bad:
+            return i + offset
+    return None
@@ -0,0 +1,313 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module transports the receipts of a work package to a worker process
+through shared memory instead of pickling them. All receipts of a package
+are packed into one segment, preceded by an array with their offsets. The
+worker decodes the receipts directly from the segment.
+It also provides a cutoff shared by all workers that is used to cancel the
+packages following a failed one and a way for the workers to pass the used
+receipt IDs of a package back split into shards. Shared memory requires
+Python 3.8 or newer, check if shared_memory is None before using this
+module.
+"""
+from builtins import int
+from builtins import range
+
+import array
+import contextlib
+import os
+import pickle
+import struct
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+WRITE_BLOCK_SIZE = 1 << 20
+
+class SharedGroups(object):
+    """
+    A reference to the receipts of a list of groups stored in a shared memory
+    segment. Only the name of the segment, the number of receipts in each
+    group and the second element of each group tuple are pickled.
+    """
+
+    def __init__(self, name, counts, refs):
+        """
+        Creates a new reference. Use fromGroups() instead.
+        :param name: The name of the shared memory segment.
+        :param counts: The number of receipts in each group as a list of ints.
+        :param refs: The second element of each group tuple (usually
+        something identifying the verifier) as a list.
+        """
+        self.name = name
+        self.counts = counts
+        self.refs = refs
+
+    @staticmethod
+    def fromGroups(groups):
+        """
+        Packs the receipts of the given groups into a new shared memory
+        segment.
+        :param groups: The groups as a list of tuples with a list of
+        receipts (as byte arrays) as the first element.
+        :return: The new SharedGroups object and the SharedMemory object of
+        the segment. The caller has to free the segment with free() once the
+        worker is done with it.
+        """
+        recs = [ r for recs, ref in groups for r in recs ]
+        offsets = array.array('Q', [0] * (len(recs) + 1))
+        for i, r in enumerate(recs):
+            offsets[i + 1] = offsets[i] + len(r)
+        base = offsets.itemsize * len(offsets)
+
+        shm = shared_memory.SharedMemory(create=True,
+                size=max(1, base + offsets[-1]))
+        _untrack(shm)
+        # The receipts are copied into the segment in blocks of about
+        # WRITE_BLOCK_SIZE bytes, so the parent never holds a second copy of
+        # the entire package.
+        buf = shm.buf
+        buf[:base] = offsets.tobytes()
+        pos = base
+        block = list()
+        size = 0
+        for r in recs:
+            block.append(r)
+            size += len(r)
+            if size >= WRITE_BLOCK_SIZE:
+                buf[pos:pos + size] = b''.join(block)
+                pos += size
+                block = list()
+                size = 0
+        buf[pos:pos + size] = b''.join(block)
+
+        return SharedGroups(shm.name, [ len(recs) for recs, ref in groups ],
+                [ ref for recs, ref in groups ]), shm
+
+    @contextlib.contextmanager
+    def attach(self):
+        """
+        Attaches to the shared memory segment for the duration of a with
+        block. The receipts are not copied out of the segment, they are
+        memoryview slices of it that are released when the block is left.
+        Decode them with depparser.expandDEPReceipt() and do not keep them
+        around.
+        :return: The groups as a list of tuples of the receipts and the
+        corresponding element of refs.
+        """
+        n = sum(self.counts)
+        shm = shared_memory.SharedMemory(name=self.name)
+        _untrack(shm)
+        views = list()
+        try:
+            base = array.array('Q').itemsize * (n + 1)
+            buf = shm.buf
+            offsets = buf[:base].cast('Q')
+            views.append(offsets)
+            recs = [ buf[base + offsets[i]:base + offsets[i + 1]]
+                    for i in range(n) ]
+            views.extend(recs)
+
+            groups = list()
+            start = 0
+            for count, ref in zip(self.counts, self.refs):
+                groups.append((recs[start:start + count], ref))
+                start += count
+            yield groups
+        finally:
+            # The segment can only be closed once no view of it is left.
+            for view in views:
+                view.release()
+            shm.close()
+
+class SharedCutoff(object):
+    """
+    A reference to a sequence number stored in a shared memory segment.
+    Packages with a sequence number greater than the cutoff are cancelled.
+    Only the parent process lowers the cutoff, the workers merely read it.
+    """
+
+    FORMAT = 'q'
+    NONE = 2 ** 63 - 1
+
+    def __init__(self, name):
+        """
+        Creates a new reference. Use create() instead.
+        :param name: The name of the shared memory segment.
+        """
+        self.name = name
+
+    @staticmethod
+    def create():
+        """
+        Creates a new shared memory segment containing a cutoff that does not
+        cancel any package.
+        :return: The new SharedCutoff object and the SharedMemory object of
+        the segment. The caller has to free the segment with free().
+        """
+        shm = shared_memory.SharedMemory(create=True,
+                size=struct.calcsize(SharedCutoff.FORMAT))
+        _untrack(shm)
+        struct.pack_into(SharedCutoff.FORMAT, shm.buf, 0, SharedCutoff.NONE)
+        return SharedCutoff(shm.name), shm
+
+    @staticmethod
+    def lower(shm, seq):
+        """
+        Lowers the cutoff in the given segment to seq if it is greater.
+        :param shm: The SharedMemory object as returned by create().
+        :param seq: The new cutoff.
+        """
+        if seq < struct.unpack_from(SharedCutoff.FORMAT, shm.buf, 0)[0]:
+            struct.pack_into(SharedCutoff.FORMAT, shm.buf, 0, seq)
+
+    def isCancelled(self, seq):
+        """
+        Checks if the package with the given sequence number is cancelled.
+        The segment is only attached while reading. If it does not exist
+        anymore, the verification the package belongs to is over and the
+        package is cancelled as well.
+        :param seq: The sequence number of the package.
+        :return: True if the package is cancelled, False otherwise.
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return True
+        _untrack(shm)
+        try:
+            return seq > struct.unpack_from(SharedCutoff.FORMAT, shm.buf,
+                    0)[0]
+        finally:
+            shm.close()
+
+class SharedIdShards(object):
+    """
+    A reference to receipt IDs split into shards stored in shared memory.
+    Each shard is pickled into a segment of its own, so the shards can be
+    loaded by different processes at the same time without any of them
+    attaching to the same segment. Only the names of the segments are
+    pickled. The segments are closed right after they are written, which
+    only leaves them in place on POSIX systems. On Windows a segment is
+    removed together with its last handle, check SUPPORTED before using
+    this class.
+    """
+
+    SUPPORTED = shared_memory is not None and os.name == 'posix'
+
+    def __init__(self, names):
+        """
+        Creates a new reference. Use fromShards() instead.
+        :param names: The name of the shared memory segment of each shard or
+        None for an empty shard.
+        """
+        self.names = names
+
+    @staticmethod
+    def fromShards(shards):
+        """
+        Stores the given shards in new shared memory segments.
+        :param shards: The shards as a list of collections of receipt IDs.
+        :return: The new SharedIdShards object and the SharedMemory objects
+        of the segments. The creator only has to close the SharedMemory
+        objects, the segments are removed with free().
+        """
+        names = list()
+        segments = list()
+        try:
+            for ids in shards:
+                if not ids:
+                    names.append(None)
+                    continue
+                blob = pickle.dumps(ids, pickle.HIGHEST_PROTOCOL)
+                shm = shared_memory.SharedMemory(create=True, size=len(blob))
+                _untrack(shm)
+                segments.append(shm)
+                shm.buf[:len(blob)] = blob
+                names.append(shm.name)
+        except:
+            free(segments)
+            raise
+
+        return SharedIdShards(names), segments
+
+    def load(self, shard):
+        """
+        Loads a single shard.
+        :param shard: The index of the shard.
+        :return: The receipt IDs in the shard.
+        """
+        if self.names[shard] is None:
+            return list()
+
+        shm = shared_memory.SharedMemory(name=self.names[shard])
+        _untrack(shm)
+        try:
+            return pickle.loads(shm.buf)
+        finally:
+            shm.close()
+
+    def free(self):
+        """
+        Removes the shared memory segments. This can be done by any process
+        once the shards are not needed anymore.
+        """
+        segments = list()
+        for name in self.names:
+            if name is not None:
+                shm = shared_memory.SharedMemory(name=name)
+                _untrack(shm)
+                segments.append(shm)
+        free(segments)
+
+@contextlib.contextmanager
+def loadGroups(groups):
+    """
+    Attaches to the groups referenced by a SharedGroups object for the
+    duration of a with block, see SharedGroups.attach(). Other groups are
+    used as they are.
+    """
+    if isinstance(groups, SharedGroups):
+        with groups.attach() as attached:
+            yield attached
+    else:
+        yield groups
+
+def free(segments):
+    """
+    Closes and removes the given shared memory segments.
+    :param segments: The SharedMemory objects as returned by fromGroups(),
+    SharedCutoff.create() or SharedIdShards.fromShards().
+    """
+    for shm in segments:
+        shm.close()
+        if os.name == 'posix':
+            resource_tracker.register(shm._name, 'shared_memory')
+        shm.unlink()
+
+def _untrack(shm):
+    # On POSIX, every process that creates or attaches to a segment
+    # registers it with its resource tracker, which removes it again when
+    # the process exits. Worker processes might not share the tracker of
+    # the parent, so we keep segments untracked and free them ourselves.
+    if os.name == 'posix':
+        resource_tracker.unregister(shm._name, 'shared_memory')
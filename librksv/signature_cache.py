@@ -0,0 +1,202 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module contains a persistent cache of receipt signatures that have
+already been verified successfully. Entries are keyed by a hash of the
+signed data, the signature and the fingerprint of the public key, so a
+receipt is only skipped if it was verified with the very same key before.
+The cache file has to be protected just like the key store.
+"""
+from builtins import int
+from builtins import range
+
+from .gettext_helper import _
+
+import hashlib
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from . import utils
+
+class SignatureCacheException(utils.RKSVException):
+    def __init__(self, message):
+        super(SignatureCacheException, self).__init__(message)
+        self._initargs = (message,)
+
+class SignatureCacheUnavailableException(SignatureCacheException):
+    """
+    Indicates that the signature cache can not be used because the sqlite3
+    module is not available.
+    """
+
+    def __init__(self):
+        super(SignatureCacheUnavailableException, self).__init__(
+                _("The signature cache requires the sqlite3 module."))
+        self._initargs = ()
+
+def publicKeyFingerprint(pubKey):
+    """
+    Gets the SHA256 fingerprint of a public key.
+    :param pubKey: The public key as a cryptography key object.
+    :return: The fingerprint as a byte list.
+    """
+    return utils.sha256(utils.exportKeyToPEM(pubKey).encode('utf-8'))
+
+def signatureDigest(signingInput, signature, pubKeyFingerprint):
+    """
+    Gets the key identifying a signature in the cache.
+    :param signingInput: The signed data as a byte list.
+    :param signature: The signature as a byte list.
+    :param pubKeyFingerprint: The fingerprint of the public key as returned
+    by publicKeyFingerprint().
+    :return: The key as a byte list.
+    """
+    h = hashlib.sha256()
+    for data in (pubKeyFingerprint, signingInput, signature):
+        h.update(b'%d:' % len(data))
+        h.update(data)
+    return h.digest()
+
+class SignatureCacheI(object):
+    """
+    The base class for signature caches. It contains functions that every
+    signature cache must implement. Do not use this directly. The number of
+    lookups that found a signature is returned by hits(), the number of
+    lookups that did not by misses().
+    """
+
+    def __init__(self, counters = None):
+        """
+        Creates a new signature cache.
+        :param counters: A list of two ints to count the hits and misses in
+        or None to use a new one. To count the lookups of the caches in
+        multiple processes, pass the same multiprocessing.Array('q', 2) to
+        all of them.
+        """
+        if counters is None:
+            counters = [0, 0]
+        self.counters = counters
+
+    def hits(self):
+        return self.counters[0]
+
+    def misses(self):
+        return self.counters[1]
+
+    def _countLookup(self, found):
+        idx = 0 if found else 1
+        if hasattr(self.counters, 'get_lock'):
+            with self.counters.get_lock():
+                self.counters[idx] += 1
+        else:
+            self.counters[idx] += 1
+
+    def contains(self, digest):
+        """
+        Checks if a signature has already been verified and counts the lookup
+        as a hit or a miss.
+        :param digest: The key as returned by signatureDigest().
+        :return: True if the signature is in the cache, False otherwise.
+        """
+        raise NotImplementedError("Please implement this yourself.")
+
+    def add(self, digest):
+        """
+        Adds a successfully verified signature to the cache.
+        :param digest: The key as returned by signatureDigest().
+        """
+        raise NotImplementedError("Please implement this yourself.")
+
+    def commit(self):
+        """
+        Writes all added signatures to persistent storage.
+        """
+        raise NotImplementedError("Please implement this yourself.")
+
+    def close(self):
+        """
+        Commits and closes the cache.
+        """
+        raise NotImplementedError("Please implement this yourself.")
+
+class SQLiteSignatureCache(SignatureCacheI):
+    """
+    A signature cache stored in an SQLite database. Multiple processes can
+    use the same file at once. Added signatures are written in batches of
+    COMMIT_INTERVAL and whenever commit() is called.
+    """
+
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path, counters = None):
+        """
+        Opens the cache in the given file and creates it if necessary.
+        :param path: The file name of the database.
+        :param counters: The hit and miss counters as for SignatureCacheI.
+        :throws: SignatureCacheUnavailableException
+        """
+        super(SQLiteSignatureCache, self).__init__(counters)
+        if sqlite3 is None:
+            raise SignatureCacheUnavailableException()
+
+        self.path = path
+        # The cache may be used by the signature verification threads.
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn = sqlite3.connect(path, timeout=60,
+                check_same_thread=False)
+        with self.lock:
+            # Readers are not blocked by a writer in WAL mode.
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS signatures '
+                    '(digest BLOB PRIMARY KEY) WITHOUT ROWID')
+            self.conn.commit()
+
+    def contains(self, digest):
+        with self.lock:
+            found = self.conn.execute(
+                    'SELECT 1 FROM signatures WHERE digest = ?',
+                    (digest,)).fetchone() is not None
+        self._countLookup(found)
+        return found
+
+    def add(self, digest):
+        with self.lock:
+            self.conn.execute(
+                    'INSERT OR IGNORE INTO signatures (digest) VALUES (?)',
+                    (digest,))
+            self.pending += 1
+            if self.pending >= self.COMMIT_INTERVAL:
+                self._commit()
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        if self.pending > 0:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,85 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module contains helpers for the tests that sign receipts and verify
+them one by one with a ReceiptVerifier.
+"""
+
+from builtins import range
+
+import datetime
+import os
+import unittest
+
+from .. import cashreg
+from .. import sigsys
+from .. import utils
+from .. import verify_receipt
+
+from sys import version_info
+if version_info[0] < 3:
+    import __builtin__
+else:
+    import builtins as __builtin__
+
+def makeReceipts(zda, serial, priv, num):
+    """
+    Creates num receipts of a single cash register signed with priv.
+    :return: The receipts as a list of JWS strings.
+    """
+    sigsystem = sigsys.SignatureSystemWorking(zda, serial, priv)
+    register = cashreg.CashRegister('RECEIPTS-1', None, 0, os.urandom(32))
+    dateTime = datetime.datetime(2017, 1, 1)
+    recs = list()
+    for i in range(num):
+        dateTime += datetime.timedelta(seconds=1)
+        recs.append(register.receipt('R1', '%d' % i, dateTime, 1.0, 0.0, 0.0,
+            0.0, 0.0, sigsystem).toJWSString('R1'))
+    return recs
+
+def verifyAll(rv, recs):
+    """
+    Verifies each receipt with rv.
+    :return: None or the class of the exception raised for each receipt.
+    """
+    results = list()
+    for r in recs:
+        try:
+            rv.verifyJWS(r)
+            results.append(None)
+        except verify_receipt.receipt.ReceiptException as e:
+            results.append(e.__class__)
+    return results
+
+class SignedReceiptsTestCase(unittest.TestCase):
+    """
+    Creates a key pair (priv and pub) and a certificate for it (cert with
+    the serial number serial) once for all tests of a class.
+    """
+
+    CERT_NAME = 'receipts'
+
+    @classmethod
+    def setUpClass(cls):
+        if not hasattr(__builtin__, '_'):
+            __builtin__._ = lambda x: x
+
+        cls.priv, cls.pub = utils.makeES256Keypair()
+        cls.serial = utils.makeCertSerial()
+        cls.cert = utils.makeSignedCert(cls.pub, cls.CERT_NAME, 365,
+                cls.serial, cls.priv)
@@ -0,0 +1,69 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module checks that the batch turnover counter decryption of the
+algorithm classes matches the decryption of single receipts.
+"""
+
+from builtins import int
+from builtins import range
+
+import base64
+import os
+import random
+import unittest
+
+from .. import algorithms
+
+class _Receipt(object):
+    def __init__(self, registerId, receiptId):
+        self.registerId = registerId
+        self.receiptId = receiptId
+        self.encTurnoverCounter = None
+
+class DecryptTurnoverCountersTest(unittest.TestCase):
+    def testMatchesSingle(self):
+        rand = random.Random(0)
+        key = os.urandom(32)
+        for name, algorithm in algorithms.ALGORITHMS.items():
+            receipts = list()
+            encTCs = list()
+            for i in range(500):
+                r = _Receipt('REG%d' % rand.randint(0, 3), '%d' % i)
+                size = rand.choice([0, 1, 5, 8, 15, 16, 17, 32])
+                counter = rand.randint(-2 ** (8 * size - 1),
+                        2 ** (8 * size - 1) - 1) if size else 0
+                if size:
+                    ct = algorithm.encryptTurnoverCounter(r, counter, key,
+                            size)
+                else:
+                    ct = b''
+                r.encTurnoverCounter = base64.b64encode(ct).decode('utf-8')
+                receipts.append(r)
+                encTCs.append(ct)
+
+            expected = [ algorithm.decryptTurnoverCounter(r, ct, key)
+                    for r, ct in zip(receipts, encTCs) ]
+            self.assertEqual(algorithm.decryptTurnoverCounters(receipts, key,
+                encTCs), expected, name)
+            self.assertEqual(algorithm.decryptTurnoverCounters(receipts, key),
+                    expected, name)
+            self.assertEqual(algorithm.decryptTurnoverCounters([], key), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module checks that verify.verifyCert() only verifies a certificate
+chain once when given a cert_cache.CertificateChainCache.
+"""
+
+import json
+import unittest
+
+from .. import cert_cache
+from .. import key_store
+from .. import utils
+from .. import verify
+
+from sys import version_info
+if version_info[0] < 3:
+    import __builtin__
+else:
+    import builtins as __builtin__
+
+def _makeCert(name, spriv = None, scert = None):
+    priv, pub = utils.makeES256Keypair()
+    cert = utils.makeSignedCert(pub, name, 365, utils.makeCertSerial(),
+            spriv or priv, scert)
+    return priv, cert
+
+class CertificateChainCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not hasattr(__builtin__, '_'):
+            __builtin__._ = lambda x: x
+
+        rootPriv, cls.root = _makeCert('root')
+        interPriv, cls.inter = _makeCert('inter', rootPriv, cls.root)
+        signPriv, cls.cert = _makeCert('sign', interPriv, cls.inter)
+
+    def setUp(self):
+        self.keyStore = key_store.KeyStore()
+        self.keyStore.putKey(key_store.numSerialToKeyId(
+            self.root.serial_number), self.root.public_key(), self.root)
+
+        self.verifyCalls = 0
+        self.utilsVerifyCert = verify.utils.verifyCert
+        def countingVerifyCert(cert, signCert):
+            self.verifyCalls += 1
+            return self.utilsVerifyCert(cert, signCert)
+        verify.utils.verifyCert = countingVerifyCert
+
+    def tearDown(self):
+        verify.utils.verifyCert = self.utilsVerifyCert
+
+    def testVerifiedOnce(self):
+        cache = cert_cache.CertificateChainCache()
+        cache.useKeyStore(self.keyStore)
+        for i in range(3):
+            verify.verifyCert(self.cert, [ self.inter, self.root ],
+                    self.keyStore, cache)
+        self.assertEqual(self.verifyCalls, 2)
+
+        # Other chains are verified on their own.
+        verify.verifyCert(self.inter, [ self.root ], self.keyStore, cache)
+        self.assertEqual(self.verifyCalls, 3)
+
+    def testFailuresNotCached(self):
+        cache = cert_cache.CertificateChainCache()
+        cache.useKeyStore(self.keyStore)
+        for i in range(2):
+            with self.assertRaises(verify.CertificateChainBrokenException):
+                verify.verifyCert(self.cert, [ self.root ], self.keyStore,
+                        cache)
+        self.assertEqual(len(cache.chains), 0)
+
+    def testKeyStoreChange(self):
+        cache = cert_cache.CertificateChainCache()
+        cache.useKeyStore(self.keyStore)
+        verify.verifyCert(self.cert, [ self.inter, self.root ],
+                self.keyStore, cache)
+
+        self.keyStore.delKey(key_store.numSerialToKeyId(
+            self.root.serial_number))
+        cache.useKeyStore(self.keyStore)
+        with self.assertRaises(verify.UntrustedCertificateException):
+            verify.verifyCert(self.cert, [ self.inter, self.root ],
+                    self.keyStore, cache)
+
+    def testJson(self):
+        cache = cert_cache.CertificateChainCache()
+        cache.useKeyStore(self.keyStore)
+        verify.verifyCert(self.cert, [ self.inter, self.root ],
+                self.keyStore, cache)
+
+        cache = cert_cache.CertificateChainCache.readCacheFromJson(
+                json.loads(json.dumps(cache.writeCacheToJson())))
+        cache.useKeyStore(self.keyStore)
+        verify.verifyCert(self.cert, [ self.inter, self.root ],
+                self.keyStore, cache)
+        self.assertEqual(self.verifyCalls, 2)
+
+        for malformed in ([], { 'keyStore': 1 }, { 'chains': [ 1 ] }):
+            with self.assertRaises(
+                    cert_cache.MalformedCertificateChainCacheException):
+                cert_cache.CertificateChainCache.readCacheFromJson(malformed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module checks that the group checks in receipt_columns yield the same
+results with and without NumPy.
+"""
+
+from builtins import int
+from builtins import range
+
+import random
+import unittest
+
+from .. import receipt_columns
+
+class _PrevReceipt(object):
+    def __init__(self, registerId, zda, timestamp, signedBroken):
+        self.registerId = registerId
+        self.zda = zda
+        self.timestamp = timestamp
+        self.signedBroken = signedBroken
+
+    def isSignedBroken(self):
+        return self.signedBroken
+
+def _makeColumns(rand, n):
+    """
+    Creates random columns without going through actual receipts.
+    """
+    registerIds = [ rand.choice(['REG1', 'REG1', 'REG1', 'REG2'])
+            for i in range(n) ]
+    zdas = [ rand.choice(['AT0', 'AT0', 'AT0', 'AT1']) for i in range(n) ]
+    timestamps = [ rand.randint(0, 2 * n) + 4 * i for i in range(n) ]
+    flags = [ [ rand.random() < p for i in range(n) ]
+            for p in (0.2, 0.1, 0.5, 0.3) ]
+
+    cols = receipt_columns.ReceiptColumns.__new__(
+            receipt_columns.ReceiptColumns)
+    cols.size = n
+    cols.registerIds, cols.registerIdIdx = receipt_columns._internColumn(
+            registerIds)
+    cols.zdas, cols.zdaIdx = receipt_columns._internColumn(zdas)
+    cols.timestamps = receipt_columns._intColumn(timestamps)
+    cols.dummy, cols.reversal, cols.null, cols.signedBroken = [
+            receipt_columns._boolColumn(f) for f in flags ]
+    bound = rand.choice([1000, 10 ** 6, 2 ** 62, 2 ** 70])
+    cols.sums = [ receipt_columns._intColumn([ rand.randint(-bound, bound)
+        for i in range(n) ]) for j in range(5) ]
+    return cols
+
+def _referenceTurnoverCounters(rand, cols, last):
+    """
+    Creates turnover counters the way verify.verifyGroup() expects them
+    with an occasional wrong one.
+    """
+    counters = list()
+    for i in range(cols.size):
+        if not cols.dummy[i]:
+            last += sum(int(s[i]) for s in cols.sums)
+        if cols.dummy[i] or cols.reversal[i]:
+            counters.append(0)
+        elif rand.random() < 0.05:
+            counters.append(last + rand.choice([-1, 1]))
+        else:
+            counters.append(last)
+    return counters
+
+def _referenceTurnover(cols, last, counters):
+    """
+    The turnover counter checks as done by verify.verifyGroup() before the
+    checks were done for entire groups.
+    """
+    for i in range(cols.size):
+        if cols.dummy[i]:
+            continue
+        last += sum(int(s[i]) for s in cols.sums)
+        if not cols.reversal[i] and counters[i] != last:
+            return i, None
+    return None, last
+
+def _referenceRestore(cols, prev, need):
+    """
+    The restore receipt checks as done by verify.verifyGroup() before the
+    checks were done for entire groups.
+    """
+    prevBroken = prev.isSignedBroken() if prev else None
+    hasPrev = prev is not None
+    for i in range(cols.size):
+        if not cols.signedBroken[i]:
+            if hasPrev and (not cols.null[i] or cols.dummy[i]
+                    or cols.reversal[i]):
+                if need:
+                    return i, need
+                if prevBroken:
+                    need = True
+            else:
+                need = False
+        elif hasPrev and need:
+            return i, need
+        prevBroken = cols.signedBroken[i]
+        hasPrev = True
+    return None, need
+
+class ReceiptColumnsTest(unittest.TestCase):
+    def setUp(self):
+        self.numpy = receipt_columns.numpy
+
+    def tearDown(self):
+        receipt_columns.numpy = self.numpy
+
+    def _results(self, seed, useNumpy):
+        receipt_columns.numpy = self.numpy if useNumpy else None
+        rand = random.Random(seed)
+        results = list()
+        for i in range(200):
+            cols = _makeColumns(rand, rand.randint(0, 30))
+            prev = None
+            if rand.random() < 0.8:
+                prev = _PrevReceipt(rand.choice(['REG1', 'REG2']),
+                        rand.choice(['AT0', 'AT1']), rand.randint(0, 10),
+                        rand.random() < 0.3)
+            need = rand.random() < 0.3
+            restore = cols.firstRestoreReceiptViolation(prev, need)
+            if restore[0] is not None:
+                # The state after the group does not matter in this case.
+                restore = (restore[0], None)
+            reference = _referenceRestore(cols, prev, need)
+            if reference[0] is not None:
+                reference = (reference[0], None)
+            self.assertEqual(restore, reference)
+
+            last = rand.choice([0, rand.randint(-10 ** 6, 10 ** 6),
+                2 ** 63 - 1])
+            counters = _referenceTurnoverCounters(rand, cols, last)
+            turnover = cols.firstTurnoverCounterViolation(last,
+                    receipt_columns._intColumn(counters))
+            if turnover[0] is not None:
+                turnover = (turnover[0], None)
+            self.assertEqual(turnover, _referenceTurnover(cols, last,
+                counters))
+
+            results.append((restore, cols.firstStructureViolations(prev),
+                turnover))
+        return results
+
+    def testLists(self):
+        self._results(0, False)
+
+    @unittest.skipIf(receipt_columns.numpy is None, 'NumPy not installed')
+    def testNumpyMatchesLists(self):
+        for seed in range(5):
+            self.assertEqual(self._results(seed, True),
+                    self._results(seed, False))
+
+if __name__ == '__main__':
+    unittest.main()
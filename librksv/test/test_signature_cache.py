@@ -0,0 +1,105 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module checks that ReceiptVerifier skips the signatures found in a
+signature_cache.SQLiteSignatureCache and only adds valid ones to it.
+"""
+
+from builtins import range
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import key_store
+from .. import signature_cache
+from .. import utils
+from .. import verify_receipt
+
+from . import receipt_helpers
+
+class SignatureCacheTest(receipt_helpers.SignedReceiptsTestCase):
+    CERT_NAME = 'sigcache'
+
+    @classmethod
+    def setUpClass(cls):
+        super(SignatureCacheTest, cls).setUpClass()
+        cls.recs = receipt_helpers.makeReceipts('AT1', '%d' % cls.serial,
+                cls.priv, 5)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'signatures.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testHitsAndMisses(self):
+        cache = signature_cache.SQLiteSignatureCache(self.path)
+        rv = verify_receipt.ReceiptVerifier.fromCert(self.cert, cache)
+        self.assertEqual(receipt_helpers.verifyAll(rv, self.recs),
+                [ None ] * 5)
+        self.assertEqual((cache.hits(), cache.misses()), (0, 5))
+
+        self.assertEqual(receipt_helpers.verifyAll(rv, self.recs),
+                [ None ] * 5)
+        self.assertEqual((cache.hits(), cache.misses()), (5, 5))
+        cache.close()
+
+    def testPersistent(self):
+        cache = signature_cache.SQLiteSignatureCache(self.path)
+        rv = verify_receipt.ReceiptVerifier.fromCert(self.cert, cache)
+        receipt_helpers.verifyAll(rv, self.recs)
+        cache.close()
+
+        cache = signature_cache.SQLiteSignatureCache(self.path)
+        rv = verify_receipt.ReceiptVerifier.fromCert(self.cert, cache)
+        self.assertEqual(receipt_helpers.verifyAll(rv, self.recs),
+                [ None ] * 5)
+        self.assertEqual((cache.hits(), cache.misses()), (5, 0))
+        cache.close()
+
+    def testInvalidNotCached(self):
+        otherPriv, otherPub = utils.makeES256Keypair()
+        recs = receipt_helpers.makeReceipts('AT1', '%d' % self.serial,
+                otherPriv, 3)
+        cache = signature_cache.SQLiteSignatureCache(self.path)
+        rv = verify_receipt.ReceiptVerifier.fromCert(self.cert, cache)
+        expected = [ verify_receipt.InvalidSignatureException ] * 3
+        for i in range(2):
+            self.assertEqual(receipt_helpers.verifyAll(rv, recs), expected)
+        self.assertEqual(cache.hits(), 0)
+        cache.close()
+
+    def testOtherKey(self):
+        cache = signature_cache.SQLiteSignatureCache(self.path)
+        rv = verify_receipt.ReceiptVerifier.fromCert(self.cert, cache)
+        receipt_helpers.verifyAll(rv, self.recs)
+
+        # The same signatures are not valid for a different key.
+        otherPriv, otherPub = utils.makeES256Keypair()
+        keyStore = key_store.KeyStore()
+        keyStore.putKey('%d' % self.serial, otherPub, None)
+        rv = verify_receipt.ReceiptVerifier.fromKeyStore(keyStore, cache)
+        self.assertEqual(receipt_helpers.verifyAll(rv, self.recs),
+                [ verify_receipt.InvalidSignatureException ] * 5)
+        cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
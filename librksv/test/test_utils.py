@@ -0,0 +1,147 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module contains unit tests for the helper functions in utils.
+"""
+
+from __future__ import unicode_literals
+from builtins import int
+from builtins import range
+
+import datetime
+import random
+import unittest
+
+from .. import utils
+
+def _referenceCents(value):
+    """
+    Converts a sum to cents the way it was done before getReceiptCents()
+    existed.
+    """
+    try:
+        return int(round(utils.monetary_value_to_float(value) * 100))
+    except Exception:
+        return None
+
+class GetReceiptCentsTest(unittest.TestCase):
+    """
+    Checks that getReceiptCents() accepts and rejects the same values as
+    monetary_value_to_float() and yields the same amounts.
+    """
+
+    VALUES = [
+            '0', '-0', '0,00', '-0,00', '0.00', '0,0', '0.5', '-0,05',
+            '00', '00,00', '01', '01,00', '0,000', '0,', ',5', '-', '',
+            '1', '-1', '10', '100', '1000', '1,5', '1.5', '1,50', '-1,23',
+            '12,34', '123,45', '1234,56', '1234.56', '1,234', '1.234',
+            '1,234.5', '1.234,5', '1,234.56', '1.234,56', '-1.234,56',
+            '12.345.678', '12,345,678', '12.345.678,90', '12,345,678.90',
+            '1,234,5', '1.234.5', '1.2345', '1,2345', '1.23.456',
+            '1234.567', '1234,567', '1,234,567.8', '1.234,567', '1,234.567',
+            '1 234,56', '+1,00', '--1', '1e3', '1,00 ', ' 1,00', '1,00\n',
+            'abc', '12a', '0x10', '١٢,٣٤',
+            ]
+
+    def testValues(self):
+        for value in self.VALUES:
+            self.assertEqual(utils.getReceiptCents(value),
+                    _referenceCents(value), value)
+
+    def testRandomValues(self):
+        rand = random.Random(0)
+        alphabet = '0123456789,.-'
+        for i in range(20000):
+            value = ''.join(rand.choice(alphabet)
+                    for j in range(rand.randint(1, 12)))
+            self.assertEqual(utils.getReceiptCents(value),
+                    _referenceCents(value), value)
+
+    def testNonString(self):
+        for value in [None, 1, 1.5, b'1,00']:
+            self.assertIsNone(utils.getReceiptCents(value))
+
+    def testExactness(self):
+        # Large amounts can not be represented exactly as float cents.
+        self.assertEqual(utils.getReceiptCents('90071992547409,93'),
+                9007199254740993)
+        self.assertEqual(utils.getReceiptCents('-0,29'), -29)
+
+def _referenceTimestamp(value):
+    """
+    Converts a timestamp with strptime() like it was done before
+    getReceiptTimestamp() existed.
+    """
+    try:
+        dt = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+    return utils.dateTimeToTimestamp(dt)
+
+def _getReceiptTimestampOrNone(value):
+    try:
+        return utils.getReceiptTimestamp(value)
+    except ValueError:
+        return None
+
+class GetReceiptTimestampTest(unittest.TestCase):
+    """
+    Checks that getReceiptTimestamp() accepts and rejects the same values as
+    strptime() and that the results are ordered like the datetime objects.
+    """
+
+    VALUES = [
+            '2016-03-11T03:57:08', '0001-01-01T00:00:00',
+            '9999-12-31T23:59:59', '0000-01-01T00:00:00',
+            '2016-02-29T12:00:00', '2015-02-29T12:00:00',
+            '2000-02-29T12:00:00', '1900-02-29T12:00:00',
+            '2016-04-31T00:00:00', '2016-13-01T00:00:00',
+            '2016-00-01T00:00:00', '2016-01-00T00:00:00',
+            '2016-01-01T24:00:00', '2016-01-01T00:60:00',
+            '2016-01-01T00:00:60', '2016-01-01T00:00:61',
+            '2016-3-1T3:5:8', '2016-03-11t03:57:08', '2016-03-11 03:57:08',
+            '2016-03-11T03:57:08 ', ' 2016-03-11T03:57:08',
+            '2016-03-11T03:57:08\n', '2016-03-11T03:57', '2016-03-11',
+            '16-03-11T03:57:08', '+016-03-11T03:57:08', '2016-03-11T03:57:0a',
+            '\u0662\u0660\u0661\u0666-03-11T03:57:08', '',
+            ]
+
+    def testValues(self):
+        for value in self.VALUES:
+            self.assertEqual(_getReceiptTimestampOrNone(value),
+                    _referenceTimestamp(value), value)
+
+    def testRandomValues(self):
+        rand = random.Random(0)
+        start = datetime.datetime(1, 1, 1)
+        for i in range(20000):
+            dt = start + datetime.timedelta(
+                    seconds=rand.randint(0, 3652058 * 86400 - 1))
+            value = '%04d-%02d-%02dT%02d:%02d:%02d' % (dt.year, dt.month,
+                    dt.day, dt.hour, dt.minute, dt.second)
+            ts = utils.getReceiptTimestamp(value)
+            self.assertEqual(ts, _referenceTimestamp(value), value)
+            self.assertEqual(utils.timestampToDateTime(ts), dt)
+
+    def testOrdering(self):
+        a = utils.getReceiptTimestamp('2016-12-31T23:59:59')
+        b = utils.getReceiptTimestamp('2017-01-01T00:00:00')
+        self.assertEqual(b - a, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,375 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module checks the used receipt IDs backends in verification_state.
+"""
+
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from cryptography.hazmat.primitives import serialization
+
+from .. import depparser
+from .. import key_store
+from .. import utils
+from .. import verification_state
+from .. import verify
+
+from .test_verify_parallel import SERIAL, _makeDEP
+
+from sys import version_info
+if version_info[0] < 3:
+    import __builtin__
+else:
+    import builtins as __builtin__
+
+class UsedReceiptIdsUniqueTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not hasattr(__builtin__, '_'):
+            __builtin__._ = lambda x: x
+
+    def testMerge(self):
+        rIds = verification_state.UsedReceiptIdsUnique()
+        rIds.add('1')
+        others = [ verification_state.UsedReceiptIdsUnique() for i in
+                range(2) ]
+        others[0].add('2')
+        others[1].add('3')
+        rIds.merge(others)
+        self.assertEqual(rIds._usedRecIds, set([ '1', '2', '3' ]))
+
+        other = verification_state.UsedReceiptIdsUnique()
+        for rId in ('4', '3', '2'):
+            other.add(rId)
+        with self.assertRaises(verification_state.DuplicateReceiptIdException) as cm:
+            rIds.merge([other])
+        self.assertEqual(cm.exception.receipt, '2')
+        self.assertEqual(rIds._usedRecIds, set([ '1', '2', '3' ]))
+
+    def testShards(self):
+        rIds = verification_state.UsedReceiptIdsUnique()
+        for i in range(50):
+            rIds.add('R-%d' % i)
+        shards = rIds.shard(4)
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(sorted(rId for ids in shards for rId in ids),
+                sorted(rIds._usedRecIds))
+        for i, ids in enumerate(shards):
+            for rId in ids:
+                self.assertEqual(verification_state.receiptIdShard(rId, 4), i)
+
+        other = verification_state.UsedReceiptIdsUnique()
+        other.add('X')
+        other.begin()
+        other.addShards(shards)
+        self.assertEqual(len(other._usedRecIds), 51)
+        other.rollback()
+        self.assertEqual(other._usedRecIds, set([ 'X' ]))
+
+        other.add('R-7')
+        with self.assertRaises(verification_state.DuplicateReceiptIdException) as cm:
+            other.addShards(shards)
+        self.assertEqual(cm.exception.receipt, 'R-7')
+        self.assertEqual(other._usedRecIds, set([ 'X', 'R-7' ]))
+
+class UsedReceiptIdsSQLiteTest(unittest.TestCase):
+    backend = verification_state.UsedReceiptIdsSQLite
+
+    @classmethod
+    def setUpClass(cls):
+        if not hasattr(__builtin__, '_'):
+            __builtin__._ = lambda x: x
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'receipt_ids.sqlite')
+        self.environ = os.environ.get('RKSV_STATE_RECEIPT_IDS_FILE')
+        os.environ['RKSV_STATE_RECEIPT_IDS_FILE'] = self.path
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['RKSV_STATE_RECEIPT_IDS_FILE']
+        else:
+            os.environ['RKSV_STATE_RECEIPT_IDS_FILE'] = self.environ
+        shutil.rmtree(self.dir)
+
+    def _roundTrip(self, rIds):
+        return verification_state.UsedReceiptIdsBackend.readFromJson(
+                json.loads(json.dumps(rIds.writeToJson())), 'usedReceiptIds')
+
+    def testDuplicates(self):
+        rIds = self.backend()
+        for rId in ('1', '2', '3'):
+            rIds.check(rId)
+            rIds.add(rId)
+        with self.assertRaises(verification_state.DuplicateReceiptIdException):
+            rIds.check('2')
+
+        rIds = self._roundTrip(rIds)
+        self.assertEqual(rIds.writeToJson()['backendData'],
+                { 'file': self.path })
+        with self.assertRaises(verification_state.DuplicateReceiptIdException):
+            rIds.check('3')
+
+        other = self.backend()
+        other.add('4')
+        rIds.merge([other])
+        other = self.backend()
+        other.add('1')
+        with self.assertRaises(verification_state.DuplicateReceiptIdException):
+            rIds.merge([other])
+
+    def testBatches(self):
+        rIds = self._roundTrip(self.backend())
+        ids = [ 'R%d' % i for i in range(
+            self.backend.INSERT_BATCH_SIZE + 5) ]
+        for rId in ids:
+            rIds.add(rId)
+        self.assertEqual(len(rIds._pending), 5)
+        self.assertEqual(sorted(rIds._ids()), sorted(ids))
+
+    def testRollback(self):
+        rIds = self.backend()
+        rIds.add('1')
+        rIds = self._roundTrip(rIds)
+
+        cp = copy.deepcopy(rIds)
+        for i in range(self.backend.INSERT_BATCH_SIZE):
+            cp.add('X%d' % i)
+        with self.assertRaises(verification_state.DuplicateReceiptIdException):
+            cp.check('X0')
+        # The copy is discarded without being written to JSON.
+        del cp
+
+        rIds = self._roundTrip(rIds)
+        rIds.check('X0')
+        self.assertEqual(list(rIds._ids()), [ '1' ])
+
+    def testMalformed(self):
+        for data in ([], {}, { 'file': 1 }):
+            with self.assertRaises(
+                    verification_state.MalformedStateElementException):
+                verification_state.UsedReceiptIdsBackend.readFromJson({
+                    'backendType': self.backend._backendType,
+                    'backendData': data }, 'usedReceiptIds')
+
+        del os.environ['RKSV_STATE_RECEIPT_IDS_FILE']
+        with self.assertRaises(verification_state.UsedReceiptIdsFileException):
+            self.backend().writeToJson()
+        os.environ['RKSV_STATE_RECEIPT_IDS_FILE'] = self.path
+
+    def testVerifyDEP(self):
+        privKey, pubKey = utils.makeES256Keypair()
+        priv = privKey.private_bytes(serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()).decode('utf-8')
+        keyStore = key_store.KeyStore()
+        keyStore.putKey(SERIAL, pubKey, None)
+        key = os.urandom(32)
+        dep = _makeDEP(priv, key, 30)
+
+        results = list()
+        for backend in (verification_state.UsedReceiptIdsUnique,
+                self.backend):
+            state = verification_state.ClusterState.readStateFromJson(
+                    verification_state.ClusterState(backend).writeStateToJson())
+            parser = depparser.DictDEPParser(dep)
+            state = verify.verifyParsedDEP(parser, keyStore, key, state,
+                    None, None, 1, 7, backend)
+            state = verification_state.ClusterState.readStateFromJson(
+                    json.loads(json.dumps(state.writeStateToJson())))
+            results.append((state.cashRegisters,
+                sorted(state.usedReceiptIds._ids() if backend is
+                    self.backend else
+                    state.usedReceiptIds._usedRecIds)))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[0][1]), 30)
+
+class UsedReceiptIdsSQLiteBloomTest(UsedReceiptIdsSQLiteTest):
+    backend = verification_state.UsedReceiptIdsSQLiteBloom
+
+    def testFilter(self):
+        self.environ_expected = os.environ.get('RKSV_STATE_RECEIPT_IDS_EXPECTED')
+        os.environ['RKSV_STATE_RECEIPT_IDS_EXPECTED'] = '10'
+        try:
+            rIds = self.backend()
+            for i in range(10):
+                rIds.add('A%d' % i)
+            rIds = self._roundTrip(rIds)
+            self.assertEqual(rIds._filter().capacity, 10)
+
+            for i in range(20):
+                rIds.check('B%d' % i)
+                rIds.add('B%d' % i)
+            rIds = self._roundTrip(rIds)
+            bloom = rIds._filter()
+            self.assertEqual(bloom.count, 30)
+            self.assertEqual(bloom.capacity, 60)
+            for i in range(10):
+                self.assertTrue(bloom.mightContain('A%d' % i))
+                self.assertTrue(bloom.mightContain('B%d' % i))
+            with self.assertRaises(
+                    verification_state.DuplicateReceiptIdException):
+                rIds.check('B19')
+        finally:
+            if self.environ_expected is None:
+                del os.environ['RKSV_STATE_RECEIPT_IDS_EXPECTED']
+            else:
+                os.environ['RKSV_STATE_RECEIPT_IDS_EXPECTED'] = \
+                        self.environ_expected
+
+class UsedReceiptIdsIntervalsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not hasattr(__builtin__, '_'):
+            __builtin__._ = lambda x: x
+
+    def _roundTrip(self, rIds):
+        return verification_state.UsedReceiptIdsBackend.readFromJson(
+                json.loads(json.dumps(rIds.writeToJson())), 'usedReceiptIds')
+
+    def testIntervals(self):
+        rIds = verification_state.UsedReceiptIdsIntervals()
+        for rId in ('R3', 'R1', 'R2', 'R5', 'R07', 'R10', 'ID-x'):
+            rIds.check(rId)
+            rIds.add(rId)
+        self.assertEqual(rIds.writeToJson()['backendData'], {
+            'intervals': [ [ 'R', 1, [ [ 1, 3 ], [ 5, 5 ] ] ],
+                [ 'R', 2, [ [ 7, 7 ], [ 10, 10 ] ] ] ],
+            'otherIds': [ 'ID-x' ] })
+
+        rIds = self._roundTrip(rIds)
+        for rId in ('R2', 'R07', 'ID-x'):
+            with self.assertRaises(
+                    verification_state.DuplicateReceiptIdException):
+                rIds.check(rId)
+        for rId in ('R4', 'R7', 'R007', 'R11', 'ID-y'):
+            rIds.check(rId)
+
+        rIds.add('R4')
+        self.assertEqual(rIds._intervals[('R', 1)], ([ 1 ], [ 5 ]))
+
+    def testTrailingNewline(self):
+        rIds = verification_state.UsedReceiptIdsIntervals()
+        rIds.add('abc1')
+        rIds.check('abc1\n')
+        rIds.add('abc1\n')
+        self.assertEqual(rIds._otherRecIds, set([ 'abc1\n' ]))
+        with self.assertRaises(verification_state.DuplicateReceiptIdException):
+            rIds.check('abc1\n')
+
+    def testMerge(self):
+        rIds = verification_state.UsedReceiptIdsIntervals()
+        rIds.add('R1')
+        rIds.add('R9')
+
+        other = verification_state.UsedReceiptIdsIntervals()
+        for i in range(2, 9):
+            other.add('R%d' % i)
+        other.add('X')
+        rIds.merge([other])
+        self.assertEqual(rIds._intervals[('R', 1)], ([ 1 ], [ 9 ]))
+        self.assertEqual(rIds._otherRecIds, set([ 'X' ]))
+
+        other = verification_state.UsedReceiptIdsIntervals()
+        other.add('R05')
+        other.add('R8')
+        with self.assertRaises(verification_state.DuplicateReceiptIdException) as cm:
+            rIds.merge([other])
+        self.assertEqual(cm.exception.receipt, 'R8')
+
+    def testMalformed(self):
+        for data in ([], {}, { 'intervals': [], 'otherIds': [ 1 ] },
+                { 'intervals': [ [ 'R', 1, [ [ 2, 1 ] ] ] ], 'otherIds': [] },
+                { 'intervals': [ [ 'R', 1, [ [ 1, 2 ], [ 3, 4 ] ] ] ],
+                    'otherIds': [] }):
+            with self.assertRaises(
+                    verification_state.MalformedStateElementException):
+                verification_state.UsedReceiptIdsBackend.readFromJson({
+                    'backendType': 'USED_RECEIPT_IDS_INTERVALS',
+                    'backendData': data }, 'usedReceiptIds')
+
+class ClusterStateTransactionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not hasattr(__builtin__, '_'):
+            __builtin__._ = lambda x: x
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.environ = os.environ.get('RKSV_STATE_RECEIPT_IDS_FILE')
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['RKSV_STATE_RECEIPT_IDS_FILE']
+        else:
+            os.environ['RKSV_STATE_RECEIPT_IDS_FILE'] = self.environ
+        shutil.rmtree(self.dir)
+
+    def _check(self, rIds, rId):
+        try:
+            rIds.check(rId)
+        except verification_state.DuplicateReceiptIdException:
+            return True
+        return False
+
+    def testRollback(self):
+        for backend in (verification_state.UsedReceiptIdsUnique,
+                verification_state.UsedReceiptIdsIntervals,
+                verification_state.UsedReceiptIdsSQLite,
+                verification_state.UsedReceiptIdsSQLiteBloom):
+            os.environ['RKSV_STATE_RECEIPT_IDS_FILE'] = os.path.join(self.dir,
+                    backend._backendType)
+            state = verification_state.ClusterState(backend)
+            state.usedReceiptIds.add('R1')
+            state = verification_state.ClusterState.readStateFromJson(
+                    json.loads(json.dumps(state.writeStateToJson())))
+
+            prev, rState, rIds = state.begin(None)
+            self.assertIs(rIds, state.usedReceiptIds)
+            self.assertEqual(len(state.cashRegisters), 1)
+            rIds.add('R2')
+            other = backend()
+            other.add('R3')
+            rIds.merge([other])
+            state.rollback()
+            self.assertEqual(len(state.cashRegisters), 0)
+            self.assertTrue(self._check(state.usedReceiptIds, 'R1'))
+            self.assertFalse(self._check(state.usedReceiptIds, 'R2'))
+            self.assertFalse(self._check(state.usedReceiptIds, 'R3'))
+
+            prev, rState, rIds = state.begin(None)
+            rIds.add('R2')
+            rState.startReceiptJWS = 'start'
+            state.commit(None, rState)
+            self.assertEqual(state.cashRegisters[0].startReceiptJWS, 'start')
+            self.assertTrue(self._check(state.usedReceiptIds, 'R2'))
+
+            state = verification_state.ClusterState.readStateFromJson(
+                    json.loads(json.dumps(state.writeStateToJson())))
+            self.assertTrue(self._check(state.usedReceiptIds, 'R1'))
+            self.assertTrue(self._check(state.usedReceiptIds, 'R2'))
+            self.assertFalse(self._check(state.usedReceiptIds, 'R3'))
+
+if __name__ == '__main__':
+    unittest.main()
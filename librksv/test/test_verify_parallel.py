@@ -0,0 +1,435 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module checks that verifying a DEP with a process pool yields the same
+results as verifying it sequentially.
+"""
+
+from builtins import int
+from builtins import range
+
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from cryptography.hazmat.primitives import serialization
+
+from .. import cashreg
+from .. import depparser
+from .. import key_store
+from .. import receipt
+from .. import shared_chunks
+from .. import signature_cache
+from .. import sigsys
+from .. import utils
+from .. import verification_state
+from .. import verify
+
+from sys import version_info
+if version_info[0] < 3:
+    import __builtin__
+else:
+    import builtins as __builtin__
+
+SERIAL = 'U:ATU12345678-K1'
+NPROCS = 2
+
+def _makeDEP(priv, key, num, badTurnoverCounterIdx = None,
+        duplicateIdIdx = None, reusedIds = None):
+    """
+    Creates a DEP for a closed system with num receipts. If
+    badTurnoverCounterIdx is given, the turnover counter of that receipt is
+    off by one cent. If duplicateIdIdx is given, that receipt reuses the ID
+    of the third receipt. reusedIds maps the index of other receipts to the
+    index of the receipt whose ID they reuse.
+    """
+    reusedIds = dict(reusedIds or {})
+    if duplicateIdIdx is not None:
+        reusedIds[duplicateIdIdx] = 2
+    rand = random.Random(num)
+    sigsystem = sigsys.SignatureSystemWorking('AT0', SERIAL, priv)
+    register = cashreg.CashRegister('PARALLEL-1', None, 0, key)
+
+    dateTime = datetime.datetime(2017, 1, 1)
+    recs = [ register.receipt('R1', '0', dateTime, 0.0, 0.0, 0.0, 0.0, 0.0,
+        sigsystem) ]
+    for i in range(1, num):
+        dateTime += datetime.timedelta(seconds=1)
+        if i == badTurnoverCounterIdx:
+            register.turnoverCounter += 1
+        sums = [ round(rand.uniform(-100, 100), 2) for j in range(5) ]
+        recs.append(register.receipt('R1',
+            '%d' % reusedIds.get(i, i), dateTime, sums[0],
+            sums[1], sums[2], sums[3], sums[4], sigsystem,
+            dummy=rand.random() < 0.1, reversal=rand.random() < 0.1))
+
+    return { 'Belege-Gruppe': [ {
+        'Signaturzertifikat': '',
+        'Zertifizierungsstellen': [],
+        'Belege-kompakt': [ r.toJWSString('R1') for r in recs ],
+        } ] }
+
+class VerifyParallelTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not hasattr(__builtin__, '_'):
+            __builtin__._ = lambda x: x
+
+        privKey, pubKey = utils.makeES256Keypair()
+        cls.priv = privKey.private_bytes(serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()).decode('utf-8')
+        cls.keyStore = key_store.KeyStore()
+        cls.keyStore.putPEMKey(SERIAL, pubKey.public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8'))
+        cls.key = os.urandom(32)
+
+        cls.pool = multiprocessing.Pool(NPROCS)
+        cls.initPool = multiprocessing.Pool(NPROCS,
+                verify.initVerificationWorker, (cls.keyStore, cls.key))
+
+    @classmethod
+    def tearDownClass(cls):
+        for pool in (cls.pool, cls.initPool):
+            pool.terminate()
+            pool.join()
+
+    def _verify(self, dep, chunksize, pool, usedIds = (), **kwargs):
+        state = verification_state.ClusterState(
+                verification_state.UsedReceiptIdsUnique)
+        for rId in usedIds:
+            state.usedReceiptIds.add(rId)
+        with tempfile.TemporaryFile(mode='w+') as f:
+            json.dump(dep, f)
+            f.seek(0)
+            parser = depparser.IncrementalDEPParser.fromFd(f, True)
+            try:
+                state = verify.verifyParsedDEP(parser, self.keyStore,
+                        self.key, state, None, pool, NPROCS, chunksize,
+                        verification_state.UsedReceiptIdsUnique, **kwargs)
+            except (verify.DEPReceiptException,
+                    receipt.ReceiptException,
+                    verification_state.DuplicateReceiptIdException) as e:
+                return e.__class__, e.receipt
+            except depparser.DEPParseException as e:
+                return e.__class__, str(e)
+        # The used receipt IDs are a set.
+        return state.cashRegisters, sorted(state.usedReceiptIds._usedRecIds)
+
+    def _assertAllModesEqual(self, dep, usedIds = ()):
+        results = dict()
+        for chunksize in (1, 3, 7, 50):
+            expected = self._verify(dep, chunksize, None, usedIds)
+            results[chunksize] = expected
+            self.assertEqual(self._verify(dep, chunksize, self.pool, usedIds),
+                    expected)
+            for packageSize in (0, 2, 5):
+                self.assertEqual(self._verify(dep, chunksize, self.pool,
+                    usedIds, packageSize=packageSize), expected)
+            self.assertEqual(self._verify(dep, chunksize, self.initPool,
+                usedIds, poolInitialized=True), expected)
+            if shared_chunks.shared_memory is not None:
+                self.assertEqual(self._verify(dep, chunksize, self.pool,
+                    usedIds, sharedMemory=True), expected)
+                self.assertEqual(self._verify(dep, chunksize, self.initPool,
+                    usedIds, poolInitialized=True, sharedMemory=True),
+                    expected)
+                for maxInFlight in (1, 3, None):
+                    self.assertEqual(self._verify(dep, chunksize, self.pool,
+                        usedIds, sharedMemory=True, packageSize=2,
+                        maxInFlight=maxInFlight), expected)
+        return results
+
+    def testSplitGroups(self):
+        groups = [ (list(range(n)), n) for n in (3, 0, 7, 1, 4) ]
+        for packageSize in range(1, 17):
+            pkgs = list(verify.splitGroupsWithVerifiers(groups, packageSize))
+            for pkg in pkgs[:-1]:
+                self.assertEqual(sum(len(recs) for recs, rv in pkg),
+                        packageSize)
+            self.assertEqual([ (r, rv) for pkg in pkgs
+                for recs, rv in pkg for r in recs ],
+                [ (r, rv) for recs, rv in groups for r in recs ])
+        self.assertEqual(list(verify.splitGroupsWithVerifiers(groups, 0)),
+                [ groups ])
+
+    @unittest.skipIf(shared_chunks.shared_memory is None,
+            'shared memory not supported')
+    def testSharedGroups(self):
+        groups = [ ([ b'a', b'', u'\u00e4b'.encode('utf-8') ], 1),
+                ([], 2), ([ b'cd' ], None) ]
+        shared, shm = shared_chunks.SharedGroups.fromGroups(groups)
+        try:
+            with shared_chunks.loadGroups(shared) as attached:
+                self.assertEqual([ ([ depparser.expandDEPReceipt(r)
+                    for r in recs ], ref) for recs, ref in attached ],
+                    [ ([ u'a', u'', u'\u00e4b' ], 1), ([], 2),
+                        ([ u'cd' ], None) ])
+                view = attached[0][0][0]
+            with self.assertRaises(ValueError):
+                bytes(view)
+        finally:
+            shared_chunks.free([ shm ])
+
+    def testCancelledPackages(self):
+        dep = _makeDEP(self.priv, self.key, 40)
+        recs = [ r.encode('utf-8')
+                for r in dep['Belege-Gruppe'][0]['Belege-kompakt'] ]
+        groups = verify.packageChunkWithVerifiers([ (recs, None, None) ],
+                self.keyStore)
+        backend = verification_state.UsedReceiptIdsUnique
+        expected = verify.verifyGroupsWithVerifiers(groups, self.key, None,
+                verification_state.CashRegisterState(), backend())
+
+        pkgs = list(verify.splitGroupsWithVerifiers(groups, 7))
+        wargs, startJWS, boundary = verify.prepareVerificationTuples(pkgs,
+                self.key, None, verification_state.CashRegisterState(), None,
+                (None, None), backend)
+        results = [ verify.verifyGroupsSpeculatively(*args[:-1],
+            isCancelled=lambda: i % 2 == 1)
+            for i, args in enumerate(wargs) ]
+        for i, result in enumerate(results):
+            self.assertEqual(isinstance(result[4],
+                verify.VerificationCancelledException), i % 2 == 1)
+
+        rState, usedRecIds = verify.reconcileVerificationResults(pkgs,
+                results, self.key, None,
+                verification_state.CashRegisterState(), backend())
+        self.assertEqual(rState, expected[0])
+        self.assertEqual(sorted(usedRecIds._usedRecIds),
+                sorted(expected[1]._usedRecIds))
+
+    def testValid(self):
+        results = self._assertAllModesEqual(_makeDEP(self.priv, self.key, 40))
+        for result in results.values():
+            self.assertEqual(len(result[1]), 40)
+
+    def testInvalidTurnoverCounter(self):
+        for idx in (1, 5, 21, 39):
+            results = self._assertAllModesEqual(_makeDEP(self.priv, self.key,
+                40, idx))
+            for result in results.values():
+                self.assertEqual(result[0],
+                        verify.InvalidTurnoverCounterException)
+
+    def testDuplicateReceiptId(self):
+        for idx in (3, 21, 39):
+            results = self._assertAllModesEqual(_makeDEP(self.priv, self.key,
+                40, duplicateIdIdx=idx))
+            for result in results.values():
+                self.assertEqual(result, (
+                    verification_state.DuplicateReceiptIdException, '2'))
+
+        # The first error in receipt order is raised.
+        results = self._assertAllModesEqual(_makeDEP(self.priv, self.key, 40,
+            badTurnoverCounterIdx=36, duplicateIdIdx=21))
+        self.assertEqual(results[1][0],
+                verification_state.DuplicateReceiptIdException)
+        results = self._assertAllModesEqual(_makeDEP(self.priv, self.key, 40,
+            badTurnoverCounterIdx=8, duplicateIdIdx=31))
+        self.assertEqual(results[1][0],
+                verify.InvalidTurnoverCounterException)
+
+    @unittest.skipIf(not shared_chunks.SharedIdShards.SUPPORTED,
+            'receipt ID shards not supported')
+    def testDuplicateReceiptIdOrder(self):
+        # The first reused ID in receipt order is reported, not the
+        # smallest one.
+        dep = _makeDEP(self.priv, self.key, 40, reusedIds={ 30: 9, 31: 10 })
+        expected = (verification_state.DuplicateReceiptIdException, '9')
+        self.assertEqual(self._verify(dep, 50, None), expected)
+        for maxInFlight in (1, 3, None):
+            for packageSize in (2, 5, 0):
+                self.assertEqual(self._verify(dep, 50, self.pool,
+                    sharedMemory=True, packageSize=packageSize,
+                    maxInFlight=maxInFlight), expected)
+
+    def testDuplicateReceiptIdInState(self):
+        dep = _makeDEP(self.priv, self.key, 40)
+        results = self._assertAllModesEqual(dep, [ 'x', 'y' ])
+        for result in results.values():
+            self.assertEqual(len(result[1]), 42)
+
+        results = self._assertAllModesEqual(dep, [ 'x', '17', '33' ])
+        for result in results.values():
+            self.assertEqual(result, (
+                verification_state.DuplicateReceiptIdException, '17'))
+
+    @unittest.skipIf(not shared_chunks.SharedIdShards.SUPPORTED,
+            'receipt ID shards not supported')
+    def testSharedIdShards(self):
+        rIds = verification_state.UsedReceiptIdsUnique()
+        for i in range(20):
+            rIds.add(u'R-%d' % i)
+        rIds.add(u'\u00e4')
+        shards = rIds.shard(3)
+        shards.append(list())
+        shared, segments = shared_chunks.SharedIdShards.fromShards(shards)
+        for shm in segments:
+            shm.close()
+        try:
+            self.assertEqual(len(segments), 3)
+            self.assertEqual([ shared.load(i) for i in range(4) ], shards)
+            for i, ids in enumerate(shards):
+                for rId in ids:
+                    self.assertEqual(
+                            verification_state.receiptIdShard(rId, 3), i)
+        finally:
+            shared.free()
+
+    @unittest.skipIf(not shared_chunks.SharedIdShards.SUPPORTED,
+            'receipt ID shards not supported')
+    def testShardedReconcile(self):
+        dep = _makeDEP(self.priv, self.key, 40, duplicateIdIdx=30)
+        recs = [ r.encode('utf-8')
+                for r in dep['Belege-Gruppe'][0]['Belege-kompakt'] ]
+        groups = verify.packageChunkWithVerifiers([ (recs, None, None) ],
+                self.keyStore)
+        backend = verification_state.UsedReceiptIdsUnique
+
+        for last in (25, 40):
+            pkgs = list(verify.splitGroupsWithVerifiers(
+                [ (groups[0][0][:last], groups[0][1]) ], 7))
+            wargs, startJWS, boundary = verify.prepareVerificationTuples(
+                    pkgs, self.key, None,
+                    verification_state.CashRegisterState(), None,
+                    (None, None), backend)
+            results = [ verify.shardVerificationResultTuple(
+                verify.verifyGroupsSpeculativelyTuple, 3, args)
+                for args in wargs ]
+            rState, idShards, error = \
+                    verify.reconcileShardedVerificationResults(pkgs, results,
+                            self.key, None,
+                            verification_state.CashRegisterState(), backend,
+                            3)
+            self.assertIsNone(error)
+            self.assertEqual(len(idShards), len(pkgs))
+
+            try:
+                for usedIds in ((), ('x', '9')):
+                    usedRecIds = backend()
+                    for rId in usedIds:
+                        usedRecIds.add(rId)
+                    merged = [ verify.mergeReceiptIdShard(idShards, shard)
+                            for shard in range(3) ]
+                    if last == 40 or usedIds:
+                        with self.assertRaises(verification_state.
+                                DuplicateReceiptIdException) as cm:
+                            verify.combineReceiptIdShards(pkgs, idShards,
+                                    merged, usedRecIds)
+                        self.assertEqual(cm.exception.receipt,
+                                '2' if not usedIds else '9')
+                        self.assertEqual(sorted(usedRecIds._usedRecIds),
+                                sorted(usedIds))
+                    else:
+                        verify.combineReceiptIdShards(pkgs, idShards, merged,
+                                usedRecIds)
+                        self.assertEqual(usedRecIds._usedRecIds,
+                                set([ '%d' % i for i in range(25) ]))
+            finally:
+                for shards in idShards:
+                    shards.free()
+
+    def testSignatureThreads(self):
+        batchSize = verify.SIGNATURE_BATCH_SIZE
+        environ = os.environ.get('RKSV_VERIFY_SIGNATURE_THREADS')
+        deps = [ _makeDEP(self.priv, self.key, 40),
+                _makeDEP(self.priv, self.key, 40, 21) ]
+        # An invalid signature before an invalid turnover counter.
+        dep = _makeDEP(self.priv, self.key, 40, 21)
+        recs = dep['Belege-Gruppe'][0]['Belege-kompakt']
+        recs[13] = recs[13][:-4] + ('AAAA' if recs[13][-4:] != 'AAAA'
+                else 'BBBB')
+        deps.append(dep)
+
+        try:
+            for dep in deps:
+                expected = self._verify(dep, 50, None)
+                verify.SIGNATURE_BATCH_SIZE = 3
+                os.environ['RKSV_VERIFY_SIGNATURE_THREADS'] = '4'
+                self.assertIsNotNone(verify.getSignatureExecutor())
+                self.assertEqual(self._verify(dep, 50, None), expected)
+                self.assertEqual(self._verify(dep, 7, None), expected)
+                verify.SIGNATURE_BATCH_SIZE = batchSize
+                del os.environ['RKSV_VERIFY_SIGNATURE_THREADS']
+            self.assertEqual(expected[0],
+                    verify.verify_receipt.InvalidSignatureException)
+        finally:
+            verify.SIGNATURE_BATCH_SIZE = batchSize
+            if environ is None:
+                os.environ.pop('RKSV_VERIFY_SIGNATURE_THREADS', None)
+            else:
+                os.environ['RKSV_VERIFY_SIGNATURE_THREADS'] = environ
+
+    def testSignatureCache(self):
+        dep = _makeDEP(self.priv, self.key, 40, 21)
+        recs = dep['Belege-Gruppe'][0]['Belege-kompakt']
+        recs[30] = recs[30][:-4] + ('AAAA' if recs[30][-4:] != 'AAAA'
+                else 'BBBB')
+        expected = self._verify(dep, 7, None)
+
+        tmpDir = tempfile.mkdtemp()
+        path = os.path.join(tmpDir, 'signatures.sqlite')
+        counters = multiprocessing.Array('q', 2)
+        pool = multiprocessing.Pool(NPROCS, verify.initVerificationWorker,
+                (self.keyStore, self.key, path, counters))
+        try:
+            misses = list()
+            for i in range(2):
+                cache = signature_cache.SQLiteSignatureCache(path)
+                self.assertEqual(self._verify(dep, 7, None,
+                    signatureCache=cache), expected)
+                cache.close()
+                misses.append(cache.misses())
+            # Only the valid signatures are verified again.
+            self.assertGreater(misses[0], 0)
+            self.assertEqual(cache.hits(), misses[0])
+            self.assertEqual(misses[1], 0)
+
+            cache = signature_cache.SQLiteSignatureCache(path, counters)
+            self.assertEqual(self._verify(dep, 7, pool, poolInitialized=True,
+                signatureCache=cache), expected)
+            cache.close()
+            # The workers may verify receipts after the invalid one, which
+            # are not in the cache.
+            self.assertGreaterEqual(counters[0], misses[0])
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(tmpDir)
+
+    def testParseErrorAfterInvalidReceipt(self):
+        dep = _makeDEP(self.priv, self.key, 40)
+        dep['Belege-Gruppe'][0]['Belege-kompakt'][30] = 42
+        for result in self._assertAllModesEqual(dep).values():
+            self.assertTrue(issubclass(result[0], depparser.DEPParseException))
+
+        # Receipts in chunks before the malformed one are verified first.
+        dep = _makeDEP(self.priv, self.key, 40, 10)
+        dep['Belege-Gruppe'][0]['Belege-kompakt'][30] = 42
+        results = self._assertAllModesEqual(dep)
+        self.assertEqual(results[1][0], verify.InvalidTurnoverCounterException)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+###########################################################################
+# Copyright 2017 ZT Prentner IT GmbH (www.ztp.at)
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+
+"""
+This module checks that ReceiptVerifier only looks up the public key once
+for each certificate serial and still reports the same errors.
+"""
+
+from builtins import range
+
+import pickle
+import unittest
+
+from .. import key_store
+from .. import receipt
+from .. import verify_receipt
+
+from . import receipt_helpers
+
+class _CountingKeyStore(key_store.KeyStore):
+    def __init__(self):
+        super(_CountingKeyStore, self).__init__()
+        self.lookups = 0
+
+    def getKey(self, keyId):
+        self.lookups += 1
+        return super(_CountingKeyStore, self).getKey(keyId)
+
+class ReceiptVerifierTest(receipt_helpers.SignedReceiptsTestCase):
+    CERT_NAME = 'verifier'
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReceiptVerifierTest, cls).setUpClass()
+        cls.keyStore = _CountingKeyStore()
+        cls.keyStore.putKey(key_store.numSerialToKeyId(cls.serial), cls.pub,
+                cls.cert)
+
+    def setUp(self):
+        self.keyStore.lookups = 0
+
+    def testKeyStoreLookedUpOnce(self):
+        hexSerial = key_store.numSerialToKeyId(self.serial)
+        recs = receipt_helpers.makeReceipts('AT1', hexSerial, self.priv,
+                5) + receipt_helpers.makeReceipts('AT1', 'ffff', self.priv, 5)
+        rv = verify_receipt.ReceiptVerifier.fromKeyStore(self.keyStore)
+        expected = [ None ] * 5 + [ verify_receipt.NoPublicKeyException ] * 5
+        self.assertEqual(receipt_helpers.verifyAll(rv, recs), expected)
+        lookups = self.keyStore.lookups
+
+        self.assertEqual(receipt_helpers.verifyAll(rv, recs), expected)
+        self.assertEqual(self.keyStore.lookups, lookups)
+        self.assertLessEqual(lookups, 4)
+
+    def testCertSerialMismatch(self):
+        recs = receipt_helpers.makeReceipts('AT1', 'ffff', self.priv, 3) + \
+                receipt_helpers.makeReceipts('AT1', '%d' % self.serial,
+                        self.priv, 3)
+        rv = verify_receipt.ReceiptVerifier.fromCert(self.cert)
+        expected = [ verify_receipt.CertSerialMismatchException ] * 3 + \
+                [ None ] * 3
+        for i in range(2):
+            self.assertEqual(receipt_helpers.verifyAll(rv, recs), expected)
+
+    def testPickle(self):
+        rv = verify_receipt.ReceiptVerifier.fromCert(self.cert)
+        recs = receipt_helpers.makeReceipts('AT0', 'U:ATU12345678-K1',
+                self.priv, 1)
+        self.assertEqual(receipt_helpers.verifyAll(rv, recs), [ None ])
+
+        rv = pickle.loads(pickle.dumps(rv))
+        self.assertEqual(len(rv._pubKeys), 0)
+        self.assertEqual(receipt_helpers.verifyAll(rv, recs), [ None ])
+
+    def testCompactBasicCode(self):
+        rec, prefix = receipt.Receipt.fromJWSString(
+                receipt_helpers.makeReceipts('AT1', 'ffff', self.priv, 1)[0])
+        code = rec.toBasicCode(prefix)
+        compact, prefix = receipt.CompactReceipt.fromBasicCode(code)
+        self.assertEqual(compact.sumCents(), rec.sumCents())
+
+        bad = code.replace(rec.sumAStr, 'x', 1)
+        with self.assertRaises(receipt.MalformedReceiptException):
+            receipt.CompactReceipt.fromBasicCode(bad)
+        compact, prefix = receipt.CompactReceipt.fromBasicCode(bad, False)
+        self.assertEqual(compact.receiptId, rec.receiptId)
+        with self.assertRaises(receipt.MalformedReceiptException):
+            compact.sumCents()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,6 +28,7 @@ from .gettext_helper import _
 import base64
 import codecs
 import datetime
+import hashlib
 import io
 import json
 import os
@@ -38,6 +39,7 @@ import uuid
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import ec, rsa, padding
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key, Encoding, PublicFormat
 from cryptography.hazmat.primitives import hashes
@@ -78,9 +80,97 @@ def depParserChunkSize():
     """
     return int(os.environ.get('RKSV_DEP_CHUNKSIZE', 100000))
 
+def verifyParseQueueDepth(nprocs):
+    """
+    This function returns the number of parsed work packages that the
+    parallel verification keeps ready for the worker processes when none was
+    specified. The default is nprocs. The value can be modified via the
+    RKSV_VERIFY_PARSE_QUEUE_DEPTH environment variable.
+    :param nprocs: The number of worker processes.
+    :return: An int specifying the queue depth.
+    """
+    return int(os.environ.get('RKSV_VERIFY_PARSE_QUEUE_DEPTH', nprocs))
+
+def verifyMaxPackagesInFlight(nprocs):
+    """
+    This function returns the number of packages that the parallel
+    verification hands to the worker processes before it waits for the
+    oldest one to finish when none was specified. The default is twice
+    nprocs. The value can be modified via the RKSV_VERIFY_MAX_IN_FLIGHT
+    environment variable.
+    :param nprocs: The number of worker processes.
+    :return: An int specifying the number of packages.
+    """
+    return int(os.environ.get('RKSV_VERIFY_MAX_IN_FLIGHT', 2 * nprocs))
+
+def verifyPackageSize():
+    """
+    This function returns the maximum number of receipts in a work package
+    of the parallel verification when none was specified. Chunks read by
+    the parser are split into packages of this size so that they can be
+    spread evenly among the worker processes. The default is 10000, zero
+    means that each chunk is one package. The value can be modified via the
+    RKSV_VERIFY_PACKAGE_SIZE environment variable.
+    :return: An int specifying the package size.
+    """
+    return int(os.environ.get('RKSV_VERIFY_PACKAGE_SIZE', 10000))
+
+def verifySignatureThreads():
+    """
+    This function returns the number of threads each process uses to verify
+    the signatures of the receipts in a group. The signatures are verified
+    in the calling thread if the number is less than 2, which is the
+    default. The value can be modified via the
+    RKSV_VERIFY_SIGNATURE_THREADS environment variable.
+    :return: An int specifying the number of threads.
+    """
+    return int(os.environ.get('RKSV_VERIFY_SIGNATURE_THREADS', 0))
+
+def certCacheFile():
+    """
+    This function returns the file in which the verification script keeps
+    the certificate chains it already verified against a key store, so they
+    are not verified again in later runs. The file can be set via the
+    RKSV_CERT_CACHE_FILE environment variable. It has to be protected like
+    the key store itself.
+    :return: The file name or None if no file should be used.
+    """
+    return os.environ.get('RKSV_CERT_CACHE_FILE') or None
+
+def signatureCacheFile():
+    """
+    This function returns the file of the database in which the verification
+    script keeps the receipt signatures it already verified, so they are not
+    verified again in later runs. The file can be set via the
+    RKSV_SIGNATURE_CACHE_FILE environment variable. It has to be protected
+    like the key store itself.
+    :return: The file name or None if no file should be used.
+    """
+    return os.environ.get('RKSV_SIGNATURE_CACHE_FILE') or None
+
 def clusterStateReceiptIDsBackend():
     return os.environ.get('RKSV_STATE_RECEIPT_IDS', 'USED_RECEIPT_IDS_UNIQUE')
 
+def clusterStateReceiptIDsFile():
+    """
+    This function returns the file in which the USED_RECEIPT_IDS_SQLITE
+    backend stores the used receipt IDs of a newly created state. States
+    read from JSON keep using the file they reference. The file can be set
+    via the RKSV_STATE_RECEIPT_IDS_FILE environment variable.
+    :return: The file name or None if no file was set.
+    """
+    return os.environ.get('RKSV_STATE_RECEIPT_IDS_FILE') or None
+
+def clusterStateReceiptIDsExpected():
+    """
+    This function returns the number of receipt IDs for which the
+    USED_RECEIPT_IDS_SQLITE_BLOOM backend sizes its Bloom filter. The filter
+    grows when more IDs are stored. The default is 1000000. The value can be
+    modified via the RKSV_STATE_RECEIPT_IDS_EXPECTED environment variable.
+    :return: An int specifying the number of receipt IDs.
+    """
+    return int(os.environ.get('RKSV_STATE_RECEIPT_IDS_EXPECTED', 1000000))
+
 def raiseForKey(key, algorithm):
     if not algorithm.verifyKey(key):
         raise InvalidKeyException()
@@ -109,9 +199,7 @@ def sha256(data):
     :param data: The data to be hashed as a byte list.
     :return: The hashed data as a byte list.
     """
-    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-    digest.update(data)
-    return digest.finalize()
+    return hashlib.sha256(data).digest()
 
 def aes256ctr(iv, key, data):
     """
@@ -126,6 +214,43 @@ def aes256ctr(iv, key, data):
     encryptor = cipher.encryptor()
     return encryptor.update(data) + encryptor.finalize()
 
+def aes256ecb(key, data):
+    """
+    Encrypts the given data using AES-256 in ECB mode with the given key.
+    :param key: The key as a byte list.
+    :param data: The data to be encrypted as a byte list. Its length must be
+    a multiple of 16.
+    :return: The encrypted data as a byte list.
+    """
+    cipher = Cipher(algorithms.AES(key), modes.ECB(), backend = default_backend())
+    encryptor = cipher.encryptor()
+    return encryptor.update(data) + encryptor.finalize()
+
+def verifyES256(pubKey, signature, data):
+    """
+    Verifies a raw JWS ES256 signature (i.e. the concatenated big endian
+    integers r and s) over the given data.
+    :param pubKey: The public key as a cryptography key object.
+    :param signature: The raw signature as a byte list.
+    :param data: The signed data as a byte list.
+    :return: True if the signature is valid, False otherwise.
+    """
+    if not isinstance(pubKey, ec.EllipticCurvePublicKey):
+        return False
+
+    nBytes = (pubKey.curve.key_size + 7) // 8
+    if len(signature) != 2 * nBytes:
+        return False
+
+    r = int.from_bytes(signature[:nBytes], byteorder='big')
+    s = int.from_bytes(signature[nBytes:], byteorder='big')
+    try:
+        pubKey.verify(encode_dss_signature(r, s), data,
+                ec.ECDSA(hashes.SHA256()))
+        return True
+    except InvalidSignature as e:
+        return False
+
 def loadCert(pem):
     """
     Creates a cryptography certificate object from the given PEM certificate.
@@ -134,6 +259,14 @@ def loadCert(pem):
     """
     return x509.load_pem_x509_certificate(pem.encode("utf-8"), default_backend())
 
+def loadCertDER(der):
+    """
+    Creates a cryptography certificate object from the given DER certificate.
+    :param der: A certificate as a byte list.
+    :return: A cryptography certificate object.
+    """
+    return x509.load_der_x509_certificate(der, default_backend())
+
 def loadPubKey(pem):
     """
     Creates a cryptography public key object from the given PEM public key.
@@ -160,6 +293,14 @@ def exportCertToPEM(cert):
     pem = cert.public_bytes(Encoding.PEM).decode("utf-8").splitlines()[1:-1]
     return ''.join(pem)
 
+def exportCertToDER(cert):
+    """
+    Converts a cryptography certificate object to DER.
+    :param cert: The certificate object.
+    :return: The DER certificate as a byte list.
+    """
+    return cert.public_bytes(Encoding.DER)
+
 def exportKeyToPEM(key):
     """
     Converts a cryptography public key object to a one-line PEM string without
@@ -360,16 +501,103 @@ def monetary_value_to_float(value, raise_exception=True):
     return float(parsed_value)
 
 
-# receiptFloatRegex = re.compile(r'^-?([1-9]\d+|\d)[,.]\d\d$')
-def getReceiptFloat(fstr):
-    # if receiptFloatRegex.match(fstr) is None:
-    #     return None
+# Accepts exactly the values accepted by is_valid_monetary_value(). The
+# groups are the sign followed by the integer and cent parts for integers
+# with '.' separators, with ',' separators and without separators.
+receiptCentsRegex = re.compile(
+        r'(-?)(?:'
+        r'([1-9]\d{0,2}(?:\.\d{3})+)(?:,(\d{1,2}))?|'
+        r'([1-9]\d{0,2}(?:,\d{3})+)(?:\.(\d{1,2}))?|'
+        r'([1-9]\d*|0)(?:[.,](\d{1,2}))?'
+        r')\Z')
 
-    try:
-        # return float(fstr.replace(',', '.'))
-        return monetary_value_to_float(fstr)
-    except:
+def getReceiptCents(fstr):
+    """
+    Converts a sum from a receipt to an integer number of cents.
+    :param fstr: The sum as a string.
+    :return: The sum in cents as int or None if fstr is not a valid sum.
+    """
+    if not isinstance(fstr, six.string_types):
+        return None
+    m = receiptCentsRegex.match(fstr)
+    if m is None:
+        return None
+
+    sign, dotInt, dotCents, commaInt, commaCents, plainInt, plainCents = \
+            m.groups()
+    if dotInt is not None:
+        intPart, centPart = dotInt.replace('.', ''), dotCents
+    elif commaInt is not None:
+        intPart, centPart = commaInt.replace(',', ''), commaCents
+    else:
+        intPart, centPart = plainInt, plainCents
+
+    cents = int(intPart) * 100
+    if centPart:
+        cents += int(centPart) * (10 if len(centPart) == 1 else 1)
+    return -cents if sign else cents
+
+def getReceiptFloat(fstr):
+    cents = getReceiptCents(fstr)
+    if cents is None:
         return None
+    return cents / 100.0
+
+receiptTimestampRegex = re.compile(
+        r'([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})\Z')
+_daysBeforeMonth = [0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334]
+_daysInMonth = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+def _isLeapYear(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+def getReceiptTimestamp(tstr):
+    """
+    Converts the timestamp of a receipt to the number of seconds since
+    0001-01-01T00:00:00. The usual "YYYY-MM-DDThh:mm:ss" format is decoded
+    directly, everything else is passed to strptime() so that the same
+    values are accepted as before.
+    :param tstr: The timestamp as a string.
+    :return: The timestamp as int.
+    :throws: ValueError
+    """
+    m = receiptTimestampRegex.match(tstr)
+    if m is not None:
+        year, month, day, hour, minute, second = [ int(g) for g in m.groups() ]
+        leap = _isLeapYear(year)
+        if year >= 1 and 1 <= month <= 12 \
+                and 1 <= day <= _daysInMonth[month] + (month == 2 and leap) \
+                and hour <= 23 and minute <= 59 and second <= 59:
+            y = year - 1
+            days = y * 365 + y // 4 - y // 100 + y // 400 \
+                    + _daysBeforeMonth[month] + day
+            if month > 2 and leap:
+                days += 1
+            return days * 86400 + hour * 3600 + minute * 60 + second
+
+    dt = datetime.datetime.strptime(tstr, "%Y-%m-%dT%H:%M:%S")
+    return dateTimeToTimestamp(dt)
+
+def dateTimeToTimestamp(dt):
+    """
+    Converts a datetime object to the representation returned by
+    getReceiptTimestamp().
+    :param dt: The datetime object.
+    :return: The timestamp as int.
+    """
+    return dt.toordinal() * 86400 + dt.hour * 3600 + dt.minute * 60 \
+            + dt.second
+
+def timestampToDateTime(ts):
+    """
+    Converts a timestamp returned by getReceiptTimestamp() to a datetime
+    object.
+    :param ts: The timestamp as int.
+    :return: The datetime object.
+    """
+    days, secs = divmod(ts, 86400)
+    return datetime.datetime.fromordinal(days) + datetime.timedelta(
+            seconds=secs)
 
 def skipBOM(fd):
     """
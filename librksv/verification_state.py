@@ -27,8 +27,18 @@ from .gettext_helper import _
 from six import string_types
 
 import base64
+import binascii
+import bisect
 import copy
+import hashlib
+import math
 import re
+import zlib
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 from . import algorithms
 from . import depparser
@@ -55,6 +65,17 @@ class NoStartReceiptForLastCashRegisterException(StateException):
                 self).__init__(_("The last cash register has no registered start receipt."))
         self._initargs = ()
 
+class UsedReceiptIdsFileException(StateException):
+    """
+    Indicates that the file of a disk-backed used receipt IDs backend can not
+    be used.
+    """
+
+    def __init__(self, msg):
+        super(UsedReceiptIdsFileException, self).__init__(
+                _("Used receipt IDs file: {}").format(msg))
+        self._initargs = (msg,)
+
 class StateParseException(StateException):
     """
     Indicates that an error occurred while parsing the state.
@@ -121,9 +142,23 @@ class DuplicateReceiptIdException(depparser.DEPException):
         self.receipt = receipt
         self._initargs = (receipt,)
 
+def receiptIdShard(receiptId, nshards):
+    """
+    Gets the shard a receipt ID belongs to if the used receipt IDs are split
+    into nshards shards. This uses CRC32 rather than hash() so that all
+    processes agree on the shard.
+    :param receiptId: The receipt ID as a string.
+    :param nshards: The number of shards.
+    :return: The index of the shard.
+    """
+    return (zlib.crc32(receiptId.encode('utf-8')) & 0xffffffff) % nshards
+
 class UsedReceiptIdsBackend(object):
     _backendType = 'USED_RECEIPT_IDS_INVALID'
 
+    # Whether the backend implements shard() and addShards().
+    SHARDABLE = False
+
     def check(self, receiptId):
         raise NotImplementedError("Please implement this yourself.")
 
@@ -133,6 +168,23 @@ class UsedReceiptIdsBackend(object):
     def merge(self, usedReceiptIdsList):
         raise NotImplementedError("Please implement this yourself.")
 
+    def shard(self, nshards):
+        """
+        Splits the receipt IDs into nshards lists by receiptIdShard(), so
+        that each shard can be checked for duplicates on its own.
+        :return: The receipt IDs of each shard as a list of lists.
+        """
+        raise NotImplementedError("Please implement this yourself.")
+
+    def addShards(self, shards):
+        """
+        Adds the receipt IDs in the given lists. The lists must not contain
+        the same ID twice.
+        :throws: DuplicateReceiptIdException if one of the IDs is already in
+        use. None of them are added then.
+        """
+        raise NotImplementedError("Please implement this yourself.")
+
     @classmethod
     def _dataImport(cls, data, label):
         raise NotImplementedError("Please implement this yourself.")
@@ -140,6 +192,29 @@ class UsedReceiptIdsBackend(object):
     def _dataExport(self):
         raise NotImplementedError("Please implement this yourself.")
 
+    def begin(self):
+        """
+        Starts a transaction. The receipt IDs added until the next call to
+        commit() are removed again by rollback(). Transactions can not be
+        nested. This implementation keeps a copy of the backend, which is
+        fine for backends that only need little memory.
+        """
+        self._txSnapshot = copy.deepcopy(self.__dict__)
+
+    def commit(self):
+        """
+        Ends the transaction and keeps the added receipt IDs.
+        """
+        del self._txSnapshot
+
+    def rollback(self):
+        """
+        Ends the transaction and removes the receipt IDs added in it.
+        """
+        snapshot = self._txSnapshot
+        self.__dict__.clear()
+        self.__dict__.update(snapshot)
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             return self.__dict__ == other.__dict__
@@ -182,21 +257,59 @@ class UsedReceiptIdsBackend(object):
 class UsedReceiptIdsUnique(UsedReceiptIdsBackend):
     _backendType = 'USED_RECEIPT_IDS_UNIQUE'
 
+    SHARDABLE = True
+
     def __init__(self):
         self._usedRecIds = set()
+        # The IDs added in the current transaction or None.
+        self._txRecIds = None
+
+    def begin(self):
+        self._txRecIds = set()
+
+    def commit(self):
+        self._txRecIds = None
+
+    def rollback(self):
+        self._usedRecIds.difference_update(self._txRecIds)
+        self._txRecIds = None
 
     def check(self, receiptId):
         if receiptId in self._usedRecIds:
             raise DuplicateReceiptIdException(receiptId)
 
     def add(self, receiptId):
+        if self._txRecIds is not None and receiptId not in self._usedRecIds:
+            self._txRecIds.add(receiptId)
         self._usedRecIds.add(receiptId)
 
     def merge(self, usedReceiptIdsList):
+        # Set operations instead of check() and add() for every ID, the
+        # merge happens in the parent process for every package unless the
+        # receipt IDs are sharded.
         for rIds in usedReceiptIdsList:
-            for rId in rIds._usedRecIds:
-                self.check(rId)
-                self.add(rId)
+            dups = self._usedRecIds.intersection(rIds._usedRecIds)
+            if dups:
+                raise DuplicateReceiptIdException(min(dups))
+            self._usedRecIds.update(rIds._usedRecIds)
+            if self._txRecIds is not None:
+                self._txRecIds.update(rIds._usedRecIds)
+
+    def shard(self, nshards):
+        shards = [ list() for i in range(nshards) ]
+        for rId in self._usedRecIds:
+            shards[receiptIdShard(rId, nshards)].append(rId)
+        return shards
+
+    def addShards(self, shards):
+        for ids in shards:
+            if not self._usedRecIds.isdisjoint(ids):
+                raise DuplicateReceiptIdException(min(
+                    self._usedRecIds.intersection(ids)))
+        for ids in shards:
+            self._usedRecIds.update(ids)
+            if self._txRecIds is not None:
+                self._txRecIds.update(ids)
 
     @classmethod
     def _dataImport(cls, data, label):
@@ -216,10 +329,312 @@ class UsedReceiptIdsUnique(UsedReceiptIdsBackend):
     def _dataExport(self):
         return list(self._usedRecIds)
 
+class UsedReceiptIdsSQLite(UsedReceiptIdsBackend):
+    """
+    Keeps the used receipt IDs in an SQLite database instead of memory. The
+    state JSON only references the database file. A new instance holds its
+    IDs in memory until it is written to JSON, at which point they are
+    stored in the file returned by utils.clusterStateReceiptIDsFile(). This
+    keeps the instances used for single packages small and cheap to send to
+    other processes.
+
+    An instance read from JSON (or copied from one) adds new IDs to the
+    database in batches of INSERT_BATCH_SIZE, but only commits them when it
+    is written to JSON or copied again. If the verification fails, the
+    copy is discarded and the added IDs are rolled back.
+    """
+    _backendType = 'USED_RECEIPT_IDS_SQLITE'
+
+    INSERT_BATCH_SIZE = 10000
+
+    def __init__(self, path = None):
+        """
+        Creates a new backend.
+        :param path: The file name of the database or None if the IDs should
+        be kept in memory until written to JSON.
+        :throws: UsedReceiptIdsFileException
+        """
+        if sqlite3 is None:
+            raise UsedReceiptIdsFileException(
+                    _('the sqlite3 module is not available'))
+        self._path = path
+        self._conn = None
+        self._pending = set()
+
+    def __del__(self):
+        # The connection is only freed by the garbage collector, so close it
+        # (and roll back uncommitted IDs) as soon as a discarded copy is gone.
+        if getattr(self, '_conn', None) is not None:
+            self._conn.close()
+
+    def __getstate__(self):
+        # Uncommitted IDs are only visible to our own connection, so an
+        # instance with a file should not be sent to other processes.
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+    def __deepcopy__(self, memo):
+        self._commit()
+        cp = self.__class__(self._path)
+        cp._pending = set(self._pending)
+        return cp
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return set(self._ids()) == set(other._ids())
+        return NotImplemented
+
+    def begin(self):
+        self._commit()
+        self._txPending = set(self._pending)
+
+    def commit(self):
+        # The IDs are only written to the file with the state.
+        del self._txPending
+
+    def rollback(self):
+        if self._conn is not None:
+            self._conn.rollback()
+        self._pending = self._txPending
+        del self._txPending
+
+    def _connection(self):
+        if self._conn is None:
+            try:
+                self._conn = sqlite3.connect(self._path, timeout=60)
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute('CREATE TABLE IF NOT EXISTS receipt_ids '
+                        '(id TEXT PRIMARY KEY) WITHOUT ROWID')
+                self._conn.commit()
+            except sqlite3.Error as e:
+                raise UsedReceiptIdsFileException(u'{}: {}'.format(
+                    self._path, e))
+        return self._conn
+
+    def _clear(self):
+        self._connection().execute('DELETE FROM receipt_ids')
+
+    def _flush(self):
+        if self._path is None or not self._pending:
+            return
+        self._connection().executemany(
+                'INSERT OR IGNORE INTO receipt_ids (id) VALUES (?)',
+                ((rId,) for rId in self._pending))
+        self._pending = set()
+
+    def _commit(self):
+        if self._path is None:
+            return
+        self._flush()
+        self._connection().commit()
+
+    def _ids(self):
+        for rId in self._pending:
+            yield rId
+        if self._path is not None:
+            for row in self._connection().execute(
+                    'SELECT id FROM receipt_ids'):
+                yield row[0]
+
+    def check(self, receiptId):
+        if receiptId in self._pending:
+            raise DuplicateReceiptIdException(receiptId)
+        if self._path is not None and self._connection().execute(
+                'SELECT 1 FROM receipt_ids WHERE id = ?',
+                (receiptId,)).fetchone() is not None:
+            raise DuplicateReceiptIdException(receiptId)
+
+    def add(self, receiptId):
+        self._pending.add(receiptId)
+        if len(self._pending) >= self.INSERT_BATCH_SIZE:
+            self._flush()
+
+    def merge(self, usedReceiptIdsList):
+        for rIds in usedReceiptIdsList:
+            for rId in rIds._ids():
+                self.check(rId)
+                self.add(rId)
+
+    @classmethod
+    def _dataImport(cls, data, label):
+        if not isinstance(data, dict):
+            raise MalformedStateElementException(label,
+                    _('backend data not a dictionary'))
+
+        if 'file' not in data:
+            raise MalformedStateElementException(label,
+                    _('receipt IDs file missing'))
+        if not isinstance(data['file'], string_types):
+            raise MalformedStateElementException(label,
+                    _('receipt IDs file not a string'))
+
+        return cls(data['file'])
+
+    def _dataExport(self):
+        if self._path is None:
+            path = utils.clusterStateReceiptIDsFile()
+            if path is None:
+                raise UsedReceiptIdsFileException(
+                        _('RKSV_STATE_RECEIPT_IDS_FILE not set'))
+            # The file now holds exactly our IDs.
+            self._path = path
+            self._clear()
+        self._commit()
+        return {
+                'file': self._path,
+        }
+
+class _BloomFilter(object):
+    """
+    A Bloom filter over receipt IDs. It has no false negatives, i.e. an ID
+    for which mightContain() returns False was never added.
+    """
+
+    FALSE_POSITIVE_RATE = 0.01
+
+    def __init__(self, capacity, bits = None, numHashes = None):
+        """
+        Creates a new filter.
+        :param capacity: The number of IDs the filter is sized for.
+        :param bits: The bytes of an existing filter or None.
+        :param numHashes: The number of hash functions of an existing filter
+        or None.
+        """
+        capacity = max(capacity, 1)
+        if bits is None:
+            numBits = int(math.ceil(-capacity * math.log(
+                self.FALSE_POSITIVE_RATE) / (math.log(2) ** 2)))
+            bits = bytearray((numBits + 7) // 8)
+            numHashes = max(1, int(round(
+                len(bits) * 8 / float(capacity) * math.log(2))))
+        self.capacity = capacity
+        self.bits = bytearray(bits)
+        self.numHashes = numHashes
+        self.count = 0
+
+    def _positions(self, receiptId):
+        digest = hashlib.sha256(receiptId.encode('utf-8')).digest()
+        h1 = int(binascii.hexlify(digest[:8]), 16)
+        h2 = int(binascii.hexlify(digest[8:16]), 16) | 1
+        numBits = len(self.bits) * 8
+        for i in range(self.numHashes):
+            yield (h1 + i * h2) % numBits
+
+    def add(self, receiptId):
+        for pos in self._positions(receiptId):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def mightContain(self, receiptId):
+        for pos in self._positions(receiptId):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class UsedReceiptIdsSQLiteBloom(UsedReceiptIdsSQLite):
+    """
+    Like UsedReceiptIdsSQLite, but checks the IDs against an in-memory Bloom
+    filter first, so that only possible duplicates are looked up in the
+    database. The filter is stored in the database together with the IDs.
+    It is sized for utils.clusterStateReceiptIDsExpected() IDs and rebuilt
+    with twice the size once it holds more IDs than that.
+    """
+    _backendType = 'USED_RECEIPT_IDS_SQLITE_BLOOM'
+
+    def __init__(self, path = None):
+        super(UsedReceiptIdsSQLiteBloom, self).__init__(path)
+        self._bloom = None
+
+    def __deepcopy__(self, memo):
+        cp = super(UsedReceiptIdsSQLiteBloom, self).__deepcopy__(memo)
+        if self._bloom is not None:
+            cp._bloom = copy.deepcopy(self._bloom, memo)
+        return cp
+
+    def begin(self):
+        super(UsedReceiptIdsSQLiteBloom, self).begin()
+        self._txBloom = copy.deepcopy(self._bloom)
+
+    def commit(self):
+        super(UsedReceiptIdsSQLiteBloom, self).commit()
+        del self._txBloom
+
+    def rollback(self):
+        super(UsedReceiptIdsSQLiteBloom, self).rollback()
+        self._bloom = self._txBloom
+        del self._txBloom
+
+    def _connection(self):
+        if self._conn is None:
+            conn = super(UsedReceiptIdsSQLiteBloom, self)._connection()
+            try:
+                conn.execute('CREATE TABLE IF NOT EXISTS bloom_filter '
+                        '(id INTEGER PRIMARY KEY, capacity INTEGER, '
+                        'num_hashes INTEGER, count INTEGER, bits BLOB)')
+                conn.commit()
+            except sqlite3.Error as e:
+                raise UsedReceiptIdsFileException(u'{}: {}'.format(
+                    self._path, e))
+        return self._conn
+
+    def _buildFilter(self, capacity):
+        bloom = _BloomFilter(capacity)
+        for rId in self._ids():
+            bloom.add(rId)
+        return bloom
+
+    def _filter(self):
+        if self._bloom is None:
+            row = self._connection().execute('SELECT capacity, num_hashes, '
+                    'count, bits FROM bloom_filter WHERE id = 0').fetchone()
+            if row is not None:
+                self._bloom = _BloomFilter(row[0], row[3], row[1])
+                self._bloom.count = row[2]
+                # IDs added but not yet flushed are not in the stored filter.
+                for rId in self._pending:
+                    self._bloom.add(rId)
+            else:
+                self._bloom = self._buildFilter(
+                        utils.clusterStateReceiptIDsExpected())
+        return self._bloom
+
+    def _commit(self):
+        if self._path is None:
+            return
+        self._flush()
+        bloom = self._filter()
+        if bloom.count > bloom.capacity:
+            self._bloom = bloom = self._buildFilter(2 * bloom.count)
+        self._connection().execute('INSERT OR REPLACE INTO bloom_filter '
+                '(id, capacity, num_hashes, count, bits) '
+                'VALUES (0, ?, ?, ?, ?)', (bloom.capacity, bloom.numHashes,
+                    bloom.count, sqlite3.Binary(bytes(bloom.bits))))
+        self._connection().commit()
+
+    def check(self, receiptId):
+        if receiptId in self._pending:
+            raise DuplicateReceiptIdException(receiptId)
+        if self._path is None or not self._filter().mightContain(receiptId):
+            return
+        super(UsedReceiptIdsSQLiteBloom, self).check(receiptId)
+
+    def add(self, receiptId):
+        if self._path is not None:
+            self._filter().add(receiptId)
+        super(UsedReceiptIdsSQLiteBloom, self).add(receiptId)
+
+    def _clear(self):
+        super(UsedReceiptIdsSQLiteBloom, self)._clear()
+        self._connection().execute('DELETE FROM bloom_filter')
+        # Built from all our IDs on the next commit.
+        self._bloom = None
+
 # TODO: this breaks for out of order cluster DEP verification, we need to scope
 # IDs per cash register...
 # impl algorithm to find correct split? (i.e. key[>i] range, key[<=i] unique)
 # manually specify ranged parts of key?
+# UsedReceiptIdsIntervals does not have this problem.
 _numSplitRegex = re.compile('([0-9]+)')
 class UsedReceiptIdsSortedNatural(UsedReceiptIdsBackend):
     _backendType = 'USED_RECEIPT_IDS_SORTED_NATURAL'
@@ -294,13 +709,195 @@ class UsedReceiptIdsSortedNatural(UsedReceiptIdsBackend):
                 'maxId': self._maxId,
         }
 
+_prefixCounterRegex = re.compile(r'(.*?)([0-9]+)\Z')
+class UsedReceiptIdsIntervals(UsedReceiptIdsBackend):
+    """
+    Keeps receipt IDs of the form <prefix><counter> as sorted sets of
+    disjoint counter intervals, one per prefix and number of counter digits.
+    IDs that do not match this pattern are kept in an exact set. This only
+    needs memory for the gaps between the counters and, unlike
+    UsedReceiptIdsSortedNatural, still detects every duplicate ID no matter
+    in which order the receipts are verified.
+    Counters that are added in ascending order only ever extend the last
+    interval. Adding a counter that opens or closes a gap in the middle
+    takes time linear in the number of intervals for its prefix, so the
+    worst case for scattered counters added in random order is quadratic.
+    """
+    _backendType = 'USED_RECEIPT_IDS_INTERVALS'
+
+    def __init__(self):
+        # (prefix, digits) -> (interval starts, inclusive interval ends)
+        self._intervals = dict()
+        self._otherRecIds = set()
+
+    @staticmethod
+    def _split(receiptId):
+        m = _prefixCounterRegex.match(receiptId)
+        if not m:
+            return None, None
+        # The number of digits is part of the key, so that e.g. "R07" and
+        # "R7" are kept apart.
+        return (m.group(1), len(m.group(2))), int(m.group(2))
+
+    @staticmethod
+    def _join(key, num):
+        return u'{}{}'.format(key[0], str(num).zfill(key[1]))
+
+    @staticmethod
+    def _findOverlap(starts, ends, first, last):
+        """
+        Finds the smallest number in [first, last] that is already contained
+        in the given intervals.
+        :return: The number or None if there is no overlap.
+        """
+        i = bisect.bisect_left(ends, first)
+        if i < len(starts) and starts[i] <= last:
+            return max(first, starts[i])
+        return None
+
+    @staticmethod
+    def _insert(starts, ends, first, last):
+        """
+        Adds the interval [first, last], which must not overlap the given
+        intervals, and joins it with adjacent intervals. Extending a single
+        neighbouring interval is O(1). Inserting a new interval or joining
+        two existing ones shifts the lists and is O(n) in the number of
+        intervals.
+        """
+        i = bisect.bisect_left(starts, first)
+        joinLeft = i > 0 and ends[i - 1] == first - 1
+        joinRight = i < len(starts) and starts[i] == last + 1
+        if joinLeft and joinRight:
+            ends[i - 1] = ends[i]
+            del starts[i]
+            del ends[i]
+        elif joinLeft:
+            ends[i - 1] = last
+        elif joinRight:
+            starts[i] = first
+        else:
+            starts.insert(i, first)
+            ends.insert(i, last)
+
+    def check(self, receiptId):
+        key, num = self._split(receiptId)
+        if key is None:
+            if receiptId in self._otherRecIds:
+                raise DuplicateReceiptIdException(receiptId)
+            return
+
+        if key not in self._intervals:
+            return
+        starts, ends = self._intervals[key]
+        if self._findOverlap(starts, ends, num, num) is not None:
+            raise DuplicateReceiptIdException(receiptId)
+
+    def add(self, receiptId):
+        key, num = self._split(receiptId)
+        if key is None:
+            self._otherRecIds.add(receiptId)
+            return
+
+        starts, ends = self._intervals.setdefault(key, (list(), list()))
+        if self._findOverlap(starts, ends, num, num) is None:
+            self._insert(starts, ends, num, num)
+
+    def merge(self, usedReceiptIdsList):
+        for rIds in usedReceiptIdsList:
+            for rId in rIds._otherRecIds:
+                self.check(rId)
+                self.add(rId)
+
+            for key, (oStarts, oEnds) in rIds._intervals.items():
+                starts, ends = self._intervals.setdefault(key,
+                        (list(), list()))
+                for first, last in zip(oStarts, oEnds):
+                    num = self._findOverlap(starts, ends, first, last)
+                    if num is not None:
+                        raise DuplicateReceiptIdException(
+                                self._join(key, num))
+                    self._insert(starts, ends, first, last)
+
+    @classmethod
+    def _dataImport(cls, data, label):
+        if not isinstance(data, dict):
+            raise MalformedStateElementException(label,
+                    _('backend data not a dictionary'))
+
+        if 'intervals' not in data:
+            raise MalformedStateElementException(label,
+                    _('receipt ID intervals missing'))
+        if 'otherIds' not in data:
+            raise MalformedStateElementException(label,
+                    _('other receipt IDs missing'))
+
+        if not isinstance(data['otherIds'], list):
+            raise MalformedStateElementException(label,
+                    _('other receipt IDs not a list'))
+        for recId in data['otherIds']:
+            if not isinstance(recId, string_types):
+                raise MalformedStateElementException(label,
+                        _('receipt ID not a string'))
+
+        if not isinstance(data['intervals'], list):
+            raise MalformedStateElementException(label,
+                    _('receipt ID intervals not a list'))
+
+        ret = cls()
+        ret._otherRecIds = set(data['otherIds'])
+        for entry in data['intervals']:
+            if (not isinstance(entry, list) or len(entry) != 3 or
+                    not isinstance(entry[0], string_types) or
+                    not isinstance(entry[1], int) or
+                    not isinstance(entry[2], list)):
+                raise MalformedStateElementException(label,
+                        _('receipt ID interval entry malformed'))
+            key = (entry[0], entry[1])
+            if key in ret._intervals:
+                raise MalformedStateElementException(label,
+                        _('duplicate receipt ID prefix'))
+
+            starts, ends = ret._intervals.setdefault(key, (list(), list()))
+            for iv in entry[2]:
+                if (not isinstance(iv, list) or len(iv) != 2 or
+                        not isinstance(iv[0], int) or
+                        not isinstance(iv[1], int) or iv[0] > iv[1] or
+                        (ends and ends[-1] + 1 >= iv[0])):
+                    raise MalformedStateElementException(label,
+                            _('receipt ID interval malformed'))
+                starts.append(iv[0])
+                ends.append(iv[1])
+
+        return ret
+
+    def _dataExport(self):
+        return {
+                'intervals': [ [ key[0], key[1], [ [ s, e ] for s, e in
+                    zip(starts, ends) ] ] for key, (starts, ends) in
+                    sorted(self._intervals.items()) if starts ],
+                'otherIds': list(self._otherRecIds),
+        }
+
 USED_RECEIPT_IDS_BACKENDS = {
         UsedReceiptIdsUnique._backendType: UsedReceiptIdsUnique,
         UsedReceiptIdsSortedNatural._backendType: UsedReceiptIdsSortedNatural,
+        UsedReceiptIdsSQLite._backendType: UsedReceiptIdsSQLite,
+        UsedReceiptIdsSQLiteBloom._backendType: UsedReceiptIdsSQLiteBloom,
+        UsedReceiptIdsIntervals._backendType: UsedReceiptIdsIntervals,
 }
 DEFAULT_USED_RECEIPT_IDS_BACKEND = USED_RECEIPT_IDS_BACKENDS[
         utils.clusterStateReceiptIDsBackend()]
 
+def _needRestoreReceiptAfter(secondToLastReceiptJWS, lastReceiptJWS):
+    stl = None
+    if secondToLastReceiptJWS:
+        stl, prefix = receipt.CompactReceipt.fromJWSString(
+                secondToLastReceiptJWS, False)
+    last, prefix = receipt.CompactReceipt.fromJWSString(lastReceiptJWS, False)
+
+    return bool(not last.isSignedBroken() and stl and (not last.isNull() or
+            last.isDummy() or last.isReversal()) and stl.isSignedBroken())
+
 class CashRegisterState(object):
     """
     An object holding the state of a cash register. This allows for the
@@ -359,6 +956,26 @@ class CashRegisterState(object):
 
         return ret
 
+    @staticmethod
+    def fromBoundaryReceipts(startReceiptJWS, secondToLastReceiptJWS,
+            lastReceiptJWS):
+        """
+        Creates the state of a cash register after the given receipts
+        assuming that they are valid. The turnover counter is not restored.
+        :param startReceiptJWS: The start receipt of the cash register as a
+        JWS string.
+        :param secondToLastReceiptJWS: The receipt preceding the last receipt
+        as a JWS string or None if there is none.
+        :param lastReceiptJWS: The last receipt as a JWS string.
+        :return: The new CashRegisterState object.
+        """
+        ret = CashRegisterState()
+        ret.startReceiptJWS = startReceiptJWS
+        ret.lastReceiptJWS = lastReceiptJWS
+        ret.needRestoreReceipt = _needRestoreReceiptAfter(
+                secondToLastReceiptJWS, lastReceiptJWS)
+        return ret
+
     @staticmethod
     def fromDEPGroup(old, group, key = None):
         new = copy.copy(old)
@@ -374,17 +991,8 @@ class CashRegisterState(object):
         else:
             secondToLastReceiptJWS = depparser.expandDEPReceipt(group[-2])
 
-        stl = None
-        if secondToLastReceiptJWS:
-            stl, prefix = receipt.Receipt.fromJWSString(secondToLastReceiptJWS)
-        last, prefix = receipt.Receipt.fromJWSString(
-                depparser.expandDEPReceipt(group[-1]))
-
-        if not last.isSignedBroken() and stl and (not last.isNull() or
-                last.isDummy() or last.isReversal()) and stl.isSignedBroken():
-            self.needRestoreReceipt = True
-        else:
-            self.needRestoreReceipt = False
+        self.needRestoreReceipt = _needRestoreReceiptAfter(
+                secondToLastReceiptJWS, depparser.expandDEPReceipt(group[-1]))
 
         if not self.startReceiptJWS:
             self.startReceiptJWS = depparser.expandDEPReceipt(group[0])
@@ -398,8 +1006,8 @@ class CashRegisterState(object):
 
         reversals = list()
         for i in range(len(group) - 1, -1, -1):
-            ro, prefix = receipt.Receipt.fromJWSString(
-                depparser.expandDEPReceipt(group[i]))
+            ro, prefix = receipt.CompactReceipt.fromJWSString(
+                depparser.expandDEPReceipt(group[i]), False)
             if (not ro.isDummy()) and (not ro.isReversal()):
                 alg = algorithms.ALGORITHMS[prefix]
                 self.lastTurnoverCounter = ro.decryptTurnoverCounter(key, alg)
@@ -408,8 +1016,7 @@ class CashRegisterState(object):
                 reversals.insert(0, ro)
 
         for ro in reversals:
-            self.lastTurnoverCounter += int(round(
-                (ro.sumA + ro.sumB + ro.sumC + ro.sumD + ro.sumE) * 100))
+            self.lastTurnoverCounter += ro.sumCents()
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -432,6 +1039,9 @@ class ClusterState(object):
             initChainNextTo = None, initReceiptJWS = None):
         self.cashRegisters = list()
         self.usedReceiptIds = usedRecIdsBackend()
+        # The number of cash registers before the current transaction or
+        # None.
+        self._txNumRegisters = None
 
         if initReceiptJWS or initChainNextTo:
             self.addNewCashRegister()
@@ -448,8 +1058,7 @@ class ClusterState(object):
         dummyLastTC = 0
         if key and not rec.isDummy() and not rec.isReversal():
             curTC = rec.decryptTurnoverCounter(key, algorithm)
-            dummyLastTC = curTC - int(round((rec.sumA + rec.sumB + rec.sumC
-                + rec.sumD + rec.sumE) * 100))
+            dummyLastTC = curTC - rec.sumCents()
 
         dummyChain = base64.b64encode("DUMMY000".encode('utf-8'))
         dummyRec = receipt.Receipt(rec.zda, rec.registerId, "dummyrec",
@@ -494,6 +1103,10 @@ class ClusterState(object):
         copy of the set of used receipt IDs.
         :throws InvalidCashRegisterIndexException
         """
+        prev, rState = self._cashRegisterInfo(registerIdx)
+        return prev, rState, copy.deepcopy(self.usedReceiptIds)
+
+    def _cashRegisterInfo(self, registerIdx):
         if registerIdx is None or registerIdx == len(self.cashRegisters):
             registerIdx = len(self.cashRegisters)
             self.addNewCashRegister()
@@ -504,9 +1117,53 @@ class ClusterState(object):
         if registerIdx > 0:
             prev = self.cashRegisters[registerIdx - 1].startReceiptJWS
 
-        return prev, copy.copy(
-                self.cashRegisters[registerIdx]), copy.deepcopy(
-                        self.usedReceiptIds)
+        return prev, copy.copy(self.cashRegisters[registerIdx])
+
+    def begin(self, registerIdx):
+        """
+        Like getCashRegisterInfo() but returns the used receipt IDs of the
+        cluster state itself instead of a copy. The IDs added to them are
+        removed again if the verification fails and rollback() is called.
+        Either commit() or rollback() has to be called afterwards.
+        :param registerIdx: The index of the cash register or None if a new
+        one should be added.
+        :return: The start receipt of the previous cash register in JWS
+        format or None, if registerIdx equals zero, a copy of the state
+        of the specified cash register as CashRegisterState object and the
+        used receipt IDs.
+        :throws InvalidCashRegisterIndexException
+        :throws NoStartReceiptForLastCashRegisterException
+        """
+        numRegisters = len(self.cashRegisters)
+        prev, rState = self._cashRegisterInfo(registerIdx)
+        self.usedReceiptIds.begin()
+        self._txNumRegisters = numRegisters
+        return prev, rState, self.usedReceiptIds
+
+    def commit(self, registerIdx, newRegisterState):
+        """
+        Ends the transaction started with begin() after the DEP has been
+        verified and updates the state of the cash register.
+        :param registerIdx: The index of the cash register or None if the
+        last one should be updated.
+        :param newRegisterState: The updated state of the cash register as
+        a CashRegisterState object.
+        :throws InvalidCashRegisterIndexException
+        """
+        self.updateCashRegisterInfo(registerIdx, newRegisterState,
+                self.usedReceiptIds)
+        self.usedReceiptIds.commit()
+        self._txNumRegisters = None
+
+    def rollback(self):
+        """
+        Ends the transaction started with begin() after the verification
+        failed. The used receipt IDs and the list of cash registers are
+        restored.
+        """
+        self.usedReceiptIds.rollback()
+        del self.cashRegisters[self._txNumRegisters:]
+        self._txNumRegisters = None
 
     def updateCashRegisterInfo(self, registerIdx, newRegisterState,
             newUsedReceiptIds):
@@ -25,16 +25,30 @@ from builtins import range
 from .gettext_helper import _
 
 import base64
+import collections
+import copy
+import functools
+import os
+import threading
 
 from itertools import groupby
 from math import ceil
 from six import string_types
-from types import MethodType
+from six.moves import queue
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 
 from . import algorithms
+from . import cert_cache
 from . import depparser
 from . import key_store
 from . import receipt
+from . import receipt_columns
+from . import shared_chunks
+from . import signature_cache
 from . import utils
 from . import verification_state
 from . import verify_receipt
@@ -235,6 +249,16 @@ class NonstandardTypeOnInitialReceiptException(DEPReceiptException):
                 _("Initial receipt is a dummy or reversal receipt."))
         self._initargs = (rec,)
 
+class VerificationCancelledException(utils.RKSVException):
+    """
+    Indicates that the verification of a package was cancelled because a
+    preceding package failed. It is never raised by verifyParsedDEP().
+    """
+    def __init__(self):
+        super(VerificationCancelledException, self).__init__(
+                _("Verification cancelled."))
+        self._initargs = ()
+
 def verifyChainValue(rec, chainingValue):
     if chainingValue != rec.previousChain:
         raise ChainingException(rec.receiptId, rec.previousChain)
@@ -253,7 +277,22 @@ def verifyChain(rec, prev, algorithm):
     chainingValue = base64.b64encode(chainingValue)
     verifyChainValue(rec, chainingValue.decode('utf-8'));
 
-def verifyCert(cert, chain, keyStore):
+def verifyChainRaw(rec, recChainingValue, prev, algorithm):
+    """
+    Like verifyChain() but compares the chaining value as bytes instead of
+    its base64 representation.
+    :param rec: The new receipt as a receipt object.
+    :param recChainingValue: The decoded chaining value of the new receipt
+    as a byte list or None if it is not canonically encoded.
+    :param prev: The previous receipt as a JWS string or None if this is
+    the first receipt.
+    :param algorithm: The algorithm class to use.
+    :throws: ChainingException
+    """
+    if algorithm.chain(rec, prev) != recChainingValue:
+        raise ChainingException(rec.receiptId, rec.previousChain)
+
+def verifyCert(cert, chain, keyStore, certCache = None):
     """
     Verifies that a certificate or one of its signers is in the given key store.
     Returns nothing on success and throws an exception otherwise.
@@ -261,10 +300,24 @@ def verifyCert(cert, chain, keyStore):
     :param chain: A list of certificates as objects. These represent the
     signing chain for the certificate.
     :param keyStore: The key store.
+    :param certCache: A cert_cache.CertificateChainCache bound to keyStore or
+    None. Chains found in the cache are not verified again, successfully
+    verified chains are added to it.
     :throws: UntrustedCertificateException
     :throws: CertificateSerialCollisionException
     :throws: CertificateChainBrokenException
     """
+    if certCache is None:
+        _verifyCert(cert, chain, keyStore)
+        return
+
+    chainKey = certCache.chainKey(cert, chain)
+    if certCache.isVerified(chainKey):
+        return
+    _verifyCert(cert, chain, keyStore)
+    certCache.addVerified(chainKey)
+
+def _verifyCert(cert, chain, keyStore):
     prev = cert
 
     for c in chain:
@@ -296,13 +349,71 @@ def verifyCert(cert, chain, keyStore):
     raise UntrustedCertificateException(key_store.numSerialToKeyId(
         cert.serial_number))
 
+SIGNATURE_BATCH_SIZE = 64
+
+_signatureExecutor = None
+
+def getSignatureExecutor():
+    """
+    Gets the thread pool that verifyGroup() uses to verify the signatures of
+    a group in parallel. The number of threads is determined by
+    utils.verifySignatureThreads(). Each process gets its own pool.
+    :return: A ThreadPoolExecutor or None if signatures should be verified
+    in the calling thread (or concurrent.futures is not available).
+    """
+    global _signatureExecutor
+    nthreads = utils.verifySignatureThreads()
+    if nthreads < 2 or ThreadPoolExecutor is None:
+        return None
+
+    pid = os.getpid()
+    if _signatureExecutor is None or _signatureExecutor[:2] != (pid,
+            nthreads):
+        # An executor inherited from the parent process has no threads.
+        _signatureExecutor = (pid, nthreads, ThreadPoolExecutor(nthreads))
+    return _signatureExecutor[2]
+
+def _verifySignatureSlice(rv, receipts, prefixes, start, end):
+    results = list()
+    for i in range(start, end):
+        try:
+            results.append(rv.verify(receipts[i], prefixes[i]) + (None,))
+        except Exception as e:
+            results.append((receipts[i], None, e))
+    return results
+
+def verifySignatures(executor, rv, receipts, prefixes):
+    """
+    Calls rv.verify() for each receipt on the threads of the given executor.
+    Since the signature checks release the GIL, this uses multiple cores.
+    :param executor: The ThreadPoolExecutor to use.
+    :param rv: The receipt verifier object.
+    :param receipts: The receipts as a list of receipt objects.
+    :param prefixes: The algorithm prefix of each receipt as a list.
+    :return: A list with a tuple for each receipt containing the receipt
+    object and the algorithm class returned by rv.verify() and None, or the
+    receipt object, None and the exception raised by rv.verify().
+    """
+    futures = [ executor.submit(_verifySignatureSlice, rv, receipts,
+        prefixes, start, min(start + SIGNATURE_BATCH_SIZE, len(receipts)))
+        for start in range(0, len(receipts), SIGNATURE_BATCH_SIZE) ]
+    return [ res for f in futures for res in f.result() ]
+
+def _signatureResult(result):
+    ro, algorithm, e = result
+    if e is not None:
+        raise e
+    return ro, algorithm
+
 def verifyGroup(group, rv, key, prevStartReceiptJWS, cashRegisterState,
         usedReceiptIds):
     """
     Verifies a group of receipts from a DEP. It checks if the signature of
     each receipt is valid, if the receipts are properly chained and if
     receipts with zero turnover are present as required. If a key is
-    specified it also verifies the turnover counter.
+    specified it also verifies the turnover counter. If
+    getSignatureExecutor() returns a thread pool, the signatures are
+    verified on it before the other checks.
     :param group: The receipts in the group as a list of compressed JWS strings
     as returned by a parser conforming to depparser.DEPParserI.
     :param rv: The receipt verifier object used to verify single receipts.
@@ -350,34 +461,71 @@ def verifyGroup(group, rv, key, prevStartReceiptJWS, cashRegisterState,
     prev = cashRegisterState.lastReceiptJWS
     prevObj = None
     if prev:
-        prevObj, algorithmPrefix = receipt.Receipt.fromJWSString(prev)
-    for cr in group:
-        r = depparser.expandDEPReceipt(cr)
-        ro = None
+        prevObj, algorithmPrefix = receipt.CompactReceipt.fromJWSString(prev)
+    cols = receipt_columns.ReceiptColumns.fromDEPGroup(group)
+
+    # The checks that only compare a receipt to its predecessor are done for
+    # the entire group at once. The loop below raises the exceptions once
+    # it reaches the offending receipt so that the order of the checks is
+    # preserved.
+    restoreIdx, needRestoreReceipt = cols.firstRestoreReceiptViolation(
+            prevObj, cashRegisterState.needRestoreReceipt)
+    cmpObj = prevObj
+    if not prevObj and prevStartReceiptJWS:
+        try:
+            cmpObj, algorithmPrefix = receipt.CompactReceipt.fromJWSString(
+                    prevStartReceiptJWS)
+        except utils.RKSVVerifyException:
+            # This is raised again in the loop.
+            cmpObj = None
+    registerIdIdx, systemTypeIdx, dateIdx = cols.firstStructureViolations(
+            cmpObj)
+
+    # The turnover counters are only checked in bulk if the key is valid for
+    # all receipts. Otherwise the loop raises an InvalidKeyException at the
+    # first receipt that needs the key.
+    turnoverIdx = None
+    lastTurnoverCounter = None
+    if key is not None and all(algorithms.ALGORITHMS[p].verifyKey(key)
+            for p in set(cols.prefixes)):
+        turnoverIdx, lastTurnoverCounter = \
+                cols.firstTurnoverCounterViolation(
+                        cashRegisterState.lastTurnoverCounter,
+                        cols.decryptTurnoverCounters(key))
+
+    # The signatures can be verified independently of each other. The
+    # results (and exceptions) are then used by the loop in order.
+    signatures = None
+    executor = getSignatureExecutor()
+    if executor is not None and cols.size > SIGNATURE_BATCH_SIZE:
+        signatures = verifySignatures(executor, rv, cols.receipts,
+                cols.prefixes)
+
+    for i in range(len(group)):
+        if i == cols.size:
+            raise cols.error
+        r = cols.jwss[i]
+        ro = cols.receipts[i]
         algorithm = None
         try:
-            ro, algorithm = rv.verifyJWS(r)
-            if prevObj and (not ro.isNull() or ro.isDummy() or ro.isReversal()):
-                if cashRegisterState.needRestoreReceipt:
-                    raise NoRestoreReceiptAfterSignatureSystemFailureException(ro.receiptId)
-                if prevObj.isSignedBroken():
-                    cashRegisterState.needRestoreReceipt = True
+            if signatures is None:
+                ro, algorithm = rv.verify(ro, cols.prefixes[i])
             else:
-                cashRegisterState.needRestoreReceipt = False
+                ro, algorithm = _signatureResult(signatures[i])
         except verify_receipt.SignatureSystemFailedException as e:
             pass
         except verify_receipt.UnsignedNullReceiptException as e:
             pass
 
         # Exception occured and was caught
-        if not ro:
-            ro, algorithmPrefix = receipt.Receipt.fromJWSString(r)
+        if not algorithm:
             if not prevObj:
                 raise SignatureSystemFailedOnInitialReceiptException(ro.receiptId)
-            if cashRegisterState.needRestoreReceipt:
-                raise NoRestoreReceiptAfterSignatureSystemFailureException(ro.receiptId)
             # fromJWSString() already raises an UnknownAlgorithmException if necessary
-            algorithm = algorithms.ALGORITHMS[algorithmPrefix]
+            algorithm = algorithms.ALGORITHMS[cols.prefixes[i]]
+
+        if i == restoreIdx:
+            raise NoRestoreReceiptAfterSignatureSystemFailureException(ro.receiptId)
 
         if not prevObj:
             if not ro.isNull():
@@ -390,7 +538,7 @@ def verifyGroup(group, rv, key, prevStartReceiptJWS, cashRegisterState,
                 if ro.zda != 'AT0':
                     raise ClusterInOpenSystemException()
                 prev = prevStartReceiptJWS
-                prevObj, algorithmPrefix = receipt.Receipt.fromJWSString(prev)
+                prevObj, algorithmPrefix = receipt.CompactReceipt.fromJWSString(prev)
                 if prevObj.zda != 'AT0':
                     raise ClusterInOpenSystemException()
 
@@ -398,16 +546,15 @@ def verifyGroup(group, rv, key, prevStartReceiptJWS, cashRegisterState,
 
         if prevObj:
             usedReceiptIds.check(ro.receiptId)
-            if prevObj.registerId != ro.registerId:
+            if i == registerIdIdx:
                 raise ChangingRegisterIdException(ro.receiptId)
-            if (prevObj.zda == 'AT0' and ro.zda != 'AT0') or (
-                    prevObj.zda != 'AT0' and ro.zda == 'AT0'):
+            if i == systemTypeIdx:
                 raise ChangingSystemTypeException(ro.receiptId)
             # These checks are not necessary according to:
             # https://github.com/BMF-RKSV-Technik/at-registrierkassen-mustercode/issues/144#issuecomment-255786335
             # However, the current (v1.1.1) BMF tool enforces this anyway so we
             # will too.
-            if prevObj.dateTime > ro.dateTime:
+            if i == dateIdx:
                 raise DecreasingDateException(ro.receiptId)
 
         usedReceiptIds.add(ro.receiptId)
@@ -417,7 +564,7 @@ def verifyGroup(group, rv, key, prevStartReceiptJWS, cashRegisterState,
                 verifyChainValue(ro, cashRegisterState.chainNextTo)
                 cashRegisterState.chainNextTo = None
             else:
-                verifyChain(ro, prev, algorithm)
+                verifyChainRaw(ro, cols.chainingValues[i], prev, algorithm)
         except ChainingException as e:
             # Special exception for the initial receipt
             if cashRegisterState.startReceiptJWS == r:
@@ -429,18 +576,16 @@ def verifyGroup(group, rv, key, prevStartReceiptJWS, cashRegisterState,
         if not ro.isDummy():
             if key is not None:
                 utils.raiseForKey(key, algorithm)
-                newC = cashRegisterState.lastTurnoverCounter + int(round(
-                    (ro.sumA + ro.sumB + ro.sumC + ro.sumD + ro.sumE) * 100))
-                if not ro.isReversal():
-                    turnoverCounter = ro.decryptTurnoverCounter(key, algorithm)
-                    if turnoverCounter != newC:
-                        raise InvalidTurnoverCounterException(ro.receiptId)
-                cashRegisterState.lastTurnoverCounter = newC
+                if i == turnoverIdx:
+                    raise InvalidTurnoverCounterException(ro.receiptId)
 
         prev = r
         prevObj = ro
 
     cashRegisterState.lastReceiptJWS = prev
+    cashRegisterState.needRestoreReceipt = needRestoreReceipt
+    if lastTurnoverCounter is not None:
+        cashRegisterState.lastTurnoverCounter = lastTurnoverCounter
     return cashRegisterState, usedReceiptIds
 
 def verifyGroupsWithVerifiers(groups, key, prevStart, rState, usedRecIds):
@@ -536,23 +681,62 @@ def balanceGroupsWithVerifiers(groups, nprocs):
 
     return pkgs
 
-def packageChunkWithVerifiers(chunk, keyStore):
+def splitGroupsWithVerifiers(groups, packageSize):
+    """
+    Splits a list of tuples with lists of receipts and their according
+    ReceiptVerifiers into packages of at most packageSize receipts each,
+    keeping the order of the receipts. Unlike balanceGroupsWithVerifiers(),
+    the number of packages depends on the number of receipts.
+    :param groups: The list of tuples. The first element of each tuple is a
+    list of receipts as returned by a parser conforming to
+    depparser.DEPParserI, the second element is a ReceiptVerifier object
+    intented to verify all receipts in the list.
+    :param packageSize: The maximum number of receipts in a package or zero
+    to return all groups as one package.
+    :return: A generator yielding the packages. Each package in turn
+    contains a list structured like the groups parameter.
+    """
+    if packageSize <= 0:
+        yield groups
+        return
+
+    pkg = list()
+    size = 0
+    for recs, rv in groups:
+        start = 0
+        while start < len(recs):
+            end = start + packageSize - size
+            pkg.append((recs[start:end], rv))
+            size += len(pkg[-1][0])
+            start = end
+            if size >= packageSize:
+                yield pkg
+                pkg = list()
+                size = 0
+
+    if len(pkg) > 0:
+        yield pkg
+
+def packageChunkWithVerifiers(chunk, keyStore, certCache = None,
+        signatureCache = None):
     groupsWithVerifiers = list()
     if len(chunk) == 1:
         recs, cert, chain = chunk[0]
         if not cert:
-            rv = verify_receipt.ReceiptVerifier.fromKeyStore(keyStore)
+            rv = verify_receipt.ReceiptVerifier.fromKeyStore(keyStore,
+                    signatureCache)
         else:
-            verifyCert(cert, chain, keyStore)
-            rv = verify_receipt.ReceiptVerifier.fromCert(cert)
+            verifyCert(cert, chain, keyStore, certCache)
+            rv = verify_receipt.ReceiptVerifier.fromCert(cert,
+                    signatureCache)
 
         groupsWithVerifiers.append((recs, rv))
     else:
         for recs, cert, chain in chunk:
             if not cert:
                 raise NoCertificateGivenException()
-            verifyCert(cert, chain, keyStore)
-            rv = verify_receipt.ReceiptVerifier.fromCert(cert)
+            verifyCert(cert, chain, keyStore, certCache)
+            rv = verify_receipt.ReceiptVerifier.fromCert(cert, signatureCache)
             groupsWithVerifiers.append((recs, rv))
     return groupsWithVerifiers
 
@@ -568,26 +752,713 @@ def getChunksForProcs(allChunks, nprocs):
     if len(ret) > 0:
         yield ret
 
+def speculateCashRegisterState(groups, key, startReceiptJWS,
+        secondToLastReceiptJWS, lastReceiptJWS):
+    """
+    Derives the state of a cash register before the given groups from the
+    two receipts preceding them, assuming that all preceding receipts are
+    valid. If a key is given, the turnover counter is derived from the
+    first receipt in the groups with an encrypted turnover counter.
+    :param groups: The groups as a list of tuples of receipts and their
+    ReceiptVerifier as passed to verifyGroupsWithVerifiers().
+    :param key: The key used to decrypt the turnover counter as a byte list
+    or None.
+    :param startReceiptJWS: The start receipt of the cash register as a JWS
+    string.
+    :param secondToLastReceiptJWS: The second to last receipt preceding the
+    groups as a JWS string or None if there is none.
+    :param lastReceiptJWS: The last receipt preceding the groups as a JWS
+    string.
+    :return: The derived state as a CashRegisterState object and whether
+    the verification of the groups depends on the turnover counter in it.
+    """
+    rState = verification_state.CashRegisterState.fromBoundaryReceipts(
+            startReceiptJWS, secondToLastReceiptJWS, lastReceiptJWS)
+    if key is None:
+        return rState, False
+
+    turnover = 0
+    for recs, rv in groups:
+        for r in recs:
+            try:
+                ro, prefix = receipt.CompactReceipt.fromJWSString(
+                        depparser.expandDEPReceipt(r))
+            except Exception:
+                # verifyGroup() raises this again before it needs the
+                # turnover counter.
+                return rState, False
+
+            if ro.isDummy():
+                continue
+            turnover += ro.sumCents()
+            if ro.isReversal():
+                continue
+
+            algorithm = algorithms.ALGORITHMS[prefix]
+            if not algorithm.verifyKey(key):
+                return rState, False
+            rState.lastTurnoverCounter = ro.decryptTurnoverCounter(key,
+                    algorithm) - turnover
+            return rState, True
+
+    return rState, False
+
+CANCEL_CHECK_INTERVAL = 1000
+
+def verifyGroupsSpeculatively(groups, key, prevStart, rState, boundary,
+        usedRecIds, isCancelled = None):
+    """
+    Calls verifyGroupsWithVerifiers() for the given groups. If boundary is
+    given, the state of the cash register before the groups is derived
+    with speculateCashRegisterState() instead of being passed in. Any
+    exception raised during the verification is returned rather than
+    raised so that the caller can decide if it is relevant.
+    :param groups: The groups as passed to verifyGroupsWithVerifiers().
+    :param key: The key used to decrypt the turnover counter as a byte list
+    or None.
+    :param prevStart: The start receipt (in JWS format) of the previous
+    cash register in the GGS cluster or None.
+    :param rState: State of the cash register before the groups as a
+    CashRegisterState object or None if boundary is given.
+    :param boundary: A tuple of the start receipt of the cash register and
+    the two receipts preceding the groups as passed to
+    speculateCashRegisterState() or None.
+    :param usedRecIds: An empty used receipt IDs backend.
+    :param isCancelled: A function without arguments returning True if the
+    verification should be stopped or None. It is called before every
+    CANCEL_CHECK_INTERVAL receipts. A stopped verification returns a
+    VerificationCancelledException.
+    :return: The derived state of the cash register before the groups (or
+    None if boundary is None), whether the verification depends on the
+    derived turnover counter, the state after the groups, the used receipt
+    IDs and the exception raised during the verification (or None).
+    """
+    specRState = None
+    dependsOnCounter = False
+    try:
+        if boundary is not None:
+            rState, dependsOnCounter = speculateCashRegisterState(groups,
+                    key, *boundary)
+            specRState = copy.copy(rState)
+        if isCancelled is None:
+            rState, usedRecIds = verifyGroupsWithVerifiers(groups, key,
+                    prevStart, rState, usedRecIds)
+        else:
+            for part in splitGroupsWithVerifiers(groups,
+                    CANCEL_CHECK_INTERVAL):
+                if isCancelled():
+                    raise VerificationCancelledException()
+                rState, usedRecIds = verifyGroupsWithVerifiers(part, key,
+                        prevStart, rState, usedRecIds)
+    except Exception as e:
+        return specRState, dependsOnCounter, None, None, e
+
+    return specRState, dependsOnCounter, rState, usedRecIds, None
+
+def verifyGroupsSpeculativelyTuple(args):
+    """
+    This function is used as an adapter for the process pool's map()
+    function. It simply calls verifyGroupsSpeculatively with the arguments
+    given in the args tuple. The last element of the tuple is the
+    SharedCutoff object and the sequence number of the package or None.
+    """
+    isCancelled = _cancellationCheck(args[-1])
+    if isCancelled is not None and isCancelled():
+        return None, False, None, None, VerificationCancelledException()
+    with shared_chunks.loadGroups(args[0]) as groups:
+        return verifyGroupsSpeculatively(groups, *args[1:-1],
+                isCancelled=isCancelled)
+
+def _cancellationCheck(cancellation):
+    if cancellation is None:
+        return None
+    cutoff, seq = cancellation
+    return lambda: cutoff.isCancelled(seq)
+
+class VerificationWorkerContext(object):
+    """
+    The data a worker process needs to verify packages that stays the same
+    for all packages of a DEP. The ReceiptVerifier for each certificate is
+    only created once per worker and then reused.
+    """
+
+    def __init__(self, keyStore, key, signatureCache = None):
+        """
+        Creates a new worker context.
+        :param keyStore: The key store object containing the used public keys
+        and certificates.
+        :param key: The key used to decrypt the turnover counter as a byte
+        list or None.
+        :param signatureCache: The signature_cache.SignatureCacheI object
+        used by the verifiers or None.
+        """
+        self.keyStore = keyStore
+        self.key = key
+        self.signatureCache = signatureCache
+        self.verifiers = dict()
+
+    def getVerifier(self, certDER):
+        """
+        Gets the ReceiptVerifier for the given certificate.
+        :param certDER: The certificate as DER byte list or None to verify the
+        receipts with the key store.
+        :return: The ReceiptVerifier object.
+        """
+        rv = self.verifiers.get(certDER)
+        if rv is None:
+            if certDER is None:
+                rv = verify_receipt.ReceiptVerifier.fromKeyStore(
+                        self.keyStore, self.signatureCache)
+            else:
+                rv = verify_receipt.ReceiptVerifier.fromCert(
+                        utils.loadCertDER(certDER), self.signatureCache)
+            self.verifiers[certDER] = rv
+        return rv
+
+_workerContext = None
+
+def initVerificationWorker(keyStore, key, signatureCacheFile = None,
+        signatureCacheCounters = None):
+    """
+    Installs the key store and the key in a worker process. This is intended
+    to be used as the initializer of the process pool passed to
+    verifyParsedDEP() with poolInitialized set to True.
+    :param keyStore: The key store object containing the used public keys
+    and certificates.
+    :param key: The key used to decrypt the turnover counter as a byte list
+    or None.
+    :param signatureCacheFile: The file of a
+    signature_cache.SQLiteSignatureCache the worker should use or None.
+    :param signatureCacheCounters: The hit and miss counters shared by the
+    signature caches of all workers or None.
+    """
+    global _workerContext
+    sigCache = None
+    if signatureCacheFile:
+        sigCache = signature_cache.SQLiteSignatureCache(signatureCacheFile,
+                signatureCacheCounters)
+    _workerContext = VerificationWorkerContext(keyStore, key, sigCache)
+
+def verifyGroupsInWorkerTuple(args):
+    """
+    This function is used as an adapter for the process pool's map()
+    function in a worker initialized with initVerificationWorker(). The
+    args tuple is like the one for verifyGroupsSpeculativelyTuple() except
+    that the groups contain the DER certificates (or None) instead of
+    ReceiptVerifier objects and that the key is missing.
+    """
+    groups, prevStart, rState, boundary, usedRecIds, cancellation = args
+    if _workerContext is None:
+        raise Exception(_('THIS IS A BUG'))
+
+    isCancelled = _cancellationCheck(cancellation)
+    if isCancelled is not None and isCancelled():
+        return None, False, None, None, VerificationCancelledException()
+    try:
+        with shared_chunks.loadGroups(groups) as groups:
+            groups = [ (recs, _workerContext.getVerifier(certDER))
+                    for recs, certDER in groups ]
+            return verifyGroupsSpeculatively(groups, _workerContext.key,
+                    prevStart, rState, boundary, usedRecIds, isCancelled)
+    finally:
+        # Worker processes are usually terminated without notice.
+        if _workerContext.signatureCache is not None:
+            _workerContext.signatureCache.commit()
+
+def shardVerificationResultTuple(func, nshards, args):
+    """
+    This function is used as an adapter for the process pool's map()
+    function with func and nshards bound by functools.partial(). It calls
+    func (verifyGroupsSpeculativelyTuple() or verifyGroupsInWorkerTuple())
+    with args and replaces the used receipt IDs in the result with a
+    shared_chunks.SharedIdShards object holding them split into nshards
+    shards, so they are not pickled back. The caller has to free the shards.
+    """
+    result = func(args)
+    if result[3] is None:
+        return result
+    return result[:3] + (_shardReceiptIds(result[3], nshards),) + result[4:]
+
+def _shardReceiptIds(usedRecIds, nshards):
+    return _storeShards(usedRecIds.shard(nshards))
+
+def _storeShards(shards):
+    idShards, segments = shared_chunks.SharedIdShards.fromShards(shards)
+    for shm in segments:
+        shm.close()
+    return idShards
+
+def _moveToSharedMemory(wargs):
+    """
+    Replaces the groups in the given arguments with SharedGroups objects.
+    :return: The new arguments and the created shared memory segments.
+    """
+    ret = list()
+    segments = list()
+    try:
+        for args in wargs:
+            groups, shm = shared_chunks.SharedGroups.fromGroups(args[0])
+            segments.append(shm)
+            ret.append((groups,) + tuple(args[1:]))
+    except:
+        shared_chunks.free(segments)
+        raise
+    return ret, segments
+
+def _stripForWorker(wargs):
+    """
+    Replaces the ReceiptVerifier objects in the arguments for
+    verifyGroupsSpeculativelyTuple() with their DER certificates and removes
+    the key.
+    """
+    ret = list()
+    for groups, key, prevStart, rState, boundary, usedRecIds, c in wargs:
+        groups = [ (recs, None if rv.cert is None else
+            utils.exportCertToDER(rv.cert)) for recs, rv in groups ]
+        ret.append((groups, prevStart, rState, boundary, usedRecIds, c))
+    return ret
+
+def _boundaryAfter(boundary, groups):
+    """
+    Updates the last two receipts in boundary with the ones in groups.
+    """
+    recs = [ r for group, rv in groups[-2:] for r in group[-2:] ]
+    if len(recs) == 0:
+        return boundary
+    if len(recs) == 1:
+        return boundary[1], depparser.expandDEPReceipt(recs[0])
+    return (depparser.expandDEPReceipt(recs[-2]),
+            depparser.expandDEPReceipt(recs[-1]))
+
 def prepareVerificationTuples(chunksWithVerifiers, key, prevStartJWS,
-        cashregState, usedRecIdsBackend):
-    # create start cashreg state for each package
-    npkgs = len(chunksWithVerifiers)
-    pkgRStates = [cashregState]
-    pkgRState = cashregState
+        cashregState, startJWS, boundary, usedRecIdsBackend,
+        cancellation = None):
+    """
+    Creates the arguments for verifyGroupsSpeculatively() for each package.
+    Only the first package is passed cashregState, the other ones derive
+    their state from the receipts preceding them. Note that this only
+    touches the last receipts of each package.
+    :param chunksWithVerifiers: The packages as a list of lists of groups.
+    :param key: The key used to decrypt the turnover counter as a byte list
+    or None.
+    :param prevStartJWS: The start receipt (in JWS format) of the previous
+    cash register in the GGS cluster or None.
+    :param cashregState: The state of the cash register before the first
+    package or None if it is not known yet.
+    :param startJWS: The start receipt of the cash register as a JWS string
+    or None if the first package contains it.
+    :param boundary: The two receipts preceding the first package as a tuple
+    of JWS strings (or None).
+    :param usedRecIdsBackend: The implementation used to keep track of used
+    receipt IDs.
+    :param cancellation: The SharedCutoff object and the sequence number of
+    the first package as a tuple or None. The sequence number is incremented
+    for each following package.
+    :return: The list of argument tuples, the start receipt and the two
+    receipts following the last package.
+    """
+    wargs = list()
     for pkg in chunksWithVerifiers:
-        for group, rv in pkg:
-            pkgRState = verification_state.CashRegisterState.fromDEPGroup(
-                    pkgRState, group, key)
-        pkgRStates.append(pkgRState)
-    del pkgRStates[-1]
+        if cashregState is not None:
+            wargs.append((pkg, key, prevStartJWS, cashregState, None,
+                usedRecIdsBackend(), cancellation))
+            cashregState = None
+        else:
+            wargs.append((pkg, key, prevStartJWS, None,
+                (startJWS,) + boundary, usedRecIdsBackend(), cancellation))
+        if cancellation is not None:
+            cancellation = (cancellation[0], cancellation[1] + 1)
+
+        if not startJWS:
+            startJWS = depparser.expandDEPReceipt(pkg[0][0][0])
+        boundary = _boundaryAfter(boundary, pkg)
+
+    return wargs, startJWS, boundary
+
+def _reconcileResult(pkg, result, key, prevStartJWS, cashregState,
+        usedRecIdsBackend):
+    """
+    Checks that a package verified by verifyGroupsSpeculatively() joins the
+    given state and verifies it again if it does not, see
+    reconcileVerificationResults().
+    :return: The state of the cash register after the package and the used
+    receipt IDs of the package.
+    """
+    specRState, dependsOnCounter, outRState, outUsedRecIds, error = result
+    if isinstance(error, VerificationCancelledException) or (
+            specRState is not None and not _joins(cashregState,
+                specRState, dependsOnCounter)):
+        outRState, outUsedRecIds = verifyGroupsWithVerifiers(pkg, key,
+                prevStartJWS, cashregState, usedRecIdsBackend())
+    elif error is not None:
+        raise error
+    elif specRState is not None:
+        outRState.lastTurnoverCounter += cashregState.lastTurnoverCounter \
+                - specRState.lastTurnoverCounter
+
+    return outRState, outUsedRecIds
+
+def reconcileVerificationResults(chunksWithVerifiers, results, key,
+        prevStartJWS, cashregState, usedRecIds):
+    """
+    Checks that the packages verified by verifyGroupsSpeculatively() join
+    correctly and merges their results. A package whose derived start state
+    does not match the actual state after the preceding package (which can
+    only happen if its first turnover counter is invalid) or whose
+    verification was cancelled is verified again with the actual state.
+    :param chunksWithVerifiers: The packages as a list of lists of groups.
+    :param results: The results of verifyGroupsSpeculatively() for each
+    package.
+    :param key: The key used to decrypt the turnover counter as a byte list
+    or None.
+    :param prevStartJWS: The start receipt (in JWS format) of the previous
+    cash register in the GGS cluster or None.
+    :param cashregState: The state of the cash register before the first
+    package.
+    :param usedRecIds: The used receipt IDs before the first package.
+    :return: The state of the cash register after the last package and the
+    updated usedRecIds.
+    """
+    for pkg, result in zip(chunksWithVerifiers, results):
+        cashregState, outUsedRecIds = _reconcileResult(pkg, result, key,
+                prevStartJWS, cashregState, usedRecIds.__class__)
+        usedRecIds.merge([outUsedRecIds])
+
+    return cashregState, usedRecIds
+
+def reconcileShardedVerificationResults(chunksWithVerifiers, results, key,
+        prevStartJWS, cashregState, usedRecIdsBackend, nshards):
+    """
+    Like reconcileVerificationResults() for results whose used receipt IDs
+    were split into shards by shardVerificationResultTuple(). The receipt
+    IDs are not merged, the shards of each package are returned instead so
+    that they can be merged in the process pool with
+    mergeReceiptIdShardTuple(). The exception raised by a failed package is
+    returned as well, it only counts if none of the preceding packages
+    reuses a receipt ID.
+    :param chunksWithVerifiers: The packages as a list of lists of groups.
+    :param results: The results of shardVerificationResultTuple() for each
+    package.
+    :param key: The key used to decrypt the turnover counter as a byte list
+    or None.
+    :param prevStartJWS: The start receipt (in JWS format) of the previous
+    cash register in the GGS cluster or None.
+    :param cashregState: The state of the cash register before the first
+    package.
+    :param usedRecIdsBackend: The implementation used to keep track of used
+    receipt IDs. It has to be shardable.
+    :param nshards: The number of shards.
+    :return: The state of the cash register after the last package before
+    the failed one, the shared_chunks.SharedIdShards objects of these
+    packages and the exception raised by the failed package or None. The
+    caller has to free the returned shards, the other shards in results are
+    freed already.
+    """
+    idShards = list()
+    error = None
+    for pkg, result in zip(chunksWithVerifiers, results):
+        pkgShards = result[3]
+        if error is None:
+            try:
+                cashregState, outUsedRecIds = _reconcileResult(pkg, result,
+                        key, prevStartJWS, cashregState, usedRecIdsBackend)
+            except Exception as e:
+                error = e
+        if error is None and outUsedRecIds is pkgShards:
+            idShards.append(pkgShards)
+            continue
+
+        if error is None:
+            # The package was verified again.
+            idShards.append(_shardReceiptIds(outUsedRecIds, nshards))
+        if pkgShards is not None:
+            pkgShards.free()
+
+    return cashregState, idShards, error
+
+def mergeReceiptIdShard(idShards, shard):
+    """
+    Checks one shard of the used receipt IDs of consecutive packages for
+    duplicates and unites it. Doing this for all shards is equivalent to
+    merging the used receipt IDs of the packages one after the other.
+    :param idShards: The shared_chunks.SharedIdShards objects of the
+    packages in receipt order.
+    :param shard: The index of the shard.
+    :return: A SharedIdShards object with a single shard containing the
+    receipt IDs of the shard in all packages or None if a receipt ID in the
+    shard is used by more than one package.
+    """
+    merged = set()
+    for pkgShards in idShards:
+        ids = pkgShards.load(shard)
+        if not merged.isdisjoint(ids):
+            return None
+        merged.update(ids)
 
-    return zip(chunksWithVerifiers, [key] * npkgs, [prevStartJWS] * npkgs,
-            pkgRStates, [usedRecIdsBackend()] * npkgs)
+    return _storeShards([ merged ])
+
+def mergeReceiptIdShardTuple(args):
+    """
+    This function is used as an adapter for the process pool's map()
+    function. It simply calls mergeReceiptIdShard with the arguments given
+    in the args tuple.
+    """
+    return mergeReceiptIdShard(*args)
+
+def combineReceiptIdShards(chunksWithVerifiers, idShards, results,
+        usedRecIds):
+    """
+    Combines the results of mergeReceiptIdShard() for all shards, adds the
+    receipt IDs to usedRecIds and frees the merged shards.
+    :param chunksWithVerifiers: The packages as a list of lists of groups.
+    :param idShards: The shared_chunks.SharedIdShards objects of the
+    packages.
+    :param results: The results of mergeReceiptIdShard() for each shard.
+    :param usedRecIds: The receipt IDs used before the first package. The
+    backend has to be shardable.
+    :throws: DuplicateReceiptIdException naming the first receipt in
+    receipt order that reuses a receipt ID. usedRecIds is not changed then.
+    """
+    try:
+        if all(merged is not None for merged in results):
+            try:
+                usedRecIds.addShards([ merged.load(0)
+                    for merged in results ])
+                return
+            except verification_state.DuplicateReceiptIdException:
+                pass
+        raise verification_state.DuplicateReceiptIdException(
+                _firstReusedReceiptId(chunksWithVerifiers, idShards,
+                    usedRecIds))
+    finally:
+        for merged in results:
+            if merged is not None:
+                merged.free()
+
+def _firstReusedReceiptId(chunksWithVerifiers, idShards, usedRecIds):
+    """
+    Goes through the packages one after the other to find the first
+    receipt reusing a receipt ID. Only the receipts of the package
+    containing it are decoded again, in order.
+    :return: The reused receipt ID.
+    """
+    seen = set()
+    for pkg, pkgShards in zip(chunksWithVerifiers, idShards):
+        ids = set()
+        for shard in range(len(pkgShards.names)):
+            ids.update(pkgShards.load(shard))
+        dups = set(rId for rId in ids
+                if rId in seen or _isUsed(usedRecIds, rId))
+        if dups:
+            for recs, rv in pkg:
+                for r in recs:
+                    ro, prefix = receipt.CompactReceipt.fromJWSString(
+                            depparser.expandDEPReceipt(r))
+                    if ro.receiptId in dups:
+                        return ro.receiptId
+        seen.update(ids)
+
+    raise Exception(_('THIS IS A BUG'))
+
+def _isUsed(usedRecIds, receiptId):
+    try:
+        usedRecIds.check(receiptId)
+    except verification_state.DuplicateReceiptIdException:
+        return True
+    return False
+
+class _ShardMerge(object):
+    """
+    The receipt ID shards of consecutive packages being merged in the pool,
+    one task per shard. Each shard is merged exactly once, either with
+    finish() or with discard().
+    """
+
+    def __init__(self, pool, chunksWithVerifiers, idShards, nshards):
+        """
+        Starts the tasks. The shards of the packages belong to the new
+        object once this returns.
+        """
+        self.chunksWithVerifiers = chunksWithVerifiers
+        self.idShards = idShards
+        self.pending = [ pool.apply_async(mergeReceiptIdShardTuple,
+            [ (idShards, shard) ]) for shard in range(nshards) ]
+
+    def ready(self):
+        return all(res.ready() for res in self.pending)
+
+    def finish(self, usedRecIds):
+        """
+        Waits for the tasks, adds the merged receipt IDs to usedRecIds and
+        frees all shards.
+        :throws: DuplicateReceiptIdException
+        """
+        pending, self.pending = self.pending, list()
+        idShards, self.idShards = self.idShards, list()
+        try:
+            results = _successfulResults(pending)
+            if len(results) < len(pending):
+                for merged in results:
+                    if merged is not None:
+                        merged.free()
+                # Raise the exception of the failed task.
+                for res in pending:
+                    res.get()
+
+            combineReceiptIdShards(self.chunksWithVerifiers, idShards,
+                    results, usedRecIds)
+        finally:
+            for pkgShards in idShards:
+                pkgShards.free()
+
+    def discard(self):
+        """
+        Waits for the tasks and frees all shards without adding them
+        anywhere.
+        """
+        pending, self.pending = self.pending, list()
+        idShards, self.idShards = self.idShards, list()
+        for merged in _successfulResults(pending):
+            if merged is not None:
+                merged.free()
+        for pkgShards in idShards:
+            pkgShards.free()
+
+def _successfulResults(pending):
+    for res in pending:
+        res.wait()
+    return [ res.get() for res in pending if res.successful() ]
+
+def _pendingResult(pending, segments):
+    """
+    Waits for the result of a package and frees its shared memory segments.
+    :return: The package and its result.
+    """
+    pkg, res, pkgSegments = pending
+    try:
+        result = res.get()
+    finally:
+        shared_chunks.free(pkgSegments)
+        for shm in pkgSegments:
+            segments.remove(shm)
+
+    return pkg, result
+
+def _stopInFlight(inFlight, cancellation):
+    """
+    Cancels the packages that are still being verified, waits for them and
+    frees their receipt ID shards.
+    """
+    if cancellation is None:
+        return
+
+    # Let the remaining packages stop early so the pool is free again when
+    # we return.
+    cancellation.cancelAfter(-1)
+    while inFlight:
+        pkg, res, pkgSegments = inFlight.popleft()
+        if pkg is None:
+            continue
+        res.wait()
+        if res.successful() and isinstance(res.get()[3],
+                shared_chunks.SharedIdShards):
+            res.get()[3].free()
+
+class _ParserThread(threading.Thread):
+    """
+    Parses a DEP and splits its chunks into packages in the background. The
+    packages are put into a bounded queue, so parsing stays at most a fixed number of
+    packages ahead of the verification. The end of the DEP is signalled by
+    a None package, together with the exception raised while parsing, if
+    any.
+    """
+
+    def __init__(self, parser, chunksize, keyStore, certCache,
+            signatureCache, packageSize, depth):
+        super(_ParserThread, self).__init__()
+        self.daemon = True
+        self.parser = parser
+        self.chunksize = chunksize
+        self.keyStore = keyStore
+        self.certCache = certCache
+        self.signatureCache = signatureCache
+        self.packageSize = packageSize
+        self.packages = queue.Queue(max(1, depth))
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            for chunk in self.parser.parse(self.chunksize):
+                groups = packageChunkWithVerifiers(chunk, self.keyStore,
+                        self.certCache, self.signatureCache)
+                for pkg in splitGroupsWithVerifiers(groups,
+                        self.packageSize):
+                    if not self._put((pkg, None)):
+                        return
+        except Exception as e:
+            self._put((None, e))
+            return
+        self._put((None, None))
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.packages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class _Cancellation(object):
+    """
+    Owns the SharedCutoff used to cancel the packages following a failed
+    one. The cutoff is lowered from the pool's result handler thread as soon
+    as a package returns an error, so the packages after it stop even
+    before the failed package is reconciled.
+    """
+
+    def __init__(self):
+        self.cutoff, self.shm = shared_chunks.SharedCutoff.create()
+        self.lock = threading.Lock()
+
+    def cancelAfter(self, seq):
+        with self.lock:
+            shared_chunks.SharedCutoff.lower(self.shm, seq)
+
+    def callback(self, seq):
+        def onResult(result):
+            error = result[4]
+            if error is not None and not isinstance(error,
+                    VerificationCancelledException):
+                self.cancelAfter(seq)
+        return onResult
+
+    def free(self):
+        shared_chunks.free([self.shm])
+
+def _joins(rState, specRState, dependsOnCounter):
+    if rState.lastReceiptJWS != specRState.lastReceiptJWS:
+        return False
+    if rState.needRestoreReceipt != specRState.needRestoreReceipt:
+        return False
+    if rState.chainNextTo != specRState.chainNextTo:
+        return False
+    if dependsOnCounter and rState.lastTurnoverCounter != \
+            specRState.lastTurnoverCounter:
+        return False
+    return True
 
 def verifyParsedDEP(parser, keyStore, key, state = None,
         cashRegisterIdx = None, pool = None, nprocs = 1,
         chunksize = utils.depParserChunkSize(),
-        usedRecIdsBackend = verification_state.DEFAULT_USED_RECEIPT_IDS_BACKEND):
+        usedRecIdsBackend = verification_state.DEFAULT_USED_RECEIPT_IDS_BACKEND,
+        poolInitialized = False, sharedMemory = False,
+        parseQueueDepth = None, maxInFlight = None, packageSize = None,
+        certCache = None, signatureCache = None):
     """
     Verifies a previously parsed DEP. It checks if the signature of each
     receipt is valid, if the receipts are properly chained, if receipts
@@ -604,16 +1475,43 @@ def verifyParsedDEP(parser, keyStore, key, state = None,
     :param cashRegisterIdx: The index of the cash register that created the
     DEP in the state parameter or None to create a new register state.
     :param pool: A pool of processes to distribute the work of verifying a
-    DEP among. The pool must support the map() function. If no pool is
-    specified, the current process will perform all the work itself.
-    :param nprocs: The number of processes to expect/use in pool. This
-    function will create at most nprocs work packages at a time and either pass
-    them to a pool or (if no pool is given) process them itself. How the
+    DEP among. The pool must support the apply_async() function. If no pool
+    is specified, the current process will perform all the work itself.
+    :param nprocs: The number of processes to expect/use in pool. It
+    determines the defaults of parseQueueDepth and maxInFlight. How the
     packages are distributed among the pool's processes is up to the pool.
+    If shared memory is supported (Python 3.8 or newer), a failed package
+    cancels all packages following it.
     :param chunksize: The number of receipts the parser should read from the DEP
     in one go.
     :param usedRecIdsBackend: The implementation used to keep track of used
     receipt IDs.
+    :param poolInitialized: True if the processes in pool were initialized
+    with initVerificationWorker() using keyStore and key. The key store, the
+    key and the certificates are then not sent along with each package.
+    :param sharedMemory: True to pass the receipts of each package to the
+    pool through shared memory instead of pickling them. If the used receipt
+    IDs backend is shardable, the receipt IDs are passed back in shards
+    through shared memory as well and merged in the pool (only on POSIX
+    systems). This is ignored if shared memory is not supported
+    (Python < 3.8).
+    :param parseQueueDepth: The number of packages a background thread
+    parses ahead while the pool verifies. If None,
+    utils.verifyParseQueueDepth() is used.
+    :param maxInFlight: The number of packages handed to the pool before
+    waiting for the oldest one. It is also the number of packages whose
+    receipt ID shards are merged at once. If None,
+    utils.verifyMaxPackagesInFlight() is used.
+    :param packageSize: The maximum number of receipts in a package handed to
+    the pool. Chunks are split into packages of this size. If None,
+    utils.verifyPackageSize() is used.
+    :param certCache: A cert_cache.CertificateChainCache used to verify each
+    certificate chain only once. It is bound to keyStore before use. If
+    None, a new cache is used for this DEP only.
+    :param signatureCache: A signature_cache.SignatureCacheI object with
+    signatures that do not need to be verified again or None. The caller
+    has to commit or close it. Worker processes initialized with
+    initVerificationWorker() use their own cache instead.
     :return: The state of the evaluation. (Can be used for the next DEP.)
     :throws: NoRestoreReceiptAfterSignatureSystemFailure
     :throws: InvalidTurnoverCounterException
@@ -649,36 +1547,186 @@ def verifyParsedDEP(parser, keyStore, key, state = None,
     # across different backends.
     usedRecIdsBackend = state.usedReceiptIds.__class__
 
-    prevStart, rState, usedRecIds = state.getCashRegisterInfo(cashRegisterIdx)
-    res = None
-    for chunks in getChunksForProcs(parser.parse(chunksize), nprocs):
-        pkgs = [ packageChunkWithVerifiers(chunk, keyStore) for chunk in chunks ]
-
-        if res is not None:
-            outRStates, outUsedRecIds = zip(*res.get())
-            usedRecIds.merge(outUsedRecIds)
-            rState = outRStates[-1]
-
-        wargs = prepareVerificationTuples(pkgs, key, prevStart, rState,
-                usedRecIdsBackend)
-
-        # apply verifyGroup() to each package
-        if not pool:
-            outresults = map(verifyGroupsWithVerifiersTuple, wargs)
-            res = type('DummyAsyncResult', (object,), {"data": outresults})
-            res.get = MethodType(lambda self: self.data, res)
-        else:
-            res = pool.map_async(verifyGroupsWithVerifiersTuple, wargs)
-
-    outRStates, outUsedRecIds = zip(*res.get())
-    usedRecIds.merge(outUsedRecIds)
-    rState = outRStates[-1]
-
-    state.updateCashRegisterInfo(cashRegisterIdx, rState, usedRecIds)
+    # The used receipt IDs are updated in place and restored if the
+    # verification fails.
+    prevStart, rState, usedRecIds = state.begin(cashRegisterIdx)
+    try:
+        rState = _verifyParsedDEPInState(parser, keyStore, key, prevStart,
+                rState, usedRecIds, usedRecIdsBackend, pool, nprocs,
+                chunksize, poolInitialized, sharedMemory, parseQueueDepth,
+                maxInFlight, packageSize, certCache, signatureCache)
+    except:
+        state.rollback()
+        raise
+
+    state.commit(cashRegisterIdx, rState)
     return state
 
+def _verifyParsedDEPInState(parser, keyStore, key, prevStart, rState,
+        usedRecIds, usedRecIdsBackend, pool, nprocs, chunksize,
+        poolInitialized, sharedMemory, parseQueueDepth, maxInFlight,
+        packageSize, certCache, signatureCache):
+    """
+    Verifies a previously parsed DEP for verifyParsedDEP() and adds the
+    receipt IDs to usedRecIds.
+    :return: The state of the cash register after the DEP.
+    """
+    if certCache is None:
+        certCache = cert_cache.CertificateChainCache()
+    certCache.useKeyStore(keyStore)
+
+    if not pool:
+        for chunk in parser.parse(chunksize):
+            pkg = packageChunkWithVerifiers(chunk, keyStore, certCache,
+                    signatureCache)
+            rState, outUsedRecIds = verifyGroupsWithVerifiers(pkg, key,
+                    prevStart, rState, usedRecIdsBackend())
+            usedRecIds.merge([outUsedRecIds])
+
+        return rState
+
+    if parseQueueDepth is None:
+        parseQueueDepth = utils.verifyParseQueueDepth(nprocs)
+    if maxInFlight is None:
+        maxInFlight = utils.verifyMaxPackagesInFlight(nprocs)
+    maxInFlight = max(1, maxInFlight)
+    if packageSize is None:
+        packageSize = utils.verifyPackageSize()
+
+    func = verifyGroupsSpeculativelyTuple
+    if poolInitialized:
+        func = verifyGroupsInWorkerTuple
+    sharedMemory = sharedMemory and shared_chunks.shared_memory is not None
+
+    # With shared memory, the workers split the used receipt IDs of each
+    # package into shards instead of pickling them back. Once maxInFlight
+    # packages are reconciled, each shard of this window is checked for
+    # duplicates and united by a task in the pool while the next window is
+    # verified. The parent then checks the united shards against
+    # usedRecIds and adds them, so the IDs used before stay in the parent.
+    nshards = 0
+    if sharedMemory and shared_chunks.SharedIdShards.SUPPORTED and \
+            usedRecIdsBackend.SHARDABLE:
+        nshards = max(1, nprocs)
+        func = functools.partial(shardVerificationResultTuple, func, nshards)
+
+    # The DEP is parsed in a background thread while the pool verifies the
+    # packages. Each package is verified starting from a state derived from
+    # the receipts preceding it, so packages can be handed to the pool as
+    # soon as they are parsed. The results are reconciled in order. Once a
+    # package fails, the packages after it are cancelled. The first error in
+    # receipt order is still the one that gets raised, cancelled packages
+    # before it are verified again.
+    startJWS = rState.startReceiptJWS
+    boundary = (None, rState.lastReceiptJWS)
+    firstState = rState
+    inFlight = collections.deque()
+    segments = list()
+    windowPkgs = list()
+    windowShards = list()
+    merging = None
+    cancellation = None
+    if shared_chunks.shared_memory is not None:
+        cancellation = _Cancellation()
+    seq = 0
+    parserThread = _ParserThread(parser, chunksize, keyStore, certCache,
+            signatureCache, packageSize, parseQueueDepth)
+    parserThread.start()
+    try:
+        parsed = False
+        error = None
+        while True:
+            while not parsed and len(inFlight) < maxInFlight:
+                pkg, parseError = parserThread.packages.get()
+                if pkg is None:
+                    parsed = True
+                    if parseError is not None:
+                        inFlight.append((None, parseError, None))
+                    break
+
+                callback = None
+                pkgCancellation = None
+                if cancellation is not None:
+                    callback = cancellation.callback(seq)
+                    pkgCancellation = (cancellation.cutoff, seq)
+                seq += 1
+
+                wargs, startJWS, boundary = prepareVerificationTuples([pkg],
+                        key, prevStart, firstState, startJWS, boundary,
+                        usedRecIdsBackend, pkgCancellation)
+                firstState = None
+                if poolInitialized:
+                    wargs = _stripForWorker(wargs)
+                pkgSegments = list()
+                if sharedMemory:
+                    wargs, pkgSegments = _moveToSharedMemory(wargs)
+                    segments.extend(pkgSegments)
+                inFlight.append((pkg, pool.apply_async(func, wargs,
+                    callback=callback), pkgSegments))
+
+            if merging is not None and merging.ready():
+                merging.finish(usedRecIds)
+                merging = None
+            if not inFlight:
+                break
+            pending = inFlight.popleft()
+            if pending[0] is None:
+                # All packages before the parser error are verified.
+                error = pending[1]
+            elif nshards:
+                pkg, result = _pendingResult(pending, segments)
+                rState, pkgShards, error = \
+                        reconcileShardedVerificationResults([pkg], [result],
+                                key, prevStart, rState, usedRecIdsBackend,
+                                nshards)
+                if pkgShards:
+                    windowPkgs.append(pkg)
+                    windowShards.extend(pkgShards)
+            else:
+                pkg, result = _pendingResult(pending, segments)
+                rState, usedRecIds = reconcileVerificationResults([pkg],
+                        [result], key, prevStart, rState, usedRecIds)
+            if error is not None:
+                _stopInFlight(inFlight, cancellation)
+                break
+
+            if len(windowShards) >= maxInFlight:
+                if merging is not None:
+                    merging.finish(usedRecIds)
+                    merging = None
+                merging = _ShardMerge(pool, windowPkgs, windowShards,
+                        nshards)
+                windowPkgs, windowShards = list(), list()
+
+        # A receipt ID reused before the failed package is reported first.
+        if merging is not None:
+            merging.finish(usedRecIds)
+            merging = None
+        if windowShards:
+            merging = _ShardMerge(pool, windowPkgs, windowShards, nshards)
+            windowPkgs, windowShards = list(), list()
+            merging.finish(usedRecIds)
+            merging = None
+        if error is not None:
+            raise error
+    except:
+        _stopInFlight(inFlight, cancellation)
+        raise
+    finally:
+        parserThread.stop()
+        shared_chunks.free(segments)
+        for pkgShards in windowShards:
+            pkgShards.free()
+        if merging is not None:
+            merging.discard()
+        if cancellation is not None:
+            cancellation.free()
+
+    return rState
+
 def verifyDEP(dep, keyStore, key, state = None, cashRegisterIdx = None,
-        usedRecIdsBackend = verification_state.DEFAULT_USED_RECEIPT_IDS_BACKEND):
+        usedRecIdsBackend = verification_state.DEFAULT_USED_RECEIPT_IDS_BACKEND,
+        certCache = None, signatureCache = None):
     """
     Verifies an entire DEP. It checks if the signature of each receipt is
     valid, if the receipts are properly chained, if receipts with zero
@@ -695,6 +1743,12 @@ def verifyDEP(dep, keyStore, key, state = None, cashRegisterIdx = None,
     DEP in the state parameter or None to create a new register state.
     :param usedRecIdsBackend: The implementation used to keep track of used
     receipt IDs.
+    :param certCache: A cert_cache.CertificateChainCache used to verify each
+    certificate chain only once. It is bound to keyStore before use. If
+    None, a new cache is used for this DEP only.
+    :param signatureCache: A signature_cache.SignatureCacheI object with
+    signatures that do not need to be verified again or None. The caller
+    has to commit or close it.
     :return: The state of the evaluation. (Can be used for the next DEP.)
     :throws: NoRestoreReceiptAfterSignatureSystemFailure
     :throws: InvalidTurnoverCounterException
@@ -726,8 +1780,27 @@ def verifyDEP(dep, keyStore, key, state = None, cashRegisterIdx = None,
     if not state:
         state = verification_state.ClusterState(usedRecIdsBackend)
 
-    prevStart, rState, usedRecIds = state.getCashRegisterInfo(
-            cashRegisterIdx)
+    prevStart, rState, usedRecIds = state.begin(cashRegisterIdx)
+    try:
+        rState = _verifyDEPInState(dep, keyStore, key, prevStart, rState,
+                usedRecIds, certCache, signatureCache)
+    except:
+        state.rollback()
+        raise
+
+    state.commit(cashRegisterIdx, rState)
+    return state
+
+def _verifyDEPInState(dep, keyStore, key, prevStart, rState, usedRecIds,
+        certCache, signatureCache):
+    """
+    Verifies an entire DEP for verifyDEP() and adds the receipt IDs to
+    usedRecIds.
+    :return: The state of the cash register after the DEP.
+    """
+    if certCache is None:
+        certCache = cert_cache.CertificateChainCache()
+    certCache.useKeyStore(keyStore)
 
     # FIXME: ewww...
     one_group = None
@@ -745,15 +1818,16 @@ def verifyDEP(dep, keyStore, key, state = None, cashRegisterIdx = None,
             if not cert:
                 if one_group == False:
                     raise NoCertificateGivenException()
-                rv = verify_receipt.ReceiptVerifier.fromKeyStore(keyStore)
+                rv = verify_receipt.ReceiptVerifier.fromKeyStore(keyStore,
+                        signatureCache)
                 one_group = True
             else:
-                verifyCert(cert, chain, keyStore)
-                rv = verify_receipt.ReceiptVerifier.fromCert(cert)
+                verifyCert(cert, chain, keyStore, certCache)
+                rv = verify_receipt.ReceiptVerifier.fromCert(cert,
+                        signatureCache)
                 one_group = False
 
             rState, usedRecIds = verifyGroup(recs, rv, key, prevStart,
                     rState, usedRecIds)
 
-    state.updateCashRegisterInfo(cashRegisterIdx, rState, usedRecIds)
-    return state
+    return rState
@@ -30,6 +30,7 @@ from six import string_types
 from . import algorithms
 from . import key_store
 from . import receipt
+from . import signature_cache
 from . import utils
 
 class CertSerialMismatchException(receipt.ReceiptException):
@@ -185,84 +186,156 @@ class ReceiptVerifierI(object):
 
 class ReceiptVerifier(ReceiptVerifierI):
     """
-    A simple implementation of a receipt verifier.
+    A simple implementation of a receipt verifier. The public key for each
+    distinct certificate serial is only looked up once, so the key store
+    must not change while the verifier is in use.
     """
 
-    def __init__(self, keyStore, cert):
+    def __init__(self, keyStore, cert, signatureCache = None):
         """
-        Creates a new receipt verifier. At least one of the two parameters has
-        to be set.
+        Creates a new receipt verifier. At least one of the first two
+        parameters has to be set.
         :param keyStore: The key store object to use to obtain public keys or
         None.
         :param cert: The certificate to verify the receipts with as a
         cryptography certificate object.
+        :param signatureCache: A signature_cache.SignatureCacheI object with
+        signatures that do not need to be verified again or None. Valid
+        signatures are added to it.
         """
         self.keyStore = keyStore
         self.cert = cert
+        self.signatureCache = signatureCache
+        self._pubKeys = dict()
+
+    def __getstate__(self):
+        # The cached public keys and the signature cache are not sent to
+        # other processes.
+        state = self.__dict__.copy()
+        del state['_pubKeys']
+        state['signatureCache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pubKeys = dict()
 
     @staticmethod
-    def fromCert(cert):
+    def fromCert(cert, signatureCache = None):
         """
         Creates a new receipt verifier from a certificate object.
         :param cert: The certificate as an object.
+        :param signatureCache: The signature cache to use or None.
         :return: The new receipt verifier.
         """
-        return ReceiptVerifier(None, cert)
+        return ReceiptVerifier(None, cert, signatureCache)
 
     @staticmethod
-    def fromKeyStore(keyStore):
+    def fromKeyStore(keyStore, signatureCache = None):
         """
         Creates a new receipt verifier from a key store object.
         :param keyStore: The key store object.
+        :param signatureCache: The signature cache to use or None.
         :return: The new receipt verifier.
         """
-        return ReceiptVerifier(keyStore, None)
+        return ReceiptVerifier(keyStore, None, signatureCache)
 
     def verify(self, rec, algorithmPrefix):
         if algorithmPrefix not in algorithms.ALGORITHMS:
             raise receipt.UnknownAlgorithmException(rec.receiptId)
         algorithm = algorithms.ALGORITHMS[algorithmPrefix]
 
+        pubKey, mismatch, pubKeyFingerprint = self._getPublicKey(
+                rec.zda == 'AT0', rec.certSerial)
+        if mismatch:
+            raise CertSerialMismatchException(rec.receiptId)
+
+        if rec.isSignedBroken():
+            if not rec.isDummy() and not rec.isReversal() and rec.isNull():
+                raise UnsignedNullReceiptException(rec.receiptId)
+            raise SignatureSystemFailedException(rec.receiptId)
+
+        if not pubKey:
+            raise NoPublicKeyException(rec.receiptId)
+
+        if rec.jwsSigningInput is not None:
+            valid = self._verifyRaw(algorithm, rec.jwsSigningInput,
+                    rec.rawSignature, pubKey, pubKeyFingerprint)
+        else:
+            valid = algorithm.verify(rec.toJWSString(algorithmPrefix), pubKey)
+        if not valid:
+            raise InvalidSignatureException(rec.receiptId)
+
+        return rec, algorithm
+
+    def _getPublicKey(self, closedSystem, recCertSerial):
+        """
+        Gets the public key for the certificate serial in a receipt. The
+        result is cached for each distinct serial.
+        :param closedSystem: True if the receipt was created by a closed
+        system (ZDA AT0).
+        :param recCertSerial: The certificate serial (or key ID) in the
+        receipt.
+        :return: The public key as a cryptography key object or None if none
+        was found, True if the serial does not match the certificate of
+        this verifier (False otherwise) and the fingerprint of the public key
+        if a signature cache is used.
+        """
+        cacheKey = (closedSystem, recCertSerial)
+        ret = self._pubKeys.get(cacheKey)
+        if ret is not None:
+            return ret
+
         pubKey = None
-        if rec.zda == 'AT0':
+        mismatch = False
+        if closedSystem:
             if self.cert:
                 pubKey = self.cert.public_key()
             else:
-                pubKey = self.keyStore.getKey(rec.certSerial)
+                pubKey = self.keyStore.getKey(recCertSerial)
         else:
-            serials = key_store.strSerialToKeyIds(rec.certSerial)
+            serials = key_store.strSerialToKeyIds(recCertSerial)
             if self.cert:
                 certSerial = key_store.numSerialToKeyId(self.cert.serial_number)
                 if not certSerial in serials:
-                    raise CertSerialMismatchException(rec.receiptId)
-                pubKey = self.cert.public_key()
+                    mismatch = True
+                else:
+                    pubKey = self.cert.public_key()
             else:
                 for serial in serials:
                     pubKey = self.keyStore.getKey(serial)
                     if pubKey:
                         break
 
-        if rec.isSignedBroken():
-            if not rec.isDummy() and not rec.isReversal() and rec.isNull():
-                raise UnsignedNullReceiptException(rec.receiptId)
-            raise SignatureSystemFailedException(rec.receiptId)
+        fingerprint = None
+        if pubKey and self.signatureCache is not None:
+            fingerprint = signature_cache.publicKeyFingerprint(pubKey)
 
-        if not pubKey:
-            raise NoPublicKeyException(rec.receiptId)
+        ret = (pubKey, mismatch, fingerprint)
+        self._pubKeys[cacheKey] = ret
+        return ret
 
-        jwsString = rec.toJWSString(algorithmPrefix)
-        if not algorithm.verify(jwsString, pubKey):
-            raise InvalidSignatureException(rec.receiptId)
+    def _verifyRaw(self, algorithm, signingInput, signature, pubKey,
+            pubKeyFingerprint):
+        if self.signatureCache is None or pubKeyFingerprint is None:
+            return algorithm.verifyRaw(signingInput, signature, pubKey)
 
-        return rec, algorithm
+        digest = signature_cache.signatureDigest(signingInput, signature,
+                pubKeyFingerprint)
+        if self.signatureCache.contains(digest):
+            return True
+        valid = algorithm.verifyRaw(signingInput, signature, pubKey)
+        if valid:
+            self.signatureCache.add(digest)
+        return valid
 
     def verifyJWS(self, jwsString):
-        rec, algorithmPrefix = receipt.Receipt.fromJWSString(jwsString)
+        rec, algorithmPrefix = receipt.CompactReceipt.fromJWSString(jwsString)
 
         return self.verify(rec, algorithmPrefix)
 
     def verifyBasicCode(self, basicCode):
-        rec, algorithmPrefix = receipt.Receipt.fromBasicCode(basicCode)
+        rec, algorithmPrefix = receipt.CompactReceipt.fromBasicCode(basicCode)
 
         return self.verify(rec, algorithmPrefix)
 
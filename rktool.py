@@ -23,6 +23,7 @@ from builtins import range
 import kivy
 kivy.require('1.9.0')
 
+import functools
 import os
 import json
 
@@ -71,6 +72,7 @@ from librksv import algorithms
 from librksv import depparser
 from librksv import key_store
 from librksv import receipt
+from librksv import shared_chunks
 from librksv import utils
 from librksv import verification_state
 from librksv import verify_receipt
@@ -563,26 +565,44 @@ def verifyDEP_prepare_Task(dep, store, key, nprocs):
         groupsWithVerifiers = verify.packageChunkWithVerifiers(dep, store)
         pkgs = verify.balanceGroupsWithVerifiers(groupsWithVerifiers, nprocs)
         rState = verification_state.CashRegisterState()
-        inargs = verify.prepareVerificationTuples(pkgs, key, None, rState,
+        inargs, startJWS, boundary = verify.prepareVerificationTuples(pkgs,
+                key, None, rState, None, (None, None),
                 verification_state.UsedReceiptIdsUnique)
         return None, inargs
     except (receipt.ReceiptException, depparser.DEPException) as e:
         return e, None
 
 def verifyDEP_main_Task(args):
-    try:
-        rState, usedRecIds = verify.verifyGroupsWithVerifiersTuple(args)
-        return None, usedRecIds
-    except (receipt.ReceiptException, depparser.DEPException) as e:
-        return e, None
+    # Errors are returned as part of the result.
+    return verify.verifyGroupsSpeculativelyTuple(args)
 
-def verifyDEP_finalize_Task(outUsedRecIds, usedRecIds):
+def verifyDEP_finalize_Task(pkgs, results, key, nshards):
     try:
-        usedRecIds.merge(outUsedRecIds)
-        return None, usedRecIds
+        if not nshards:
+            verify.reconcileVerificationResults(pkgs, results, key, None,
+                    verification_state.CashRegisterState(),
+                    verification_state.UsedReceiptIdsUnique())
+            return None, None
+
+        # The receipt IDs are merged in the pool afterwards, the error only
+        # counts if no receipt ID before it is reused.
+        rState, idShards, e = verify.reconcileShardedVerificationResults(
+                pkgs, results, key, None,
+                verification_state.CashRegisterState(),
+                verification_state.UsedReceiptIdsUnique, nshards)
+        if e is not None and not isinstance(e, (receipt.ReceiptException,
+                depparser.DEPException)):
+            verifyDEP_freeShards(idShards)
+            raise e
+        return e, idShards
     except (receipt.ReceiptException, depparser.DEPException) as e:
         return e, None
 
+def verifyDEP_freeShards(idShards):
+    for shards in idShards:
+        if isinstance(shards, shared_chunks.SharedIdShards):
+            shards.free()
+
 # TODO: add a visual way to determine where an error happened?
 class VerifyDEPWidget(BoxLayout):
     treeView = ObjectProperty(None)
@@ -591,6 +611,8 @@ class VerifyDEPWidget(BoxLayout):
 
     _verifying = False
     _verified = False
+    _verifyArgs = None
+    _nshards = 0
 
     def addCert(self, btn):
         pubKey = btn.key.public_key()
@@ -694,6 +716,11 @@ class VerifyDEPWidget(BoxLayout):
 
         self._verifying = True
         self.verify_button.text = _('Verifying...')
+        # The workers pass the used receipt IDs back in shards through
+        # shared memory, which are then merged in the pool as well.
+        self._nshards = 0
+        if shared_chunks.SharedIdShards.SUPPORTED:
+            self._nshards = App.get_running_app().nprocs
 
         App.get_running_app().pool.apply_async(verifyDEP_prepare_Task,
                 (self.dep, App.get_running_app().keyStore, key,
@@ -711,35 +738,64 @@ class VerifyDEPWidget(BoxLayout):
             displayError(result[0])
 
         else:
-            App.get_running_app().pool.map_async(verifyDEP_main_Task,
+            self._verifyArgs = result[1]
+            func = verifyDEP_main_Task
+            if self._nshards:
+                func = functools.partial(verify.shardVerificationResultTuple,
+                        verifyDEP_main_Task, self._nshards)
+            App.get_running_app().pool.map_async(func,
                     result[1], callback = self.verifyDEP_main_Cb)
 
     def verifyDEP_main_Cb(self, result):
         if not self._verifying:
+            verifyDEP_freeShards([ r[3] for r in result ])
             return
 
-        outUsedRecIds = list()
-        for r in result:
-            if r[0]:
-                self._verifying = False
-                self.verify_button.text = _('Verify')
-                displayError(r[0])
-                return
-            outUsedRecIds.append(r[1])
-
+        # The packages have to be reconciled in order to find the first
+        # error, so this is left to the finalize task.
+        args = self._verifyArgs
+        self._verifyArgs = None
+        pkgs = [ a[0] for a in args ]
         App.get_running_app().pool.apply_async(verifyDEP_finalize_Task,
-                (outUsedRecIds, verification_state.UsedReceiptIdsUnique()),
-                callback = self.verifyDEP_finalize_Cb)
+                (pkgs, result, args[0][1], self._nshards),
+                callback = functools.partial(self.verifyDEP_finalize_Cb,
+                    pkgs))
+
+    def verifyDEP_finalize_Cb(self, pkgs, result):
+        error, idShards = result
+        if not idShards:
+            self.verifyDEP_done(error)
+            return
+        if not self._verifying:
+            verifyDEP_freeShards(idShards)
+            return
+
+        # Each shard of the receipt IDs is checked for duplicates by its own
+        # task.
+        App.get_running_app().pool.map_async(verify.mergeReceiptIdShardTuple,
+                [ (idShards, shard) for shard in range(self._nshards) ],
+                callback = functools.partial(self.verifyDEP_merge_Cb, error,
+                    pkgs[:len(idShards)], idShards))
+
+    def verifyDEP_merge_Cb(self, error, pkgs, idShards, results):
+        try:
+            verify.combineReceiptIdShards(pkgs, idShards, results,
+                    verification_state.UsedReceiptIdsUnique())
+        except verification_state.DuplicateReceiptIdException as e:
+            error = e
+        finally:
+            verifyDEP_freeShards(idShards)
+        self.verifyDEP_done(error)
 
     @mainthread
-    def verifyDEP_finalize_Cb(self, result):
+    def verifyDEP_done(self, error):
         if not self._verifying:
             return
 
         self._verifying = False
-        if result[0]:
+        if error:
             self.verify_button.text = _('Verify')
-            displayError(result[0])
+            displayError(error)
 
         else:
             self._verified = True
@@ -27,21 +27,28 @@ import sys
 import gettext
 gettext.install('rktool', './lang', True)
 
+from librksv import cert_cache
 from librksv import depparser
 from librksv import key_store
+from librksv import signature_cache
 from librksv import utils
 from librksv import verification_state
 
-from librksv.verify import verifyDEP, verifyParsedDEP
+from librksv.verify import initVerificationWorker, verifyDEP, verifyParsedDEP
 
 def usage():
-    print("Usage: ./verify.py [state [continue|<n>]] [par <n>] [chunksize <n>] [json] <key store> <dep export file>",
+    print("Usage: ./verify.py [state [continue|<n>]] [par <n>] [chunksize <n>] [sigcache <file>] [json] <key store> <dep export file>",
             file=sys.stderr)
     print("       ./verify.py state", file=sys.stderr)
+    print("", file=sys.stderr)
+    print("sigcache <file> caches verified receipt signatures across runs in the",
+            file=sys.stderr)
+    print("given SQLite database. Without it, RKSV_SIGNATURE_CACHE_FILE is used if set.",
+            file=sys.stderr)
     sys.exit(0)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2 or len(sys.argv) > 10:
+    if len(sys.argv) < 2 or len(sys.argv) > 12:
         usage()
 
     key = None
@@ -70,7 +77,7 @@ if __name__ == "__main__":
         except ValueError:
             pass
 
-    if len(sys.argv) < 3 or len(sys.argv) > 8:
+    if len(sys.argv) < 3 or len(sys.argv) > 10:
         usage()
 
     nprocs = 1
@@ -84,7 +91,7 @@ if __name__ == "__main__":
     if nprocs < 1:
         usage()
 
-    if len(sys.argv) < 3 or len(sys.argv) > 6:
+    if len(sys.argv) < 3 or len(sys.argv) > 8:
         usage()
 
     chunksize = utils.depParserChunkSize()
@@ -98,6 +105,15 @@ if __name__ == "__main__":
     if chunksize < 0:
         usage()
 
+    if len(sys.argv) < 3 or len(sys.argv) > 6:
+        usage()
+
+    signatureCacheFile = utils.signatureCacheFile()
+    if sys.argv[1] == 'sigcache':
+        del sys.argv[1]
+        signatureCacheFile = sys.argv[1]
+        del sys.argv[1]
+
     if len(sys.argv) < 3 or len(sys.argv) > 4:
         usage()
 
@@ -121,9 +137,27 @@ if __name__ == "__main__":
         if continueLast:
             registerIdx = len(state.cashRegisters) - 1
 
+    certCache = None
+    certCacheFile = utils.certCacheFile()
+    if certCacheFile:
+        try:
+            with open(certCacheFile) as f:
+                certCache = cert_cache.CertificateChainCache.readCacheFromJson(
+                        utils.readJsonStream(f))
+        except IOError:
+            certCache = cert_cache.CertificateChainCache()
+
+    signatureCache = None
+
     if nprocs > 1:
         import multiprocessing
-        pool = multiprocessing.Pool(nprocs)
+        signatureCacheCounters = None
+        if signatureCacheFile:
+            signatureCacheCounters = multiprocessing.Array('q', 2)
+            signatureCache = signature_cache.SQLiteSignatureCache(
+                    signatureCacheFile, signatureCacheCounters)
+        pool = multiprocessing.Pool(nprocs, initVerificationWorker,
+                (keyStore, key, signatureCacheFile, signatureCacheCounters))
 
         try:
             with open(sys.argv[2]) as f:
@@ -133,19 +167,40 @@ if __name__ == "__main__":
                     parser = depparser.IncrementalDEPParser.fromFd(f, True)
 
                 state = verifyParsedDEP(parser, keyStore, key, state, registerIdx,
-                        pool, nprocs, chunksize)
+                        pool, nprocs, chunksize, poolInitialized=True,
+                        sharedMemory=True, certCache=certCache,
+                        signatureCache=signatureCache)
         finally:
             pool.terminate()
             pool.join()
+            if signatureCache:
+                signatureCache.close()
     else:
-        with open(sys.argv[2]) as f:
-            if chunksize == 0:
-                dep = utils.readJsonStream(f)
-                state = verifyDEP(dep, keyStore, key, state, registerIdx)
-            else:
-                parser = depparser.IncrementalDEPParser.fromFd(f, True)
-                state = verifyParsedDEP(parser, keyStore, key, state, registerIdx,
-                        None, nprocs, chunksize)
+        if signatureCacheFile:
+            signatureCache = signature_cache.SQLiteSignatureCache(
+                    signatureCacheFile)
+        try:
+            with open(sys.argv[2]) as f:
+                if chunksize == 0:
+                    dep = utils.readJsonStream(f)
+                    state = verifyDEP(dep, keyStore, key, state, registerIdx,
+                            certCache=certCache, signatureCache=signatureCache)
+                else:
+                    parser = depparser.IncrementalDEPParser.fromFd(f, True)
+                    state = verifyParsedDEP(parser, keyStore, key, state,
+                            registerIdx, None, nprocs, chunksize,
+                            certCache=certCache, signatureCache=signatureCache)
+        finally:
+            if signatureCache:
+                signatureCache.close()
+
+    if certCacheFile:
+        with open(certCacheFile, 'w') as f:
+            json.dump(certCache.writeCacheToJson(), f, indent=2)
+
+    if signatureCache:
+        print(_("Signature cache: {} hits, {} misses.").format(
+            signatureCache.hits(), signatureCache.misses()), file=sys.stderr)
 
     if statePassthrough:
         print(json.dumps(